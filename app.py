@@ -1,71 +1,109 @@
-import os
 import streamlit as st
 import logging
-from feature_extracting import FeatureExtractor
-from preprocessing import Preprocessor
-from predicting import Predictor
-from image_viewing import ImageViewer
-
-
-def process_result(image_name: str, mask_name: str, clinical_data: dict, show: bool) -> int:
+import time
+from job_queue import JobQueue
+from preloading import Preloader
+
+# Период опроса состояния задачи в секундах
+POLL_INTERVAL = 0.5
+STAGE_LABELS = {
+    'queued': 'Waiting in queue',
+    'preprocess': 'Preprocessing',
+    'extract': 'Extracting features',
+    'predict': 'Predicting',
+    'robustness': 'Checking prediction stability',
+    'preview': 'Rendering preview',
+    'done': 'Done'
+}
+PREVIEW_LABELS = {
+    'axial': 'Axial slice',
+    'coronal': 'Coronal slice',
+    'sagittal': 'Sagittal slice',
+    'triplanar': 'Three planes',
+    'strip': 'Slices through the lesion'
+}
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
     """
-    Подготовка результата: загрузка, предобработка, извлечение признаков и предсказание
-
-    Параметры:
-    - image_name (str): Имя файла изображения
-    - mask_name (str): Имя файла маски
-    - clinical_data (dict): Клинические данные
-    - show (bool): Флаг, указывающий, нужно ли отобразить изображение
+    Очередь задач, общая для всех сессий приложения: тяжелые вычисления выполняются в прогретых
+    процессах, а поток Streamlit только ставит задачу и опрашивает ее состояние
 
     Возвращает:
-    - result (int): Результат предсказания
+    - job_queue (JobQueue): Очередь задач
     """
-    logging.info('App: Processing result')
-    model = 'liver_t2w_xgboost'
-    preprocessor = Preprocessor(mri_modality='T2')
-    feature_extractor = FeatureExtractor(model, desired_order_bool=False)
-    predictor = Predictor(model)
-
-    image_path = os.path.join("static", image_name)
-    mask_path = os.path.join("static", mask_name)
+    return JobQueue()
 
-    image, mask = preprocessor.preprocessing_step(image_path, mask_path, normalize=True, resample=False)
 
-    if show:
-        visualizer = ImageViewer(image, mask)
-        visualizer.show()
-
-    os.remove(image_path)
-    os.remove(mask_path)
-
-    features = feature_extractor.extract_features(image, mask)
-    data = features | clinical_data
+@st.cache_resource
+def get_preloader() -> Preloader:
+    """
+    Фоновый прогрев процессов-обработчиков (загрузка моделей и pyradiomics), пока отрисовывается интерфейс.
+    Задачи, поставленные до окончания прогрева, ждут в очереди
 
-    return predictor.predict(data)
+    Возвращает:
+    - preloader (Preloader): Прогрев, запущенный один раз на приложение
+    """
+    return Preloader({'workers': get_job_queue().warm_up}).start()
 
 
-def save_uploaded_file(uploaded_file, save_path: str) -> None:
+def show_job(job_queue: JobQueue, job_id: str) -> None:
     """
-    Сохранение загруженного файла
+    Отображение состояния задачи: этап выполнения, результат или ошибка
 
     Параметры:
-    - uploaded_file: Загруженный файл
-    - save_path: Путь для сохранения файла
+    - job_queue (JobQueue): Очередь задач
+    - job_id (str): Идентификатор задачи
     """
-    with open(save_path, "wb") as f:
-        logging.info('App: Saving uploaded file')
-        f.write(uploaded_file.getbuffer())
+    try:
+        status = job_queue.status(job_id)
+    except ValueError:
+        del st.session_state['job_id']
+        st.error("Job expired, please submit again.")
+        return
+
+    if status['state'] in ('queued', 'running'):
+        st.progress(status['progress'], text=STAGE_LABELS[status['stage']])
+        if st.button("Cancel", key="cancel_button"):
+            job_queue.cancel(job_id)
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+    elif status['state'] == 'cancelled':
+        st.warning("Prediction cancelled.")
+    elif status['state'] == 'failed':
+        st.error(f"Prediction failed: {status['error']}")
+    else:
+        result = status['result']
+        if result['prediction']:
+            st.write("Malignant lesion (intrahepatic cholangiocarcinoma, hepatocellular carcinoma)")
+        else:
+            st.write(f"Benign lesion (hepatocellular adenoma, focal nodular hyperplasia)")
+
+        stability = result.get('robustness')
+        if stability is not None and stability['variants']:
+            message = (f"Prediction agrees in {stability['variants'] - len(stability['flipped'])} of "
+                       f"{stability['variants']} mask and binning variants, probability "
+                       f"{stability['probability_min']:.2f}-{stability['probability_max']:.2f}")
+            if stability['stable']:
+                st.success(message)
+            else:
+                st.warning(f"{message}. Changed by: {', '.join(stability['flipped'])}")
+
+        if st.session_state.get('show_image'):
+            if result['preview'] is not None:
+                st.image(result['preview'], caption="MRI with Mask", use_container_width=True)
+            else:
+                st.error("Image not found.")
 
 
 # Главная функция для запуска приложения Streamlit
 def main():
 
-    if not os.path.isdir("static"):
-        os.mkdir("static")
-
     st.set_page_config(
         page_title="Liver lesion group predictor",
         page_icon="🧊")
+    preloader = get_preloader()
 
     st.markdown(
         """
@@ -81,6 +119,9 @@ def main():
     col1.metric("ROC-AUC", "0.9")
     col2.metric("F1-Score", "0.89")
 
+    if not preloader.ready:
+        st.caption("Loading models in the background...")
+
     st.subheader("Data Upload")
 
     col1, col2 = st.columns(2)
@@ -101,35 +142,33 @@ def main():
     with col5:
         age = st.number_input("Enter Age", min_value=18, value=45)
         show_image = st.checkbox("Show MRI with Mask")
+        check_stability = st.checkbox("Check prediction stability")
+        preview_mode = st.selectbox("Preview", tuple(PREVIEW_LABELS), format_func=PREVIEW_LABELS.get,
+                                    disabled=not show_image)
 
     # Кнопка для обработки файлов
     if st.button("Predict lesion group", key="html_button"):
         if t2_mri is not None and mask is not None:
-            save_uploaded_file(t2_mri, os.path.join("static", t2_mri.name))
-            save_uploaded_file(mask, os.path.join("static", mask.name))
-
             clinical_data = {
                 'age': age,
                 'sex': 'F' if gender == 'Female' else 'M',
                 'manufacturer': manufacturer
             }
-            result = process_result(t2_mri.name, mask.name, clinical_data, show_image)
-
-            if result:
-                st.write("Malignant lesion (intrahepatic cholangiocarcinoma, hepatocellular carcinoma)")
-            else:
-                st.write(f"Benign lesion (hepatocellular adenoma, focal nodular hyperplasia)")
-
-            if show_image:
-                image_path = "static/show_slice.jpg"  # Убедитесь, что путь корректен
-                if os.path.exists(image_path):
-                    st.image(image_path, caption="MRI with Mask", use_container_width=True)
-                    os.remove(image_path)
-                else:
-                    st.error("Image not found.")
+            try:
+                st.session_state['job_id'] = get_job_queue().submit(
+                    t2_mri.getbuffer(), t2_mri.name, mask.getbuffer(), mask.name, clinical_data, show_image,
+                    preview_mode, check_stability
+                )
+                st.session_state['show_image'] = show_image
+            except ValueError:
+                st.error("Server is busy, please try again in a moment.")
         else:
             st.error("Please upload both files.")
 
+    # Результат опрашивается по идентификатору задачи, интерфейс не блокируется на время вычислений
+    if 'job_id' in st.session_state:
+        show_job(get_job_queue(), st.session_state['job_id'])
+
 
 if __name__ == "__main__":
     logging.info("App: App started")
@@ -0,0 +1,403 @@
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from feature_cache import CACHE_PATH, FeatureCache
+from memory_scheduling import memory_scheduler
+from model_registry import model_registry
+from parallel_feature_extracting import START_METHOD
+from preloading import Preloader, warm_up_model
+from preprocessing import PREPROCESSING_VERSION
+from tracing import tracer
+from volume_store import volume_store
+
+IMAGE_FILE_NAME = 'image.nii.gz'
+MASK_FILE_NAME = 'segmentation.nii.gz'
+CLINICAL_FILE_NAME = 'clinical_data.txt'
+RESULT_COLUMNS = ['case', 'prediction', 'probability']
+ERROR_COLUMNS = ['case', 'error']
+
+# Кэши признаков процесса-обработчика по пути к файлу кэша
+_feature_caches = {}
+
+def read_clinical_data(clinical_path: str) -> dict:
+    """
+    Чтение клинических данных случая из файла вида "Age: 64, Sex: M, Manufacturer: Philips"
+
+    Параметры:
+    - clinical_path (str): Путь к файлу клинических данных
+
+    Возвращает:
+    - clinical_data (dict): Клинические данные в формате модели
+    """
+    values = {}
+    with open(clinical_path) as f:
+        for line in f.read().replace(',', '\n').splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                values[key.strip().lower()] = value.strip()
+
+    try:
+        return {
+            'age': int(values['age']),
+            'sex': values['sex'],
+            'manufacturer': values['manufacturer']
+        }
+    except (KeyError, ValueError):
+        logging.error('Batch: Invalid clinical data')
+        raise ValueError(f'Batch: Invalid clinical data in {clinical_path}')
+
+
+def _init_worker(model: str, mri_modality: str, backend: str, tracing=False, trace_file=None) -> None:
+    """
+    Инициализация процесса-обработчика: модель загружается в реестр один раз на процесс
+
+    Параметры:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - backend (str): Реализация извлечения признаков
+    - tracing (bool): Флаг, указывающий, включена ли трассировка в основном процессе
+    - trace_file (str): Файл JSON Lines для интервалов основного процесса
+    """
+    logging.info('Batch: Initializing worker')
+    if tracing:
+        tracer.enable(trace_file)
+    warm_up_model(model, mri_modality, backend)
+    logging.info(f'Batch: Worker models loaded: {model_registry.report()}')
+
+
+def _process_case(case_dir: str, model: str, mri_modality: str, normalize: bool, resample: bool, crop: bool,
+                  backend='pyradiomics', cache_path=None) -> dict:
+    """
+    Обработка одного случая: предобработка и извлечение признаков. Предсказание выполняется
+    в основном процессе пачками
+
+    Параметры:
+    - case_dir (str): Путь к папке случая
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+    - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+    - crop (bool): Флаг, указывающий, нужно ли обрабатывать только область маски
+    - backend (str): Реализация извлечения признаков
+    - cache_path (str): Путь к кэшу признаков, None - без кэша
+
+    Возвращает:
+    - record (dict): Признаки и клинические данные случая
+    """
+    clinical_data = read_clinical_data(os.path.join(case_dir, CLINICAL_FILE_NAME))
+    registered_model = model_registry.get(model, backend)
+    image_path = os.path.join(case_dir, IMAGE_FILE_NAME)
+    mask_path = os.path.join(case_dir, MASK_FILE_NAME)
+
+    def extract() -> dict:
+        image, mask = model_registry.preprocessor(mri_modality).preprocessing_step(
+            image_path, mask_path, normalize=normalize, resample=resample, crop=crop
+        )
+        return registered_model.feature_extractor.extract_features(image, mask)
+
+    if cache_path is None:
+        features = extract()
+    else:
+        cache = _feature_caches.setdefault(cache_path, FeatureCache(cache_path))
+        key = cache.make_key(image_path, mask_path, registered_model.feature_extractor.params,
+                             normalize=normalize, resample=resample, modality=mri_modality, crop=crop,
+                             backend=backend, version=PREPROCESSING_VERSION)
+        features = cache.get_or_compute(key, extract)
+    return features | clinical_data
+
+
+def _run_case(case_dir: str, *args) -> tuple:
+    """
+    Обработка одного случая под идентификатором запроса, равным имени случая
+
+    Параметры:
+    - case_dir (str): Путь к папке случая
+    - args: Остальные аргументы _process_case
+
+    Возвращает:
+    - record (dict): Признаки и клинические данные случая
+    - spans (list): Интервалы трассировки случая, пустой список при выключенной трассировке
+    """
+    with tracer.request(os.path.basename(case_dir)) as spans, tracer.span('case'):
+        record = _process_case(case_dir, *args)
+    return record, spans
+
+
+class BatchProcessor:
+    """
+    Класс BatchProcessor предназначен для параллельной обработки когорты случаев
+
+    Атрибуты:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+    - workers (int): Количество процессов-обработчиков
+    - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+    - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+    - crop (bool): Флаг, указывающий, нужно ли обрабатывать только область маски
+    - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+    - cache_path (str): Путь к кэшу признаков, None - без кэша
+    - metrics_path (str): Путь к файлу метрик Prometheus, None - без метрик
+
+    Методы:
+    - __init__(self, model, mri_modality='T2', workers=None, normalize=True, resample=False, crop=False,
+      backend='pyradiomics', cache_path=CACHE_PATH, metrics_path=None): Инициализация класса
+    - find_cases(cohort_root): Поиск папок случаев в корне когорты
+    - result_columns(output_path): Столбцы таблицы результатов
+    - completed_cases(output_path): Чтение уже обработанных случаев из таблицы результатов
+    - run(self, cohort_root, output_path): Обработка когорты с записью таблицы результатов
+    """
+
+    def __init__(self, model: str, mri_modality='T2', workers=None, normalize=True, resample=False, crop=False,
+                 backend='pyradiomics', cache_path=CACHE_PATH, metrics_path=None):
+        """
+        Инициализация класса BatchProcessor
+
+        Параметры:
+        - model (str): Название модели
+        - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+        - workers (int): Количество процессов-обработчиков, по умолчанию число доступных ядер
+        - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+        - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        - crop (bool): Флаг, указывающий, нужно ли обрабатывать только область маски
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+        - cache_path (str): Путь к кэшу признаков, None - без кэша
+        - metrics_path (str): Путь к файлу метрик Prometheus, записываемому после запуска; включает трассировку
+        """
+        logging.info('Batch: Initializing BatchProcessor class')
+        self.model = model
+        self.mri_modality = mri_modality
+        self.normalize = normalize
+        self.resample = resample
+        self.crop = crop
+        self.backend = backend
+        self.cache_path = cache_path
+        self.metrics_path = metrics_path
+        if metrics_path:
+            tracer.enable()
+        if workers is None:
+            workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        if workers < 1:
+            logging.error('Batch: Invalid number of workers')
+            raise ValueError('Batch: Number of workers must be positive')
+        self.workers = workers
+
+    @staticmethod
+    def find_cases(cohort_root: str) -> list:
+        """
+        Поиск папок случаев в корне когорты
+
+        Параметры:
+        - cohort_root (str): Путь к корню когорты
+
+        Возвращает:
+        - cases (list): Отсортированный список путей к папкам случаев
+        """
+        if not os.path.isdir(cohort_root):
+            logging.error('Batch: Cohort root not found')
+            raise ValueError('Batch: Cohort root not found')
+        return sorted(
+            entry.path for entry in os.scandir(cohort_root)
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, MASK_FILE_NAME))
+        )
+
+    @staticmethod
+    def result_columns(output_path: str) -> list:
+        """
+        Столбцы таблицы результатов: существующая таблица дописывается со своим заголовком
+
+        Параметры:
+        - output_path (str): Путь к таблице результатов
+
+        Возвращает:
+        - columns (list): Названия столбцов
+        """
+        if not os.path.isfile(output_path):
+            return RESULT_COLUMNS
+        with open(output_path, newline='') as f:
+            return next(csv.reader(f), RESULT_COLUMNS)
+
+    @staticmethod
+    def completed_cases(output_path: str) -> set:
+        """
+        Чтение уже обработанных случаев из таблицы результатов
+
+        Параметры:
+        - output_path (str): Путь к таблице результатов
+
+        Возвращает:
+        - cases (set): Имена обработанных случаев
+        """
+        if not os.path.isfile(output_path):
+            return set()
+        with open(output_path, newline='') as f:
+            return {row['case'] for row in csv.DictReader(f)}
+
+    def run(self, cohort_root: str, output_path: str) -> dict:
+        """
+        Обработка когорты: каждый случай обрабатывается в пуле процессов, когда для него хватает бюджета памяти
+        memory_scheduler (случай, не помещающийся в бюджет целиком, обрабатывается только в области маски),
+        предсказания для готовых случаев выполняются пачками в основном процессе, результаты дописываются в таблицу.
+        Случаи, уже присутствующие в таблице, пропускаются; ошибки записываются в отдельную таблицу
+        и не прерывают обработку остальных случаев
+
+        Параметры:
+        - cohort_root (str): Путь к корню когорты
+        - output_path (str): Путь к CSV-таблице результатов
+
+        Возвращает:
+        - summary (dict): Количество обработанных, пропущенных и ошибочных случаев
+        """
+        done = self.completed_cases(output_path)
+        cases = [case for case in self.find_cases(cohort_root) if os.path.basename(case) not in done]
+        logging.info(f'Batch: {len(cases)} cases to process, {len(done)} already done')
+        summary = {'processed': 0, 'skipped': len(done), 'failed': 0}
+        if not cases:
+            return summary
+
+        errors_path = os.path.splitext(output_path)[0] + '_errors.csv'
+        write_header = not os.path.isfile(output_path)
+        # Ошибки прерванных запусков сохраняются, неудачные случаи повторяются и дописываются снова
+        write_errors_header = not os.path.isfile(errors_path)
+        columns = self.result_columns(output_path)
+        saved_before = volume_store.stats()['total_saved_seconds'] if volume_store.enabled else 0.0
+        # Модель основного процесса для предсказаний загружается, пока запускаются процессы-обработчики
+        Preloader({'model': lambda: model_registry.get(self.model, self.backend)}).start()
+        pending = []
+        with open(output_path, 'a', newline='') as results_file, open(errors_path, 'a', newline='') as errors_file:
+            results = csv.DictWriter(results_file, fieldnames=columns, extrasaction='ignore')
+            errors = csv.DictWriter(errors_file, fieldnames=ERROR_COLUMNS)
+            if write_header:
+                results.writeheader()
+            if write_errors_header:
+                errors.writeheader()
+
+            # fork небезопасен, пока фоновый поток загружает модель в основном процессе
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(cases)),
+                                     mp_context=multiprocessing.get_context(START_METHOD),
+                                     initializer=_init_worker,
+                                     initargs=(self.model, self.mri_modality, self.backend,
+                                               tracer.enabled, tracer.trace_file)) as executor:
+                # Случаи запускаются потоком планировщика памяти, завершенные приходят в порядке готовности
+                completed = queue.Queue()
+
+                def start(case: str, admission) -> None:
+                    try:
+                        future = executor.submit(_run_case, case, self.model, self.mri_modality, self.normalize,
+                                                 self.resample, admission.crop, self.backend, self.cache_path)
+                    except RuntimeError as e:
+                        future = Future()
+                        future.set_exception(e)
+                    future.add_done_callback(lambda future: (memory_scheduler.release(admission),
+                                                             completed.put((os.path.basename(case), future))))
+
+                # Боксы масок ищутся в процессах пула не более чем для workers случаев впереди запущенных:
+                # каждый запущенный случай отправляет на оценку следующий
+                remaining, remaining_lock = iter(cases), threading.Lock()
+
+                def schedule_next() -> None:
+                    with remaining_lock:
+                        case = next(remaining, None)
+                    if case is not None:
+                        memory_scheduler.submit_measured(
+                            executor, lambda admission: (schedule_next(), start(case, admission)),
+                            os.path.join(case, IMAGE_FILE_NAME), os.path.join(case, MASK_FILE_NAME), self.normalize,
+                            self.resample, self.crop, self.backend
+                        )
+
+                for _ in range(min(self.workers, len(cases))):
+                    schedule_next()
+                batcher = model_registry.get(self.model, self.backend).batcher
+                for _ in cases:
+                    case_name, future = completed.get()
+                    try:
+                        record, spans = future.result()
+                        tracer.ingest(spans)
+                        pending.append((case_name, batcher.submit(record)))
+                    except Exception as e:
+                        self._write_error(errors, errors_file, case_name, e, summary)
+                    pending = self._write_predictions(pending, results, results_file, errors, errors_file,
+                                                      summary, wait=False)
+            self._write_predictions(pending, results, results_file, errors, errors_file, summary, wait=True)
+
+        if self.metrics_path:
+            tracer.write_prometheus(self.metrics_path)
+        if volume_store.enabled:
+            saved = volume_store.stats()['total_saved_seconds'] - saved_before
+            logging.info(f'Batch: Volume store saved {saved:.1f} s of image decompression')
+        logging.info(f'Batch: Memory scheduler {memory_scheduler.stats()}')
+        logging.info(f'Batch: Finished, summary: {summary}')
+        return summary
+
+    @staticmethod
+    def _write_error(errors: csv.DictWriter, errors_file, case_name: str, error: Exception, summary: dict) -> None:
+        logging.error(f'Batch: Case {case_name} failed: {error}')
+        errors.writerow({'case': case_name, 'error': repr(error)})
+        errors_file.flush()
+        summary['failed'] += 1
+
+    def _write_predictions(self, pending: list, results: csv.DictWriter, results_file, errors: csv.DictWriter,
+                           errors_file, summary: dict, wait: bool) -> list:
+        """
+        Запись готовых предсказаний в таблицу результатов
+
+        Параметры:
+        - pending (list): Пары (случай, Future предсказания) в порядке поступления
+        - results (csv.DictWriter): Таблица результатов
+        - results_file: Файл таблицы результатов
+        - errors (csv.DictWriter): Таблица ошибок
+        - errors_file: Файл таблицы ошибок
+        - summary (dict): Счетчики обработки
+        - wait (bool): Флаг, указывающий, нужно ли дождаться всех предсказаний
+
+        Возвращает:
+        - pending (list): Еще не готовые предсказания
+        """
+        remaining = []
+        for case_name, prediction_future in pending:
+            if not wait and not prediction_future.done():
+                remaining.append((case_name, prediction_future))
+                continue
+            try:
+                prediction, probabilities = prediction_future.result()
+            except Exception as e:
+                self._write_error(errors, errors_file, case_name, e, summary)
+                continue
+            results.writerow({'case': case_name, 'prediction': int(prediction), 'probability': probabilities[-1]})
+            summary['processed'] += 1
+        # Запись сразу на диск, чтобы прерванный запуск можно было продолжить
+        results_file.flush()
+        return remaining
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch lesion group prediction over a cohort of case directories')
+    parser.add_argument('cohort_root', help='Directory with one sub-directory per case')
+    parser.add_argument('output', help='CSV results table, appended to on resume')
+    parser.add_argument('--model', default='liver_t2w_xgboost')
+    parser.add_argument('--modality', default='T2', choices=['T1', 'T2'])
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('--no-normalize', action='store_true')
+    parser.add_argument('--resample', action='store_true')
+    parser.add_argument('--crop', action='store_true', help='Preprocess and extract only the mask bounding box')
+    parser.add_argument('--backend', default='pyradiomics', choices=['pyradiomics', 'numpy'],
+                        help='Feature extraction backend')
+    parser.add_argument('--cache', default=CACHE_PATH, help='Feature cache file')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--metrics', default=None, help='Write stage histograms in Prometheus text format to this file')
+    args = parser.parse_args()
+
+    processor = BatchProcessor(args.model, mri_modality=args.modality, workers=args.workers,
+                               normalize=not args.no_normalize, resample=args.resample, crop=args.crop,
+                               backend=args.backend, cache_path=None if args.no_cache else args.cache,
+                               metrics_path=args.metrics)
+    processor.run(args.cohort_root, args.output)
+
+
+if __name__ == "__main__":
+    logging.info("Batch: Batch processing started")
+    main()
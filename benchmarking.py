@@ -0,0 +1,275 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import SimpleITK as sitk
+from feature_extracting import FeatureExtractor
+from image_viewing import ImageViewer
+from lazy_importing import ENTRY_MODULES, import_report
+from memory_monitoring import track_peak_rss
+from parallel_feature_extracting import ParallelFeatureExtractor, compute_feature_class
+from predicting import Predictor
+from preprocessing import Preprocessor
+from volume_store import VolumeStore
+
+MODEL = 'liver_t2w_xgboost'
+TEST_CASE = 'test_data/Liver165'
+CLINICAL_DATA = {'age': 60, 'sex': 'M', 'manufacturer': 'Philips'}
+# Размеры синтетических объемов (x, y, z)
+SYNTHETIC_SIZES = {
+    'small': (128, 128, 32),
+    'medium': (256, 256, 64),
+    'large': (512, 512, 128),
+}
+SYNTHETIC_SPACING = (0.8, 0.8, 3.0)
+# Доля объема, занятая эллипсоидом маски
+ROI_FRACTIONS = (0.01, 0.1)
+# Варианты binCount для среднего объема
+BIN_COUNTS = (16, 64)
+# Порог регрессии: относительный рост и минимальный абсолютный рост
+TIME_THRESHOLD = 0.2
+MIN_TIME_DELTA = 0.005
+MEMORY_THRESHOLD = 0.2
+MIN_MEMORY_DELTA = 16 * 2 ** 20
+# Минимальный абсолютный рост времени холодного импорта в миллисекундах
+MIN_IMPORT_DELTA = 50
+
+
+def make_synthetic_case(directory: str, size: tuple, roi_fraction: float, seed=0) -> tuple:
+    """
+    Создание синтетического изображения NIfTI с текстурой и эллипсоидной маской
+
+    Параметры:
+    - directory (str): Папка для файлов
+    - size (tuple): Размер изображения (x, y, z)
+    - roi_fraction (float): Доля объема, занятая маской
+    - seed (int): Начальное значение генератора случайных чисел
+
+    Возвращает:
+    - image_path (str): Путь к изображению
+    - mask_path (str): Путь к маске
+    """
+    rng = np.random.default_rng(seed)
+    shape = size[::-1]
+    grid = np.stack(np.meshgrid(*(np.linspace(-1, 1, n, dtype=np.float32) for n in shape), indexing='ij'))
+    # Гладкий фон с шумом и более яркое образование
+    array = 400 + 100 * np.sin(4 * grid).sum(axis=0) + rng.normal(0, 30, shape).astype(np.float32)
+    radius = (roi_fraction * 3 / (4 * np.pi)) ** (1 / 3) * 2
+    roi = (grid ** 2).sum(axis=0) <= radius ** 2
+    array[roi] += 200 + rng.normal(0, 60, int(roi.sum()))
+
+    name = f'{"x".join(map(str, size))}_{roi_fraction}_{seed}'
+    paths = (os.path.join(directory, f'image_{name}.nii.gz'), os.path.join(directory, f'mask_{name}.nii.gz'))
+    for values, path in ((np.clip(array, 0, None).astype(np.float32), paths[0]), (roi.astype(np.uint8), paths[1])):
+        volume = sitk.GetImageFromArray(values)
+        volume.SetSpacing(SYNTHETIC_SPACING)
+        sitk.WriteImage(volume, path)
+    return paths
+
+
+class Benchmark:
+    """
+    Класс Benchmark предназначен для замера времени и пиковой памяти отдельных этапов обработки случая:
+    чтение, нормализация, ресэмплирование, извлечение признаков по классам, предсказание и превью
+
+    Атрибуты:
+    - repeats (int): Количество повторов каждого этапа, берется лучшее время и наибольшая память
+    - preprocessor (Preprocessor): Предобработчик
+    - predictor (Predictor): Классификатор модели
+
+    Методы:
+    - __init__(self, model=MODEL, mri_modality='T2', repeats=3): Инициализация класса Benchmark
+    - measure(self, function) -> tuple: Замер одного этапа
+    - run_case(self, image_path, mask_path, bin_count=None) -> dict: Замер всех этапов для случая
+    """
+
+    def __init__(self, model=MODEL, mri_modality='T2', repeats=3):
+        """
+        Инициализация класса Benchmark
+
+        Параметры:
+        - model (str): Название модели
+        - mri_modality (str): Модальность МРТ
+        - repeats (int): Количество повторов каждого этапа
+        """
+        logging.info('Benchmark: Initializing Benchmark class')
+        self.model = model
+        self.repeats = repeats
+        self.preprocessor = Preprocessor(mri_modality)
+        self.predictor = Predictor(model)
+
+    def measure(self, function) -> tuple:
+        """
+        Замер одного этапа
+
+        Параметры:
+        - function (callable): Функция без аргументов
+
+        Возвращает:
+        - result: Результат последнего вызова
+        - stats (dict): Лучшее время в секундах и наибольший прирост пиковой памяти в байтах
+        """
+        times, peaks = [], []
+        for _ in range(self.repeats):
+            with track_peak_rss() as peak:
+                start = time.perf_counter()
+                result = function()
+                times.append(time.perf_counter() - start)
+            peaks.append(peak['peak_rss'])
+        return result, {'time': min(times), 'peak_rss': max(peaks)}
+
+    def run_case(self, image_path: str, mask_path: str, bin_count=None) -> dict:
+        """
+        Замер всех этапов для одного случая
+
+        Параметры:
+        - image_path (str): Путь к изображению
+        - mask_path (str): Путь к маске
+        - bin_count (int): Значение binCount вместо указанного в параметрах модели
+
+        Возвращает:
+        - result (dict): Размеры случая и статистики этапов {этап: {'time', 'peak_rss'}}
+        """
+        feature_extractor = FeatureExtractor(self.model)
+        if bin_count is not None:
+            feature_extractor.extractor.settings['binCount'] = bin_count
+        stages = {}
+
+        (image, mask), stages['read'] = self.measure(lambda: (sitk.ReadImage(image_path), sitk.ReadImage(mask_path)))
+        with tempfile.TemporaryDirectory() as directory:
+            # Повторное чтение через хранилище распакованных томов, первое чтение заполняет хранилище
+            store = VolumeStore(directory)
+            read_stored = lambda: [store.read(store.file_key(path), lambda: sitk.ReadImage(path))
+                                   for path in (image_path, mask_path)]
+            read_stored()
+            _, stages['read_stored'] = self.measure(read_stored)
+        normalized, stages['normalize'] = self.measure(lambda: self.preprocessor.intensity_normalize(image))
+        grid = self.preprocessor.resampling_grid(normalized)
+        _, stages['resample'] = self.measure(lambda: (
+            self.preprocessor.resample_to_grid(normalized, grid, sitk.sitkBSpline),
+            self.preprocessor.resample_to_grid(mask, grid, sitk.sitkNearestNeighbor)
+        ))
+        features, stages['extract'] = self.measure(lambda: feature_extractor.extract_features(normalized, mask))
+
+        # Классы признаков по отдельности на один раз подготовленном изображении
+        parallel_extractor = ParallelFeatureExtractor(feature_extractor.extractor, workers=1)
+        (_, inputs), stages['extract_prepare'] = self.measure(lambda: parallel_extractor.prepare(normalized, mask))
+        for input_image, input_mask, image_type, settings in inputs:
+            for feature_class, names in feature_extractor.extractor.enabledFeatures.items():
+                if not feature_class.startswith('shape'):
+                    _, stages[f'extract_{feature_class}'] = self.measure(
+                        lambda: compute_feature_class(feature_class, names, input_image, input_mask, image_type,
+                                                      settings)
+                    )
+
+        _, stages['predict'] = self.measure(lambda: self.predictor.predict(features | CLINICAL_DATA))
+        _, stages['preview'] = self.measure(lambda: ImageViewer(normalized, mask).show())
+        for mode in ('triplanar', 'strip'):
+            _, stages[f'preview_{mode}'] = self.measure(lambda: ImageViewer(normalized, mask).show(mode=mode))
+
+        return {
+            'size': list(image.GetSize()),
+            'roi_voxels': int(np.count_nonzero(sitk.GetArrayViewFromImage(mask))),
+            'bin_count': feature_extractor.extractor.settings.get('binCount'),
+            'stages': stages
+        }
+
+
+def compare(results: dict, baseline: dict, time_threshold=TIME_THRESHOLD,
+            memory_threshold=MEMORY_THRESHOLD) -> list:
+    """
+    Сравнение результатов с сохраненным эталоном
+
+    Параметры:
+    - results (dict): Текущие результаты
+    - baseline (dict): Эталонные результаты
+    - time_threshold (float): Допустимый относительный рост времени
+    - memory_threshold (float): Допустимый относительный рост пиковой памяти
+
+    Возвращает:
+    - regressions (list): Регрессии (случай, этап, метрика, эталон, текущее значение)
+    """
+    regressions = []
+    # Время холодного импорта точек входа сравнивается как отдельный случай
+    for module, old in baseline.get('imports', {}).items():
+        new = results.get('imports', {}).get(module)
+        if new is not None and new > old * (1 + time_threshold) and new - old > MIN_IMPORT_DELTA:
+            regressions.append(('imports', module, 'import_ms', old, new))
+    for case, result in results['cases'].items():
+        base_stages = baseline['cases'].get(case, {}).get('stages', {})
+        for stage, stats in result['stages'].items():
+            if stage not in base_stages:
+                continue
+            for metric, threshold, min_delta in (('time', time_threshold, MIN_TIME_DELTA),
+                                                 ('peak_rss', memory_threshold, MIN_MEMORY_DELTA)):
+                old, new = base_stages[stage][metric], stats[metric]
+                if new > old * (1 + threshold) and new - old > min_delta:
+                    regressions.append((case, stage, metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage-level benchmark on test data and synthetic volumes')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='Stored results to compare against; exits with 1 on regressions')
+    parser.add_argument('--sizes', nargs='*', default=['small', 'medium'], choices=list(SYNTHETIC_SIZES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-synthetic', action='store_true', help='Benchmark only the test case')
+    parser.add_argument('--time-threshold', type=float, default=TIME_THRESHOLD)
+    parser.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+    args = parser.parse_args()
+
+    benchmark = Benchmark(repeats=args.repeats)
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeats': args.repeats
+        },
+        'imports': import_report(ENTRY_MODULES),
+        'cases': {}
+    }
+    results['cases'][os.path.basename(TEST_CASE)] = benchmark.run_case(
+        os.path.join(TEST_CASE, 'image.nii.gz'), os.path.join(TEST_CASE, 'segmentation.nii.gz')
+    )
+    if not args.no_synthetic:
+        with tempfile.TemporaryDirectory() as directory:
+            for size_name in args.sizes:
+                for roi_fraction in ROI_FRACTIONS:
+                    paths = make_synthetic_case(directory, SYNTHETIC_SIZES[size_name], roi_fraction)
+                    case = f'synthetic_{size_name}_roi{roi_fraction}'
+                    logging.info(f'Benchmark: Running {case}')
+                    results['cases'][case] = benchmark.run_case(*paths)
+                    if size_name == 'medium' and roi_fraction == ROI_FRACTIONS[-1]:
+                        for bin_count in BIN_COUNTS:
+                            results['cases'][f'{case}_bin{bin_count}'] = benchmark.run_case(*paths, bin_count)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('imports', ' '.join(f'{module}={milliseconds:.0f}ms' for module, milliseconds in results['imports'].items()))
+    for case, result in results['cases'].items():
+        print(case, ' '.join(f'{stage}={stats["time"] * 1000:.1f}ms/{stats["peak_rss"] / 2 ** 20:.0f}MiB'
+                             for stage, stats in result['stages'].items()))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_threshold, args.memory_threshold)
+        for case, stage, metric, old, new in regressions:
+            print(f'REGRESSION {case} {stage} {metric}: {old:.4g} -> {new:.4g}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against baseline')
+
+
+if __name__ == "__main__":
+    logging.info("Benchmark: Benchmark started")
+    main()
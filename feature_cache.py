@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from lazy_importing import lazy_import
+from tracing import annotate
+
+np = lazy_import('numpy')
+
+CACHE_PATH = 'cache/features.sqlite'
+# Кэш признаков загруженных файлов пишется на диск только при заданной переменной окружения с путем,
+# например RADIOMICS_FEATURE_CACHE=cache/features.sqlite; иначе записи хранятся в памяти процесса
+FEATURE_CACHE_ENV = 'RADIOMICS_FEATURE_CACHE'
+CACHE_MAX_SIZE = 256 * 2 ** 20
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def content_digest(source) -> str:
+    """
+    Хэш содержимого файла или буфера в памяти
+
+    Параметры:
+    - source (str | bytes-like): Путь к файлу или содержимое файла
+
+    Возвращает:
+    - digest (str): Шестнадцатеричный хэш BLAKE2b
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Класс FeatureCache предназначен для хранения извлеченных признаков на диске или в памяти процесса.
+    Ключ строится по содержимому изображения, маски, файла параметров и флагам предобработки.
+    Хранилище - SQLite, безопасное для одновременного доступа из нескольких процессов,
+    с LRU-вытеснением при превышении заданного размера. Без пути база SQLite создается в памяти
+    и доступна только текущему процессу
+
+    Атрибуты:
+    - path (str | None): Путь к файлу кэша, None - кэш в памяти
+    - max_size (int): Максимальный суммарный размер записей в байтах
+    - hits (int): Количество попаданий в кэш в текущем процессе
+    - misses (int): Количество промахов кэша в текущем процессе
+
+    Методы:
+    - __init__(self, path=CACHE_PATH, max_size=CACHE_MAX_SIZE): Инициализация класса FeatureCache
+    - make_key(image, mask, params_path, **flags): Построение ключа кэша
+    - get(self, key): Получение признаков из кэша
+    - put(self, key, features): Сохранение признаков в кэш
+    - get_or_compute(self, key, compute): Получение признаков из кэша или их вычисление
+    - stats(self): Счетчики попаданий и промахов, размер кэша
+    """
+
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_MAX_SIZE):
+        """
+        Инициализация класса FeatureCache
+
+        Параметры:
+        - path (str | None): Путь к файлу кэша, None - кэш в памяти процесса
+        - max_size (int): Максимальный суммарный размер записей в байтах
+        """
+        logging.info('FeatureCache: Initializing FeatureCache class')
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # База в памяти существует, пока открыто соединение, поэтому оно одно на объект и защищено блокировкой
+        self._memory = None if path is not None else sqlite3.connect(':memory:', check_same_thread=False,
+                                                                     isolation_level='IMMEDIATE')
+        self._memory_lock = threading.Lock()
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS features ('
+                               'key TEXT PRIMARY KEY, names TEXT, vals BLOB, size INTEGER, last_access REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            connection.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+
+    @contextmanager
+    def _connect(self):
+        if self._memory is not None:
+            with self._memory_lock, self._memory:
+                yield self._memory
+            return
+        # Отдельное соединение на каждую операцию: безопасно для потоков и процессов после fork
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level='IMMEDIATE')
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def make_key(image, mask, params_path: str, **flags) -> str:
+        """
+        Построение ключа кэша по содержимому файлов и флагам предобработки
+
+        Параметры:
+        - image (str | bytes-like): Путь к изображению или содержимое файла изображения
+        - mask (str | bytes-like): Путь к маске или содержимое файла маски
+        - params_path (str): Путь к файлу параметров извлечения признаков
+        - flags: Флаги предобработки (normalize, resample, modality и т.д.)
+
+        Возвращает:
+        - key (str): Ключ кэша
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for source in (image, mask, params_path):
+            digest.update(content_digest(source).encode())
+        digest.update(json.dumps(flags, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Получение признаков из кэша
+
+        Параметры:
+        - key (str): Ключ кэша
+
+        Возвращает:
+        - features (dict | None): Признаки или None, если записи нет
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT names, vals FROM features WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'misses'")
+                annotate(cache_hit=False)
+                return None
+            self.hits += 1
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'hits'")
+            connection.execute('UPDATE features SET last_access = ? WHERE key = ?', (time.time(), key))
+        logging.info('FeatureCache: Cache hit')
+        annotate(cache_hit=True)
+        return dict(zip(json.loads(row[0]), np.frombuffer(row[1], dtype=np.float64).tolist()))
+
+    def put(self, key: str, features: dict) -> None:
+        """
+        Сохранение признаков в кэш с вытеснением давно не использованных записей
+
+        Параметры:
+        - key (str): Ключ кэша
+        - features (dict): Признаки
+        """
+        names = json.dumps(list(features))
+        values = np.array([float(value) for value in features.values()], dtype=np.float64).tobytes()
+        size = len(names) + len(values)
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)',
+                               (key, names, values, size, time.time()))
+            total = connection.execute('SELECT SUM(size) FROM features').fetchone()[0]
+            if total > self.max_size:
+                evicted = []
+                for old_key, old_size in connection.execute('SELECT key, size FROM features ORDER BY last_access'):
+                    if total <= self.max_size:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                connection.executemany('DELETE FROM features WHERE key = ?', evicted)
+                logging.info(f'FeatureCache: Evicted {len(evicted)} entries')
+
+    def get_or_compute(self, key: str, compute) -> dict:
+        """
+        Получение признаков из кэша или их вычисление и сохранение
+
+        Параметры:
+        - key (str): Ключ кэша
+        - compute (callable): Функция без аргументов, возвращающая признаки
+
+        Возвращает:
+        - features (dict): Признаки
+        """
+        features = self.get(key)
+        if features is None:
+            features = compute()
+            self.put(key, features)
+        return features
+
+    def stats(self) -> dict:
+        """
+        Счетчики попаданий и промахов, количество и размер записей
+
+        Возвращает:
+        - stats (dict): Счетчики текущего процесса, общие счетчики всех процессов и размер кэша
+        """
+        with self._connect() as connection:
+            counters = dict(connection.execute('SELECT name, value FROM counters'))
+            entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM features').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': counters['hits'],
+            'total_misses': counters['misses'],
+            'entries': entries,
+            'size': size
+        }
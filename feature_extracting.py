@@ -1,7 +1,17 @@
+from __future__ import annotations
 import logging
 import json
-import SimpleITK as sitk
-from radiomics import featureextractor
+from lazy_importing import lazy_import
+from parallel_feature_extracting import ParallelFeatureExtractor
+from tracing import annotate, traced, tracer
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+featureextractor = lazy_import('radiomics.featureextractor')
+# Векторизованная реализация загружается только при выборе backend='numpy'
+numpy_feature_extracting = lazy_import('numpy_feature_extracting')
+
+BACKENDS = ('pyradiomics', 'numpy')
 
 
 class FeatureExtractor:
@@ -11,29 +21,49 @@ class FeatureExtractor:
     Атрибуты:
     - model: Название модели, используемой для извлечения признаков
     - desired_order_bool: Флаг, указывающий, нужно ли использовать желаемый порядок признаков
+    - backend: Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+    - workers: Количество процессов для параллельного вычисления классов признаков одного случая
 
     Методы:
-    - __init__(self, model, desired_order_bool=False): Инициализация класса FeatureExtractor
+    - __init__(self, model, desired_order_bool=False, backend='pyradiomics', workers=1): Инициализация класса
+      FeatureExtractor
     - extract_features(self, image, mask): Извлечение признаков из изображения и маски
+    - extract_bin_counts(self, image, mask, bin_counts) -> list: Признаки для нескольких чисел интервалов
     """
 
-    def __init__(self, model, desired_order_bool=False):
+    def __init__(self, model, desired_order_bool=False, backend='pyradiomics', workers=1):
         """
         Инициализация класса FeatureExtractor
 
         Параметры:
         - model (str): Название модели, используемой для извлечения признаков
         - desired_order_bool (bool): Флаг, указывающий, нужно ли использовать желаемый порядок признаков
+        - backend (str): Реализация извлечения признаков: 'pyradiomics' или 'numpy' (векторизованные вычисления
+          включенных признаков с переходом на pyradiomics для нереализованных)
+        - workers (int): Количество процессов для параллельного вычисления классов признаков pyradiomics,
+          1 - последовательно, None - по числу классов признаков, но не больше числа ядер
         """
         logging.info('Initializing FeatureExtractor class')
         self.model = model
         self.desired_order_bool = desired_order_bool
+        if backend not in BACKENDS:
+            logging.error('Extractor: Unknown backend')
+            raise ValueError(f'Extractor: Unknown backend, choose one of {BACKENDS}')
+        self.backend = backend
+        self.workers = workers
+        self._bin_count_engines = {}
         if isinstance(model, str):
             logging.info('Extractor: Initializing extractor with params')
             try:
                 self.params = f'params/{model}_extracting_params.yaml'
                 self.extractor = featureextractor.RadiomicsFeatureExtractor(self.params)
                 self.features = self.extractor.enabledFeatures
+                self.engine = numpy_feature_extracting.NumpyFeatureExtractor(self.extractor) if backend == 'numpy' else self.extractor
+                # Реализация на NumPy строит все матрицы за один проход, параллельный режим нужен только pyradiomics
+                if backend == 'pyradiomics' and workers != 1:
+                    parallel_extractor = ParallelFeatureExtractor(self.extractor, workers)
+                    if parallel_extractor.workers > 1:
+                        self.engine = parallel_extractor
                 if self.desired_order_bool:
                     logging.info('Extractor: Initializing desired_order')
                     self.desired_order = json.load(open(f'params/{model}_features.json'))
@@ -46,6 +76,7 @@ class FeatureExtractor:
             logging.error('Extractor: Model not initialized')
             raise ValueError('Extractor: Model not initialized')
 
+    @traced('extract')
     def extract_features(self, image: sitk.Image, mask: sitk.Image) -> dict:
         """
         Извлечение признаков из изображения и маски
@@ -58,8 +89,44 @@ class FeatureExtractor:
         - model_features (dict): Словарь с извлеченными признаками
         """
         logging.info('Extractor: Extracting features')
-        extracted_features = self.extractor.execute(image, mask)
+        if tracer.enabled:
+            annotate(voxels=image.GetNumberOfPixels(), backend=self.backend,
+                     roi_voxels=int(np.count_nonzero(sitk.GetArrayViewFromImage(mask))))
+        return self._select(self.engine.execute(image, mask))
+
+    @traced('extract')
+    def extract_bin_counts(self, image: sitk.Image, mask: sitk.Image, bin_counts) -> list:
+        """
+        Извлечение признаков для нескольких чисел интервалов дискретизации (binCount) одной маски.
+        Реализация на NumPy обрезает маску и находит соседей вокселей один раз для всех чисел,
+        pyradiomics вычисляет каждое число отдельно
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - mask (sitk.Image): Входная маска
+        - bin_counts (list): Числа интервалов, None - значение из файла параметров
+
+        Возвращает:
+        - model_features (list): Словари признаков в порядке bin_counts
+        """
+        logging.info(f'Extractor: Extracting features for bin counts {list(bin_counts)}')
+        annotate(bin_counts=len(bin_counts))
+        if self.backend == 'numpy':
+            results = self.engine.execute_bin_counts(image, mask, list(bin_counts))
+        else:
+            results = [self._bin_count_engine(bin_count).execute(image, mask) for bin_count in bin_counts]
+        return [self._select(extracted_features) for extracted_features in results]
+
+    def _bin_count_engine(self, bin_count):
+        # Экстрактор pyradiomics с другим числом интервалов создается один раз на число
+        if bin_count is None or bin_count == self.extractor.settings.get('binCount'):
+            return self.engine
+        if bin_count not in self._bin_count_engines:
+            self._bin_count_engines[bin_count] = featureextractor.RadiomicsFeatureExtractor(self.params,
+                                                                                           binCount=bin_count)
+        return self._bin_count_engines[bin_count]
 
+    def _select(self, extracted_features: dict) -> dict:
         if self.desired_order:
             logging.info('Extractor: Saving extracted features in desired_order in dictionary')
             model_features = {key: extracted_features[key] for key in self.desired_order if key in extracted_features}
@@ -0,0 +1,129 @@
+from __future__ import annotations
+import logging
+import os
+import tempfile
+from lazy_importing import lazy_import
+from volume_store import volume_store
+
+sitk = lazy_import('SimpleITK')
+
+SUPPORTED_SUFFIXES = ('.nii.gz', '.nii', '.nrrd')
+GZIP_MAGIC = b'\x1f\x8b'
+NRRD_MAGIC = b'NRRD'
+# tmpfs: файл существует только в памяти и удаляется сразу после чтения; None - tmpfs недоступен,
+# временный файл создается на диске
+MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def image_suffix(buffer, file_name=None) -> str:
+    """
+    Определение формата изображения по имени файла или по сигнатуре содержимого
+
+    Параметры:
+    - buffer (bytes-like): Содержимое файла
+    - file_name (str): Имя загруженного файла
+
+    Возвращает:
+    - suffix (str): Расширение файла, по которому SimpleITK выбирает формат
+    """
+    if file_name:
+        for suffix in SUPPORTED_SUFFIXES:
+            if file_name.lower().endswith(suffix):
+                return suffix
+    header = bytes(buffer[:4])
+    if header.startswith(GZIP_MAGIC):
+        return '.nii.gz'
+    if header.startswith(NRRD_MAGIC):
+        return '.nrrd'
+    return '.nii'
+
+
+def read_image_buffer(buffer, file_name=None) -> sitk.Image:
+    """
+    Чтение изображения NIfTI/NRRD (в том числе сжатого gzip) из буфера в памяти.
+    Буфер записывается во временный файл с уникальным именем в памяти (tmpfs /dev/shm), который удаляется
+    сразу после чтения, поэтому одновременные загрузки с одинаковыми именами не пересекаются. Если tmpfs
+    недоступен (например, macOS или Windows), файл создается во временном каталоге на диске, также удаляется
+    сразу после чтения, и в журнал пишется предупреждение. В хранилище распакованных томов загрузки не попадают
+
+    Параметры:
+    - buffer (bytes-like): Содержимое файла
+    - file_name (str): Имя загруженного файла, используется для определения формата
+
+    Возвращает:
+    - image (sitk.Image): Прочитанное изображение
+    """
+    logging.info('ImageLoading: Reading image from buffer')
+    if not len(buffer):
+        logging.error('ImageLoading: Empty image buffer')
+        raise ValueError('ImageLoading: Empty image buffer')
+    if MEMORY_DIR is None:
+        logging.warning('ImageLoading: No in-memory directory, uploaded image is briefly written to '
+                        f'{tempfile.gettempdir()}')
+    fd, path = tempfile.mkstemp(suffix=image_suffix(buffer, file_name), dir=MEMORY_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buffer)
+        return sitk.ReadImage(path)
+    except RuntimeError:
+        logging.error('ImageLoading: Error reading image buffer')
+        raise ValueError('ImageLoading: Error reading image buffer')
+    finally:
+        os.remove(path)
+
+
+def read_uploaded_file(uploaded_file) -> sitk.Image:
+    """
+    Чтение загруженного в Streamlit файла через временный файл read_image_buffer, без постоянного сохранения
+
+    Параметры:
+    - uploaded_file: Загруженный файл
+
+    Возвращает:
+    - image (sitk.Image): Прочитанное изображение
+    """
+    return read_image_buffer(uploaded_file.getbuffer(), uploaded_file.name)
+
+
+def _is_stored(path) -> bool:
+    return volume_store.enabled and isinstance(path, str) and path.lower().endswith(SUPPORTED_SUFFIXES)
+
+
+def read_image(path: str, index=None, size=None) -> sitk.Image:
+    """
+    Чтение изображения или его области из файла через хранилище распакованных томов:
+    сжатый файл распаковывается один раз, повторные чтения и чтения области затрагивают только нужные страницы
+
+    Параметры:
+    - path (str): Путь к файлу изображения
+    - index (list): Начальный индекс области (x, y, z), None - все изображение
+    - size (list): Размер области (x, y, z)
+
+    Возвращает:
+    - image (sitk.Image): Изображение или его область
+    """
+    if _is_stored(path):
+        return volume_store.read(volume_store.file_key(path), lambda: sitk.ReadImage(path), index, size)
+    if index is None:
+        return sitk.ReadImage(path)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.SetExtractIndex([int(i) for i in index])
+    reader.SetExtractSize([int(n) for n in size])
+    return reader.Execute()
+
+
+def open_image(path: str):
+    """
+    Открытие изображения без чтения вокселей: том из хранилища отображается в память,
+    срезы и области читают с диска только свои страницы
+
+    Параметры:
+    - path (str): Путь к файлу изображения
+
+    Возвращает:
+    - image (StoredVolume | sitk.Image): Том из хранилища или прочитанное изображение, если хранилище отключено
+    """
+    if _is_stored(path):
+        return volume_store.open(volume_store.file_key(path), lambda: sitk.ReadImage(path))
+    return sitk.ReadImage(path)
@@ -1,62 +1,342 @@
+from __future__ import annotations
+import io
 import logging
-import SimpleITK as sitk
-from scipy.ndimage import center_of_mass
-from PIL import Image
-import numpy as np
+import threading
+from collections import OrderedDict
+from image_loading import open_image, read_image
+from lazy_importing import lazy_import
+from tracing import annotate, traced
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+Image = lazy_import('PIL.Image')
+
+# Плоскости срезов: ось, вдоль которой берется срез (x, y, z)
+VIEWS = {'axial': 2, 'coronal': 1, 'sagittal': 0}
+# Режимы превью: один срез в плоскости, три плоскости через центр маски или полоса срезов через образование
+PREVIEW_MODES = tuple(VIEWS) + ('triplanar', 'strip')
+OVERLAY_COLOR = (255, 0, 0)
+OVERLAY_ALPHA = 26  # 10% opacity (255 * 0.1 = 26)
+# Количество срезов в полосе и отступ вокруг области маски в вокселях
+STRIP_SLICES = 5
+ROI_MARGIN = 16
+STRIP_GAP = 2
+# Объем кэша превью процесса в байтах
+PREVIEW_CACHE_SIZE = 64 * 2 ** 20
+
+
+class PreviewCache:
+    """
+    Класс PreviewCache - кэш готовых превью в памяти процесса с вытеснением давно не использованных записей
+
+    Атрибуты:
+    - max_size (int): Максимальный суммарный размер превью в байтах
+    - hits (int): Количество попаданий
+    - misses (int): Количество промахов
+
+    Методы:
+    - __init__(self, max_size=PREVIEW_CACHE_SIZE): Инициализация класса PreviewCache
+    - get(self, key) -> bytes | None: Получение превью
+    - put(self, key, preview): Сохранение превью
+    """
+
+    def __init__(self, max_size=PREVIEW_CACHE_SIZE):
+        """
+        Инициализация класса PreviewCache
+
+        Параметры:
+        - max_size (int): Максимальный суммарный размер превью в байтах
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Получение превью
+
+        Параметры:
+        - key (hashable): Ключ случая и режима превью
+
+        Возвращает:
+        - preview (bytes | None): Превью или None, если записи нет
+        """
+        with self._lock:
+            preview = self._entries.get(key)
+            if preview is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        annotate(preview_cache_hit=preview is not None)
+        return preview
+
+    def put(self, key, preview: bytes) -> None:
+        """
+        Сохранение превью
+
+        Параметры:
+        - key (hashable): Ключ случая и режима превью
+        - preview (bytes): Превью
+        """
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = preview
+            self._size += len(preview)
+            while self._size > self.max_size and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+# Общий кэш превью процесса
+preview_cache = PreviewCache()
 
 
 class ImageViewer:
     """
-    Класс ImageViewer предназначен для отображения медицинских изображений и масок
+    Класс ImageViewer предназначен для отображения медицинских изображений и масок.
+    Объемы не копируются: нужные срезы (или только область маски) извлекаются срезами SimpleITK,
+    положение и границы образования находятся по проекциям маски
 
     Атрибуты:
-    - image (sitk.Image): Медицинское изображение в форме sitk.Image
+    - image (sitk.Image | StoredVolume): Медицинское изображение в форме sitk.Image или том из хранилища
     - mask (sitk.Image): Медицинская маска в форме sitk.Image
+    - label (int | None): Метка образования в маске, None - все образования
+    - bounding_box (tuple | None): Границы маски (начало x, y, z, размер x, y, z), None - метки нет в маске
+    - center (tuple): Индекс центра масс маски (x, y, z), центр изображения, если метки нет
 
     Методы:
-    - __init__(self, image: sitk.Image, mask: sitk.Image): Инициализация класса ImageViewer
-    - show(self): Сохранение среднего среза маски и медицинского изображения в JPEG
+    - __init__(self, image, mask, label=1): Инициализация класса ImageViewer
+    - locate(mask, label=1) -> tuple: Границы и центр масс метки
+    - slice(self, view, index=None, crop=False) -> tuple: Срез изображения и маски в плоскости
+    - blend(image_slices, mask_slices, label=1) -> list: Наложение маски на срезы
+    - render(self, view='axial', crop=False, image_format='JPEG') -> bytes: Срез через центр маски
+    - triplanar(self, crop=False, image_format='JPEG') -> bytes: Три плоскости через центр маски
+    - strip(self, view='axial', count=STRIP_SLICES, image_format='JPEG') -> bytes: Полоса срезов через образование
+    - show(self, save_path=None, mode='axial') -> bytes: Превью в выбранном режиме в JPEG
     """
-    def __init__(self, image: sitk.Image,  mask: sitk.Image):
+    def __init__(self, image,  mask, label=1):
         """
         Инициализация класса ImageViewer
 
         Параметры:
-        - image (sitk.Image): Медицинское изображение в форме sitk.Image
-        - mask (sitk.Image): Медицинская маска в форме sitk.Image
+        - image (sitk.Image | str): Медицинское изображение в форме sitk.Image или путь к файлу; файл
+          открывается через хранилище распакованных томов, и для превью читаются только страницы срезов
+        - mask (sitk.Image | str): Медицинская маска в форме sitk.Image или путь к файлу
+        - label (int | None): Метка образования в маске, None - все образования (ненулевые метки)
         """
         logging.info('ImageViewer: Loading image and mask')
-        self.image = sitk.GetArrayFromImage(image)
-        self.mask = sitk.GetArrayFromImage(mask)
+        self.image = open_image(image) if isinstance(image, str) else image
+        self.mask = read_image(mask) if isinstance(mask, str) else mask
+        self.label = label
+
+        self.bounding_box, self.center = self.locate(self.mask, label)
+
+    @staticmethod
+    def locate(mask: sitk.Image, label=1) -> tuple:
+        """
+        Границы и центр масс метки без копирования маски: сначала быстрый проход по срезам находит
+        занятые срезы, затем проекции считаются только по ним
+
+        Параметры:
+        - mask (sitk.Image): Маска
+        - label (int | None): Метка образования, None - все ненулевые метки
+
+        Возвращает:
+        - bounding_box (tuple | None): Начало (x, y, z) и размер (x, y, z), None - метки нет в маске
+        - center (tuple): Индекс центра масс (x, y, z), центр изображения, если метки нет
+        """
+        array = sitk.GetArrayViewFromImage(mask)
+        occupied = np.flatnonzero(array.reshape(array.shape[0], -1).max(axis=1))
+        if occupied.size:
+            first = int(occupied[0])
+            slab = array[first:occupied[-1] + 1]
+            slab = slab != 0 if label is None else slab == label
+            # Проекции на оси z, y, x: количество вокселей метки в каждом срезе
+            profiles = [np.count_nonzero(slab, axis=axes) for axes in ((1, 2), (0, 2), (0, 1))]
+            total = int(profiles[0].sum())
+            if total:
+                start, size, center = [], [], []
+                for offset, profile in zip((first, 0, 0), profiles):
+                    nonzero = np.flatnonzero(profile)
+                    start.append(offset + int(nonzero[0]))
+                    size.append(int(nonzero[-1] - nonzero[0]) + 1)
+                    center.append(offset + int(round(float(profile @ np.arange(profile.size)) / total)))
+                # Массив хранится в порядке (z, y, x), результат - в порядке SimpleITK (x, y, z)
+                return (*start[::-1], *size[::-1]), tuple(center[::-1])
+        logging.warning('ImageViewer: Label not found in mask, showing the center of the image')
+        return None, tuple(size // 2 for size in mask.GetSize())
+
+    def _region(self, axis: int, crop: bool) -> list:
+        # Диапазоны по осям x, y, z: весь объем или область маски с отступом
+        size = self.image.GetSize()
+        if not crop or self.bounding_box is None:
+            return [slice(0, n) for n in size]
+        start, extent = self.bounding_box[:3], self.bounding_box[3:]
+        return [slice(max(start[i] - ROI_MARGIN, 0), min(start[i] + extent[i] + ROI_MARGIN, size[i]))
+                if i != axis else slice(0, size[i]) for i in range(3)]
+
+    def slice(self, view: str, index=None, crop=False) -> tuple:
+        """
+        Срез изображения и маски в плоскости: извлекается только сам срез (или его область маски)
+
+        Параметры:
+        - view (str): Плоскость: 'axial', 'coronal' или 'sagittal'
+        - index (int): Номер среза вдоль оси плоскости, по умолчанию через центр маски
+        - crop (bool): Флаг, указывающий, нужно ли обрезать срез по области маски с отступом
+
+        Возвращает:
+        - image_slice (np.ndarray): Срез изображения в порядке строк для отображения
+        - mask_slice (np.ndarray): Срез маски
+        - aspect (float): Отношение размера вокселя по строкам к размеру по столбцам
+        """
+        if view not in VIEWS:
+            logging.error('ImageViewer: Unknown view')
+            raise ValueError(f'ImageViewer: Unknown view, choose one of {tuple(VIEWS)}')
+        axis = VIEWS[view]
+        region = self._region(axis, crop)
+        region[axis] = self.center[axis] if index is None else index
+        # Копируется только двумерный срез; представление временного среза стало бы недействительным
+        image_slice = sitk.GetArrayFromImage(self.image[tuple(region)])
+        mask_slice = sitk.GetArrayFromImage(self.mask[tuple(region)])
+        # Аксиальный срез - строки y в обратном порядке, как в исходном просмотре;
+        # фронтальный и сагиттальный - строки z сверху вниз
+        spacing = self.image.GetSpacing()
+        row_axis, column_axis = {2: (1, 0), 1: (2, 0), 0: (2, 1)}[axis]
+        return image_slice[::-1], mask_slice[::-1], spacing[row_axis] / spacing[column_axis]
+
+    @staticmethod
+    def blend(image_slices: list, mask_slices: list, label=1) -> list:
+        """
+        Наложение маски на срезы: общее окно интенсивности и смешивание с цветом маски за один проход NumPy
+
+        Параметры:
+        - image_slices (list): Срезы изображения
+        - mask_slices (list): Срезы маски
+        - label (int | None): Метка образования, None - все ненулевые метки
+
+        Возвращает:
+        - rgb_slices (list): Срезы RGB uint8
+        """
+        low = min(float(np.min(image_slice)) for image_slice in image_slices)
+        high = max(float(np.max(image_slice)) for image_slice in image_slices)
+        scale = 255 / (high - low) if high > low else 0.0
+        color = np.array(OVERLAY_COLOR, dtype=np.float32) * (OVERLAY_ALPHA / 255)
+        rgb_slices = []
+        for image_slice, mask_slice in zip(image_slices, mask_slices):
+            gray = np.floor((image_slice.astype(np.float32) - low) * scale)
+            overlay = (mask_slice != 0 if label is None else mask_slice == label)[..., None]
+            weight = np.where(overlay, np.float32(1 - OVERLAY_ALPHA / 255), np.float32(1))
+            rgb_slices.append(np.rint(gray[..., None] * weight + overlay * color).astype(np.uint8))
+        return rgb_slices
+
+    @staticmethod
+    def _to_image(rgb: np.ndarray, aspect: float):
+        image = Image.fromarray(rgb)
+        # Анизотропные воксели: высота среза приводится к физическому размеру
+        if abs(aspect - 1) > 0.01:
+            image = image.resize((image.width, max(int(round(image.height * aspect)), 1)), Image.BILINEAR)
+        return image
+
+    @staticmethod
+    def _join(images: list):
+        height = max(image.height for image in images)
+        joined = Image.new('RGB', (sum(image.width for image in images) + STRIP_GAP * (len(images) - 1), height))
+        left = 0
+        for image in images:
+            joined.paste(image, (left, (height - image.height) // 2))
+            left += image.width + STRIP_GAP
+        return joined
+
+    @staticmethod
+    def _encode(image, image_format: str) -> bytes:
+        buffer = io.BytesIO()
+        image.save(buffer, image_format)
+        return buffer.getvalue()
 
-    def show(self) -> None:
+    def _render_slices(self, slices: list, image_format: str) -> bytes:
+        rgb_slices = self.blend([image_slice for image_slice, _, _ in slices],
+                                [mask_slice for _, mask_slice, _ in slices], self.label)
+        images = [self._to_image(rgb, aspect) for rgb, (_, _, aspect) in zip(rgb_slices, slices)]
+        return self._encode(images[0] if len(images) == 1 else self._join(images), image_format)
+
+    def render(self, view='axial', crop=False, image_format='JPEG') -> bytes:
         """
-        Сохранение среднего среза маски и медицинского изображения в JPEG
+        Срез через центр маски с наложением маски
+
+        Параметры:
+        - view (str): Плоскость: 'axial', 'coronal' или 'sagittal'
+        - crop (bool): Флаг, указывающий, нужно ли показывать только область маски с отступом
+        - image_format (str): Формат изображения PIL, например 'JPEG' или 'PNG'
+
+        Возвращает:
+        - preview (bytes): Изображение среза
         """
-        logging.info('ImageViewer: Finding center slice')
-        mask_z = int(round(center_of_mass(self.mask)[0]))
-        mri_slice = self.image[mask_z, ::-1, :]
-        mask_slice = self.mask[mask_z, ::-1, :]
+        return self._render_slices([self.slice(view, crop=crop)], image_format)
 
-        logging.info('ImageViewer: Normalizing the MRI slice to 0-255 and convert to uint8')
-        mri_slice_normalized = (mri_slice - np.min(mri_slice)) / (np.max(mri_slice) - np.min(mri_slice)) * 255
-        mri_slice_image = Image.fromarray(mri_slice_normalized.astype(np.uint8))
+    def triplanar(self, crop=False, image_format='JPEG') -> bytes:
+        """
+        Аксиальный, фронтальный и сагиттальный срезы через центр маски рядом
 
-        logging.info('ImageViewer: Creating a red mask')
-        red_mask = np.zeros((*mask_slice.shape, 3), dtype=np.uint8)
-        red_mask[mask_slice == 1] = [255, 0, 0]
+        Параметры:
+        - crop (bool): Флаг, указывающий, нужно ли показывать только область маски с отступом
+        - image_format (str): Формат изображения PIL
 
-        red_mask_image = Image.fromarray(red_mask)
+        Возвращает:
+        - preview (bytes): Изображение трех срезов
+        """
+        return self._render_slices([self.slice(view, crop=crop) for view in VIEWS], image_format)
 
-        alpha_mask = np.zeros(mask_slice.shape, dtype=np.uint8)
-        alpha_mask[mask_slice == 1] = 26  # 30% opacity (255 * 0.1 = 26)
+    def strip(self, view='axial', count=STRIP_SLICES, image_format='JPEG') -> bytes:
+        """
+        Полоса срезов, равномерно проходящих через образование, обрезанных по области маски с отступом
 
-        logging.info('ImageViewer: Creating an RGBA image for the red mask with the alpha channel')
-        red_mask_image.putalpha(Image.fromarray(alpha_mask))
+        Параметры:
+        - view (str): Плоскость: 'axial', 'coronal' или 'sagittal'
+        - count (int): Количество срезов
+        - image_format (str): Формат изображения PIL
+
+        Возвращает:
+        - preview (bytes): Изображение полосы срезов
+        """
+        indices = [None]
+        if self.bounding_box is not None and view in VIEWS:
+            axis = VIEWS[view]
+            first, extent = self.bounding_box[axis], self.bounding_box[axis + 3]
+            indices = sorted({int(round(index)) for index in np.linspace(first, first + extent - 1, count)})
+        return self._render_slices([self.slice(view, index, crop=True) for index in indices], image_format)
+
+    @traced('preview')
+    def show(self, save_path=None, mode='axial') -> bytes:
+        """
+        Превью маски и медицинского изображения в JPEG в памяти
+
+        Параметры:
+        - save_path (str): Путь для дополнительного сохранения JPEG на диск, None - не сохранять
+        - mode (str): Режим: 'axial', 'coronal', 'sagittal' (срез через центр маски), 'triplanar' или 'strip'
+
+        Возвращает:
+        - jpeg (bytes): Изображение в формате JPEG
+        """
+        if mode not in PREVIEW_MODES:
+            logging.error('ImageViewer: Unknown preview mode')
+            raise ValueError(f'ImageViewer: Unknown preview mode, choose one of {PREVIEW_MODES}')
+        logging.info(f'ImageViewer: Rendering {mode} preview')
+        annotate(voxels=self.image.GetNumberOfPixels(), mode=mode)
+        if mode == 'triplanar':
+            jpeg = self.triplanar()
+        elif mode == 'strip':
+            jpeg = self.strip()
+        else:
+            jpeg = self.render(mode)
 
-        combined_image = Image.new("RGBA", mri_slice_image.size)
-        combined_image.paste(mri_slice_image.convert("RGBA"), (0, 0))
-        combined_image.paste(red_mask_image, (0, 0), red_mask_image)
+        if save_path is not None:
+            logging.info('ImageViewer: Saving the final image as JPG')
+            with open(save_path, "wb") as f:
+                f.write(jpeg)
 
-        logging.info('ImageViewer: Saving the final image as JPG')
-        combined_image.convert("RGB").save("static/show_slice.jpg", "JPEG")
+        return jpeg
@@ -0,0 +1,368 @@
+import argparse
+import base64
+import email.message
+import email.parser
+import email.policy
+import json
+import logging
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from job_queue import JobQueue
+from memory_scheduling import memory_scheduler
+from tracing import tracer
+from volume_store import volume_store
+
+# Ограничение размера запроса: изображение и маска NIfTI с запасом
+MAX_REQUEST_SIZE = 512 * 2 ** 20
+# Максимальное время ожидания результата одним запросом в секундах
+REQUEST_TIMEOUT = 300
+# Максимальное количество одновременно открытых соединений (потоков-обработчиков)
+MAX_CONNECTIONS = 32
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\nContent-Length: 0\r\n'
+                 b'Connection: close\r\n\r\n')
+# Время бездействия соединения в секундах, после которого поток-обработчик освобождается
+IDLE_TIMEOUT = 30
+CLINICAL_FIELDS = ('age', 'sex', 'manufacturer')
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    """
+    Разбор тела multipart/form-data без копирования содержимого файлов
+
+    Параметры:
+    - content_type (str): Заголовок Content-Type с параметром boundary
+    - body (bytes): Тело запроса
+
+    Возвращает:
+    - parts (dict): {имя поля: (имя файла или None, содержимое memoryview поверх body)}
+    """
+    header = email.message.EmailMessage(policy=email.policy.HTTP)
+    header['Content-Type'] = content_type
+    boundary = header.get_boundary()
+    if header.get_content_maintype() != 'multipart' or not boundary:
+        logging.error('Service: Invalid multipart body')
+        raise ValueError('Service: Invalid multipart body')
+    delimiter = b'--' + boundary.encode('latin-1')
+    view = memoryview(body)
+    parts = {}
+    start = body.find(delimiter)
+    while start >= 0:
+        start += len(delimiter)
+        if body[start:start + 2] == b'--':
+            return parts
+        headers_end = body.find(b'\r\n\r\n', start)
+        stop = body.find(b'\r\n' + delimiter, headers_end)
+        if headers_end < 0 or stop < 0:
+            break
+        part = email.parser.BytesHeaderParser(policy=email.policy.HTTP).parsebytes(body[start:headers_end].lstrip())
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            content = view[headers_end + 4:stop]
+            if part.get('Content-Transfer-Encoding', '').lower() == 'base64':
+                content = base64.b64decode(content)
+            parts[name] = (part.get_filename(), content)
+        start = stop + 2
+    logging.error('Service: Invalid multipart body')
+    raise ValueError('Service: Invalid multipart body')
+
+
+def parse_clinical_data(raw: bytes) -> dict:
+    """
+    Разбор клинических данных из JSON
+
+    Параметры:
+    - raw (bytes-like): JSON вида {"age": 64, "sex": "M", "manufacturer": "Philips"}
+
+    Возвращает:
+    - clinical_data (dict): Клинические данные в формате модели
+    """
+    try:
+        data = json.loads(bytes(raw))
+        return {'age': int(data['age']), 'sex': str(data['sex']), 'manufacturer': str(data['manufacturer'])}
+    except (ValueError, TypeError, KeyError):
+        logging.error('Service: Invalid clinical data')
+        raise ValueError(f'Service: Invalid clinical data, expected JSON with {", ".join(CLINICAL_FIELDS)}')
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик HTTP-запросов сервиса предсказания
+
+    Маршруты:
+    - GET /health: Состояние сервиса и загрузка очереди
+    - GET /metrics: Гистограммы времени этапов и счетчики в текстовом формате Prometheus (при включенной трассировке),
+      счетчики хранилища распакованных томов и планировщика памяти
+    - POST /predict: multipart/form-data с полями image, mask (файлы) и clinical (JSON);
+      ответ - класс, вероятность и время этапов. Размер тела и свободное место в очереди проверяются до чтения,
+      в том числе по заголовку Expect: 100-continue
+    """
+
+    server_version = 'RadiomicsInference/1.0'
+    protocol_version = 'HTTP/1.1'
+    # Простаивающее keep-alive соединение не занимает поток-обработчик дольше IDLE_TIMEOUT
+    timeout = IDLE_TIMEOUT
+
+    def log_message(self, format, *args):
+        logging.info('Service: ' + format % args)
+
+    def _send_json(self, status: HTTPStatus, payload: dict, headers=None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_busy(self) -> None:
+        # Тело не читается, соединение закрывается
+        self.close_connection = True
+        self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Service: Too many requests, try again later'},
+                        {'Retry-After': '5', 'Connection': 'close'})
+
+    def _queue_full(self) -> bool:
+        load = self.server.job_queue.load()
+        return load['pending'] >= load['max_pending']
+
+    def handle_expect_100(self):
+        # Слишком большой запрос и запрос в заполненную очередь отклоняются до того, как клиент начнет передавать тело
+        length = self.headers.get('Content-Length')
+        if length is not None and length.isdigit() and int(length) > self.server.max_request_size:
+            self.close_connection = True
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            {'error': f'Request larger than {self.server.max_request_size} bytes'})
+            return False
+        if self.path == '/predict' and self._queue_full():
+            self._send_busy()
+            return False
+        return super().handle_expect_100()
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = (tracer.prometheus_text() + volume_store.prometheus_text()
+                    + memory_scheduler.prometheus_text()).encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != '/health':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        self._send_json(HTTPStatus.OK, {'status': 'ok', **self.server.job_queue.load()})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        received = time.perf_counter()
+
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self._send_json(HTTPStatus.LENGTH_REQUIRED, {'error': 'Content-Length required'})
+            return
+        if int(length) > self.server.max_request_size:
+            # Тело не читается, соединение закрывается
+            self.close_connection = True
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            {'error': f'Request larger than {self.server.max_request_size} bytes'})
+            return
+        # Место под запрос занимается до чтения тела: в памяти одновременно не больше max_pending тел запросов
+        uploads = self.server.uploads
+        if self._queue_full() or not uploads.acquire(blocking=False):
+            self._send_busy()
+            return
+        try:
+            self._predict(received, int(length))
+        finally:
+            uploads.release()
+
+    def _predict(self, received: float, length: int) -> None:
+        body = self.rfile.read(length)
+        try:
+            parts = parse_multipart(self.headers.get('Content-Type', ''), body)
+            missing = [name for name in ('image', 'mask', 'clinical') if name not in parts]
+            if missing:
+                raise ValueError(f'Service: Missing fields {", ".join(missing)}')
+            clinical_data = parse_clinical_data(parts['clinical'][1])
+        except ValueError as e:
+            self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+
+        (image_name, image_buffer), (mask_name, mask_buffer) = parts['image'], parts['mask']
+        job_queue = self.server.job_queue
+        try:
+            # Очередь копирует файлы из тела запроса один раз, после чего тело освобождается
+            job_id = job_queue.submit(image_buffer, image_name, mask_buffer, mask_name, clinical_data, show=False)
+        except ValueError as e:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(e)}, {'Retry-After': '5'})
+            return
+        finally:
+            del body, parts, image_buffer, mask_buffer
+        parsed = time.perf_counter()
+
+        status = job_queue.wait(job_id, timeout=self.server.request_timeout)
+        if status['state'] in ('queued', 'running'):
+            job_queue.cancel(job_id)
+            self._send_json(HTTPStatus.GATEWAY_TIMEOUT, {'error': 'Prediction timed out', 'job_id': job_id})
+            return
+        if status['state'] != 'done':
+            self._send_json(HTTPStatus.UNPROCESSABLE_ENTITY, {'error': status['error'], 'job_id': job_id})
+            return
+
+        result = status['result']
+        total = time.perf_counter() - received
+        timings = {'parse': parsed - received, **result['timings']}
+        # Ожидание в очереди и передача данных между процессами
+        timings['queue'] = max(total - sum(timings.values()), 0.0)
+        timings['total'] = total
+        self._send_json(HTTPStatus.OK, {
+            'job_id': job_id,
+            'class': result['prediction'],
+            'probability': result['probability'],
+            'timings': timings
+        })
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """
+    Многопоточный HTTP-сервер с ограничением количества одновременных соединений.
+    Соединение сверх лимита сразу получает 503 и закрывается, поток для него не создается
+
+    Атрибуты:
+    - connections (threading.BoundedSemaphore): Свободные места для потоков-обработчиков
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, request_handler_class, max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, request_handler_class)
+        self.connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(blocking=False):
+            logging.warning('Service: Too many connections')
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connections.release()
+
+
+class InferenceService:
+    """
+    Класс InferenceService предназначен для предсказаний по HTTP без интерфейса Streamlit.
+    Запросы принимаются многопоточным HTTP-сервером стандартной библиотеки, вычисления выполняются
+    в очереди задач с пулом заранее запущенных прогретых процессов
+
+    Атрибуты:
+    - job_queue (JobQueue): Очередь задач
+    - server (BoundedThreadingHTTPServer): HTTP-сервер
+
+    Методы:
+    - __init__(self, host='127.0.0.1', port=8000, workers=None, max_pending=None, max_request_size=MAX_REQUEST_SIZE,
+      request_timeout=REQUEST_TIMEOUT, max_connections=MAX_CONNECTIONS): Инициализация класса InferenceService
+    - start(self): Запуск сервера в фоновом потоке
+    - serve_forever(self): Запуск сервера в текущем потоке
+    - shutdown(self): Остановка сервера и очереди задач
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, workers=None, max_pending=None,
+                 max_request_size=MAX_REQUEST_SIZE, request_timeout=REQUEST_TIMEOUT, max_connections=MAX_CONNECTIONS):
+        """
+        Инициализация класса InferenceService
+
+        Параметры:
+        - host (str): Адрес сервера
+        - port (int): Порт сервера, 0 - любой свободный
+        - workers (int): Количество процессов-обработчиков
+        - max_pending (int): Максимальное количество одновременно принятых запросов предсказания
+        - max_request_size (int): Максимальный размер тела запроса в байтах
+        - request_timeout (float): Максимальное время ожидания результата в секундах
+        - max_connections (int): Максимальное количество одновременных соединений
+        """
+        logging.info('Service: Initializing InferenceService class')
+        self.job_queue = JobQueue(workers=workers, max_pending=max_pending)
+        self.job_queue.warm_up()
+        self.server = BoundedThreadingHTTPServer((host, port), InferenceRequestHandler, max_connections)
+        self.server.job_queue = self.job_queue
+        self.server.uploads = threading.BoundedSemaphore(self.job_queue.max_pending)
+        self.server.max_request_size = max_request_size
+        self.server.request_timeout = request_timeout
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> None:
+        """
+        Запуск сервера в фоновом потоке, например для локальной проверки
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, name='InferenceService', daemon=True)
+        self._thread.start()
+        logging.info(f'Service: Listening on {self.url}')
+
+    def serve_forever(self) -> None:
+        """
+        Запуск сервера в текущем потоке
+        """
+        logging.info(f'Service: Listening on {self.url}')
+        self.server.serve_forever()
+
+    def shutdown(self) -> None:
+        """
+        Остановка сервера и очереди задач
+        """
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+        self.server.server_close()
+        self.job_queue.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP inference service for lesion group prediction')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=None, help='Accepted requests before 503')
+    parser.add_argument('--max-request-size', type=int, default=MAX_REQUEST_SIZE, help='Request body limit in bytes')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help='Open connections before 503')
+    parser.add_argument('--trace', action='store_true', help='Record stage spans and serve them on /metrics')
+    parser.add_argument('--trace-file', default=None, help='Append finished spans to this JSON Lines file')
+    args = parser.parse_args()
+
+    if args.trace or args.trace_file:
+        tracer.enable(args.trace_file)
+
+    service = InferenceService(args.host, args.port, workers=args.workers, max_pending=args.max_pending,
+                               max_request_size=args.max_request_size, max_connections=args.max_connections)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    logging.info('Service: Inference service started')
+    main()
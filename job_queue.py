@@ -0,0 +1,458 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from feature_cache import FEATURE_CACHE_ENV, FeatureCache
+from image_loading import read_image_buffer
+from image_viewing import ImageViewer, preview_cache
+from memory_scheduling import memory_scheduler
+from model_registry import model_registry
+from parallel_feature_extracting import START_METHOD
+from preloading import Preloader, warm_up_model
+from preprocessing import PREPROCESSING_VERSION
+from robustness_analysis import RobustnessAnalyzer
+from tracing import traced, tracer
+
+MODEL = 'liver_t2w_xgboost'
+# Этапы обработки случая в порядке выполнения
+STAGES = ('queued', 'preprocess', 'extract', 'predict', 'robustness', 'preview', 'done')
+# Количество завершенных задач, статус которых хранится для опроса
+FINISHED_JOBS_LIMIT = 256
+# Реализация NumPy совпадает с pyradiomics (tests/test_numpy_feature_extracting.py) и извлекает признаки
+# всех чисел интервалов за один проход по маске, pyradiomics - отдельно для каждого числа
+ROBUSTNESS_BACKEND = 'numpy'
+
+# Кэш признаков процесса-обработчика
+_feature_cache = None
+
+
+def _get_feature_cache() -> FeatureCache:
+    """
+    Кэш признаков загруженных файлов: на диске только при заданной переменной окружения RADIOMICS_FEATURE_CACHE,
+    иначе в памяти процесса
+
+    Возвращает:
+    - feature_cache (FeatureCache): Кэш признаков процесса
+    """
+    global _feature_cache
+    if _feature_cache is None:
+        _feature_cache = FeatureCache(os.environ.get(FEATURE_CACHE_ENV) or None)
+    return _feature_cache
+
+
+def _init_worker(model: str, mri_modality: str, tracing=False, trace_file=None) -> None:
+    """
+    Инициализация процесса-обработчика: модель и предобработчик загружаются и прогреваются один раз на процесс
+
+    Параметры:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - tracing (bool): Флаг, указывающий, включена ли трассировка в основном процессе
+    - trace_file (str): Файл JSON Lines для интервалов основного процесса
+    """
+    global _feature_cache
+    logging.info('JobQueue: Initializing worker')
+    if tracing:
+        tracer.enable(trace_file)
+    warm_up_model(model, mri_modality)
+    # Кэш, унаследованный от родительского процесса, не используется: соединение SQLite нельзя делить после fork
+    _feature_cache = None
+    _get_feature_cache()
+
+
+@traced('process_case')
+def process_case(image_buffer, image_name: str, mask_buffer, mask_name: str, clinical_data: dict, show: bool,
+                 model=MODEL, mri_modality='T2', normalize=True, resample=False, report=None,
+                 preview_mode='axial', robustness=False, crop=False, predict=True) -> dict:
+    """
+    Обработка случая из буферов в памяти: предобработка, извлечение признаков, предсказание и превью.
+    При изменении только клинических данных признаки и превью берутся из кэшей без предобработки и извлечения
+
+    Параметры:
+    - image_buffer (bytes-like): Содержимое файла изображения
+    - image_name (str): Имя файла изображения
+    - mask_buffer (bytes-like): Содержимое файла маски
+    - mask_name (str): Имя файла маски
+    - clinical_data (dict): Клинические данные
+    - show (bool): Флаг, указывающий, нужно ли построить превью
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+    - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+    - report (callable): Функция, вызываемая с названием этапа перед его началом
+    - preview_mode (str): Режим превью ImageViewer.show: плоскость, 'triplanar' или 'strip'
+    - robustness (bool): Флаг, указывающий, нужно ли проверить устойчивость предсказания к возмущениям
+      маски и дискретизации
+    - crop (bool): Флаг, указывающий, нужно ли обрабатывать только область маски
+    - predict (bool): Флаг, указывающий, нужно ли предсказать в этом процессе через общий MicroBatcher модели;
+      иначе предсказание и вероятность равны None, а запись для предсказания возвращается в 'record'
+
+    Возвращает:
+    - result (dict): Предсказание, вероятность положительного класса, превью JPEG (или None),
+      сводка устойчивости (или None) и время выполненных этапов в секундах
+    """
+    timings = {}
+    stage_start = {}
+
+    def start(stage: str) -> None:
+        now = time.perf_counter()
+        for previous, started in stage_start.items():
+            timings.setdefault(previous, now - started)
+        stage_start[stage] = now
+        if report is not None:
+            report(stage)
+
+    registered_model = model_registry.get(model)
+    feature_cache = _get_feature_cache()
+    cache_key = feature_cache.make_key(image_buffer, mask_buffer, registered_model.feature_extractor.params,
+                                       normalize=normalize, resample=resample, modality=mri_modality, crop=crop,
+                                       version=PREPROCESSING_VERSION)
+    features = feature_cache.get(cache_key)
+    preview = preview_cache.get((cache_key, preview_mode)) if show else None
+
+    image = mask = None
+    if show and preview is None or features is None or robustness:
+        start('preprocess')
+        image, mask = model_registry.preprocessor(mri_modality).preprocessing_step(
+            read_image_buffer(image_buffer, image_name), read_image_buffer(mask_buffer, mask_name),
+            normalize=normalize, resample=resample, crop=crop
+        )
+        if features is None:
+            start('extract')
+            features = registered_model.feature_extractor.extract_features(image, mask)
+            feature_cache.put(cache_key, features)
+
+    record = features | clinical_data
+    prediction = probability = None
+    if predict:
+        start('predict')
+        prediction, probabilities = registered_model.batcher.predict(record)
+        prediction, probability = int(prediction), float(probabilities[-1])
+
+    stability = None
+    if robustness:
+        start('robustness')
+        stability = RobustnessAnalyzer(model, mri_modality, backend=ROBUSTNESS_BACKEND, normalize=normalize,
+                                       resample=resample).analyze(image, mask, clinical_data)['summary']
+
+    if show and preview is None:
+        start('preview')
+        preview = ImageViewer(image, mask).show(mode=preview_mode)
+        preview_cache.put((cache_key, preview_mode), preview)
+    start('done')
+
+    result = {'prediction': prediction, 'probability': probability, 'preview': preview, 'robustness': stability,
+              'timings': timings}
+    if not predict:
+        result['record'] = record
+    return result
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _run_job(job_id: str, stages, cancelled, case: dict, settings: dict) -> dict:
+    """
+    Выполнение задачи в процессе-обработчике с публикацией текущего этапа и проверкой отмены между этапами
+
+    Параметры:
+    - job_id (str): Идентификатор задачи
+    - stages (DictProxy): Общий словарь {задача: этап}
+    - cancelled (DictProxy): Общий словарь отмененных задач
+    - case (dict): Аргументы process_case с данными случая
+    - settings (dict): Настройки модели и предобработки
+
+    Возвращает:
+    - result (dict): Результат process_case; при включенной трассировке - с интервалами задачи в 'spans'
+    """
+    def report(stage: str) -> None:
+        if job_id in cancelled:
+            raise ValueError('JobQueue: Job cancelled')
+        stages[job_id] = stage
+
+    if job_id in cancelled:
+        raise ValueError('JobQueue: Job cancelled')
+    with tracer.request(job_id) as spans:
+        result = process_case(**case, **settings, report=report)
+    # Запись без предсказания предсказывается в основном процессе
+    stages[job_id] = 'predict' if 'record' in result else 'done'
+    if spans:
+        result['spans'] = spans
+    return result
+
+
+class JobQueue:
+    """
+    Класс JobQueue предназначен для фоновой обработки случаев в пуле прогретых процессов на одном хосте.
+    Задача получает идентификатор сразу, ее этап и результат опрашиваются по идентификатору.
+    Количество одновременно принятых задач ограничено, задачи можно отменять. Задача передается в пул,
+    когда для нее хватает бюджета памяти memory_scheduler (бокс маски для оценки ищется в том же пуле);
+    случай, не помещающийся в бюджет целиком, обрабатывается только в области маски. Признаки вычисляются
+    в процессах-обработчиках, а предсказания всех задач объединяются в пачки общим MicroBatcher модели
+    в основном процессе
+
+    Атрибуты:
+    - workers (int): Количество процессов-обработчиков
+    - max_pending (int): Максимальное количество принятых, но не завершенных задач
+    - settings (dict): Модель, модальность и флаги предобработки
+
+    Методы:
+    - __init__(self, workers=None, max_pending=None, model=MODEL, mri_modality='T2', normalize=True,
+      resample=False): Инициализация класса JobQueue
+    - warm_up(self) -> list: Запуск и прогрев всех процессов-обработчиков
+    - submit(self, image_buffer, image_name, mask_buffer, mask_name, clinical_data, show, preview_mode='axial',
+      robustness=False) -> str: Постановка задачи
+    - status(self, job_id) -> dict: Состояние, этап и результат задачи
+    - wait(self, job_id, timeout=None) -> dict: Ожидание завершения задачи
+    - load(self) -> dict: Загрузка очереди
+    - cancel(self, job_id) -> bool: Отмена задачи
+    - shutdown(self): Остановка пула процессов
+    """
+
+    def __init__(self, workers=None, max_pending=None, model=MODEL, mri_modality='T2', normalize=True,
+                 resample=False):
+        """
+        Инициализация класса JobQueue
+
+        Параметры:
+        - workers (int): Количество процессов-обработчиков, по умолчанию число ядер
+        - max_pending (int): Максимальное количество незавершенных задач, по умолчанию 4 на процесс
+        - model (str): Название модели
+        - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+        - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+        - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        """
+        logging.info('JobQueue: Initializing JobQueue class')
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.workers
+        if self.workers < 1 or self.max_pending < 1:
+            logging.error('JobQueue: Invalid queue size')
+            raise ValueError('JobQueue: Workers and max_pending must be positive')
+        self.settings = {'model': model, 'mri_modality': mri_modality, 'normalize': normalize, 'resample': resample}
+
+        context = multiprocessing.get_context(START_METHOD)
+        self._manager = context.Manager()
+        self._stages = self._manager.dict()
+        self._cancelled = self._manager.dict()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                             initargs=(model, mri_modality, tracer.enabled, tracer.trace_file))
+        self._jobs = OrderedDict()
+        # Предсказание выполняется в основном процессе, модель для него загружается, пока запускаются обработчики
+        Preloader({'model': lambda: model_registry.get(model)}).start()
+        # RLock: обратный вызов завершения может выполниться сразу внутри submit
+        self._lock = threading.RLock()
+
+    def warm_up(self) -> list:
+        """
+        Запуск всех процессов-обработчиков с загрузкой моделей заранее, до первой задачи
+
+        Возвращает:
+        - pids (list): Идентификаторы запущенных процессов
+        """
+        logging.info('JobQueue: Warming up workers')
+        # Пул запускает новый процесс на каждую задачу, пока нет свободных, поэтому задачи ставятся разом
+        futures = [self._executor.submit(_ping) for _ in range(self.workers)]
+        return sorted({future.result() for future in futures})
+
+    def _active(self) -> int:
+        return sum(not future.done() for future in self._jobs.values())
+
+    def submit(self, image_buffer, image_name: str, mask_buffer, mask_name: str, clinical_data: dict,
+               show: bool, preview_mode='axial', robustness=False) -> str:
+        """
+        Постановка случая в очередь
+
+        Параметры:
+        - image_buffer (bytes-like): Содержимое файла изображения
+        - image_name (str): Имя файла изображения
+        - mask_buffer (bytes-like): Содержимое файла маски
+        - mask_name (str): Имя файла маски
+        - clinical_data (dict): Клинические данные
+        - show (bool): Флаг, указывающий, нужно ли построить превью
+        - preview_mode (str): Режим превью: 'axial', 'coronal', 'sagittal', 'triplanar' или 'strip'
+        - robustness (bool): Флаг, указывающий, нужно ли проверить устойчивость предсказания
+
+        Возвращает:
+        - job_id (str): Идентификатор задачи
+        """
+        with self._lock:
+            if self._active() >= self.max_pending:
+                logging.warning('JobQueue: Queue is full')
+                raise ValueError('JobQueue: Queue is full, try again later')
+            job_id = uuid.uuid4().hex
+            self._stages[job_id] = 'queued'
+            # Задача ждет памяти в планировщике, поэтому ее Future создается до передачи в пул
+            job = concurrent.futures.Future()
+            self._jobs[job_id] = job
+            job.add_done_callback(self._job_finished)
+        # Файлы копируются только после проверки очереди; bytes(bytes) возвращает тот же объект без копии
+        case = {
+            'image_buffer': bytes(image_buffer), 'image_name': image_name,
+            'mask_buffer': bytes(mask_buffer), 'mask_name': mask_name,
+            'clinical_data': clinical_data, 'show': show, 'preview_mode': preview_mode, 'robustness': robustness
+        }
+        # Бокс маски для оценки памяти ищется в процессе пула, поток запроса маску не читает
+        memory_scheduler.submit_measured(
+            self._executor, lambda admission: self._start_job(job_id, job, admission, case), case['image_buffer'],
+            case['mask_buffer'], self.settings['normalize'], self.settings['resample'], image_name=image_name,
+            mask_name=mask_name
+        )
+        logging.info(f'JobQueue: Job {job_id} submitted')
+        return job_id
+
+    def _start_job(self, job_id: str, job: concurrent.futures.Future, admission, case: dict) -> None:
+        # Вызывается потоком планировщика памяти; задача, отмененная в очереди, не запускается
+        if not job.set_running_or_notify_cancel():
+            memory_scheduler.release(admission)
+            return
+        logging.info(f'JobQueue: Job {job_id} started, {admission}')
+        try:
+            future = self._executor.submit(_run_job, job_id, self._stages, self._cancelled,
+                                           case | {'crop': admission.crop, 'predict': False}, self.settings)
+        except RuntimeError as e:
+            memory_scheduler.release(admission)
+            job.set_exception(e)
+            return
+        future.add_done_callback(lambda future: self._finish_job(future, job_id, job, admission))
+
+    def _finish_job(self, future, job_id: str, job: concurrent.futures.Future, admission) -> None:
+        memory_scheduler.release(admission)
+        if future.cancelled():
+            job.set_exception(concurrent.futures.CancelledError('JobQueue: Job cancelled'))
+            return
+        if future.exception() is not None:
+            job.set_exception(future.exception())
+            return
+        # Предсказания задач всех процессов-обработчиков объединяются в пачки общим MicroBatcher
+        result = future.result()
+        started = time.perf_counter()
+        try:
+            prediction = model_registry.get(self.settings['model']).batcher.submit(result.pop('record'))
+        except ValueError as e:
+            job.set_exception(e)
+            return
+        prediction.add_done_callback(lambda prediction: self._set_prediction(prediction, job_id, job, result, started))
+
+    def _set_prediction(self, prediction, job_id: str, job: concurrent.futures.Future, result: dict,
+                        started: float) -> None:
+        if prediction.exception() is not None:
+            job.set_exception(prediction.exception())
+            return
+        predicted_class, probabilities = prediction.result()
+        result.update(prediction=int(predicted_class), probability=float(probabilities[-1]))
+        result['timings']['predict'] = time.perf_counter() - started
+        self._stages[job_id] = 'done'
+        job.set_result(result)
+
+    def _job_finished(self, future) -> None:
+        # Интервалы, записанные в процессе-обработчике, добавляются в метрики основного процесса
+        if not future.cancelled() and future.exception() is None:
+            tracer.ingest(future.result().get('spans'))
+        self._forget_finished()
+
+    def _forget_finished(self) -> None:
+        # Хранятся только последние завершенные задачи, чтобы очередь не росла без ограничений
+        with self._lock:
+            finished = [job_id for job_id, future in self._jobs.items() if future.done()]
+            for job_id in finished[:max(len(finished) - FINISHED_JOBS_LIMIT, 0)]:
+                del self._jobs[job_id]
+                self._stages.pop(job_id, None)
+                self._cancelled.pop(job_id, None)
+
+    def status(self, job_id: str) -> dict:
+        """
+        Состояние задачи
+
+        Параметры:
+        - job_id (str): Идентификатор задачи
+
+        Возвращает:
+        - status (dict): Состояние ('queued', 'running', 'done', 'failed', 'cancelled'), этап,
+          доля выполненных этапов, результат или текст ошибки
+        """
+        with self._lock:
+            future = self._jobs.get(job_id)
+        if future is None:
+            logging.error('JobQueue: Job not found')
+            raise ValueError('JobQueue: Job not found')
+
+        stage = self._stages.get(job_id, 'queued')
+        status = {'state': 'running', 'stage': stage, 'progress': STAGES.index(stage) / (len(STAGES) - 1),
+                  'result': None, 'error': None}
+        if job_id in self._cancelled:
+            status['state'] = 'cancelled'
+        elif future.done():
+            error = future.exception()
+            if error is None:
+                status.update(state='done', stage='done', progress=1.0, result=future.result())
+            else:
+                status.update(state='failed', error=str(error))
+        elif stage == 'queued':
+            status['state'] = 'queued'
+        return status
+
+    def wait(self, job_id: str, timeout=None) -> dict:
+        """
+        Ожидание завершения задачи
+
+        Параметры:
+        - job_id (str): Идентификатор задачи
+        - timeout (float): Максимальное время ожидания в секундах, None - без ограничения
+
+        Возвращает:
+        - status (dict): Состояние задачи, как в status; если время истекло, задача еще выполняется
+        """
+        with self._lock:
+            future = self._jobs.get(job_id)
+        if future is not None:
+            concurrent.futures.wait([future], timeout=timeout)
+        return self.status(job_id)
+
+    def load(self) -> dict:
+        """
+        Загрузка очереди
+
+        Возвращает:
+        - load (dict): Количество процессов, незавершенных задач, предел очереди и количество задач,
+          ожидающих памяти
+        """
+        with self._lock:
+            return {'workers': self.workers, 'pending': self._active(), 'max_pending': self.max_pending,
+                    'waiting_for_memory': memory_scheduler.waiting}
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Отмена задачи: задача в очереди снимается сразу, выполняющаяся останавливается перед следующим этапом
+
+        Параметры:
+        - job_id (str): Идентификатор задачи
+
+        Возвращает:
+        - cancelled (bool): False, если задача уже завершена
+        """
+        with self._lock:
+            future = self._jobs.get(job_id)
+        if future is None or future.done() and job_id not in self._cancelled:
+            return False
+        self._cancelled[job_id] = True
+        future.cancel()
+        logging.info(f'JobQueue: Job {job_id} cancelled')
+        return True
+
+    def shutdown(self) -> None:
+        """
+        Остановка пула процессов с отменой задач в очереди
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        # Задачи, ожидающие памяти, отменяются до остановки пула
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(cancel_futures=True)
+        self._manager.shutdown()
@@ -0,0 +1,115 @@
+import importlib
+import logging
+import subprocess
+import sys
+import threading
+import time
+import types
+
+# Точки входа, время холодного импорта которых отслеживается
+ENTRY_MODULES = ('app', 'job_queue', 'inference_service', 'batch_processing', 'model_registry')
+# Тяжелые зависимости, загружаемые отложенно при первом использовании
+HEAVY_MODULES = ('streamlit', 'numpy', 'SimpleITK', 'radiomics.featureextractor', 'intensity_normalization.typing',
+                 'scipy.ndimage', 'PIL.Image', 'pandas', 'joblib', 'sklearn.compose', 'xgboost')
+
+# Время первой загрузки отложенных модулей текущего процесса в миллисекундах
+_load_times = {}
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Класс LazyModule - заместитель модуля, который импортирует модуль при первом обращении к атрибуту.
+    После загрузки атрибуты модуля копируются в заместитель, поэтому дальнейшие обращения не медленнее обычных
+
+    Методы:
+    - __init__(self, name): Инициализация заместителя модуля
+    - __getattr__(self, attribute): Загрузка модуля и получение атрибута
+    """
+
+    def __init__(self, name: str):
+        """
+        Инициализация заместителя модуля
+
+        Параметры:
+        - name (str): Полное имя модуля, например 'radiomics.featureextractor'
+        """
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        with _lock:
+            module = self.__dict__['_lazy_module']
+            if module is None:
+                name = self.__name__
+                start = time.perf_counter()
+                module = importlib.import_module(name)
+                _load_times[name] = (time.perf_counter() - start) * 1000
+                logging.info(f'LazyImport: Loaded {name} in {_load_times[name]:.0f} ms')
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attribute: str):
+        # Вызывается только для атрибутов, которых еще нет в заместителе, в том числе для подмодулей,
+        # импортированных после загрузки
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Отложенный импорт модуля: модуль загружается при первом обращении к его атрибуту
+
+    Параметры:
+    - name (str): Полное имя модуля
+
+    Возвращает:
+    - module (ModuleType): Уже загруженный модуль или его заместитель LazyModule
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+def load_times() -> dict:
+    """
+    Время загрузки отложенных модулей, уже использованных в текущем процессе
+
+    Возвращает:
+    - load_times (dict): Словарь {модуль: миллисекунды} в порядке загрузки
+    """
+    with _lock:
+        return dict(_load_times)
+
+
+def import_report(modules=ENTRY_MODULES, repeats=3) -> dict:
+    """
+    Время холодного импорта модулей, каждый импорт - в новом интерпретаторе
+
+    Параметры:
+    - modules (tuple): Имена модулей
+    - repeats (int): Количество повторов, берется лучшее время
+
+    Возвращает:
+    - report (dict): Словарь {модуль: миллисекунды}
+    """
+    report = {}
+    for name in modules:
+        code = f'import time; start = time.perf_counter(); import {name}; print(time.perf_counter() - start)'
+        times = []
+        for _ in range(repeats):
+            completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+            if completed.returncode != 0:
+                logging.error(f'LazyImport: Failed to import {name}')
+                raise ValueError(f'LazyImport: Failed to import {name}: {completed.stderr.strip()[-200:]}')
+            times.append(float(completed.stdout.split()[-1]) * 1000)
+        report[name] = min(times)
+    return report
+
+
+if __name__ == "__main__":
+    # Отчет о времени импорта: python lazy_importing.py [модуль ...]
+    for module_name, milliseconds in import_report(tuple(sys.argv[1:]) or ENTRY_MODULES + HEAVY_MODULES).items():
+        print(f'{module_name:40s} {milliseconds:8.1f} ms')
@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Открытые участки измерения пика памяти и блокировка, согласующая сброс пика с ними
+_tracked_peaks = {}
+_tracked_lock = threading.Lock()
+
+
+def get_rss() -> int:
+    """
+    Текущий размер резидентной памяти процесса
+
+    Возвращает:
+    - rss (int): Размер резидентной памяти в байтах, 0 если платформа не поддерживается
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss()
+
+
+def get_peak_rss() -> int:
+    """
+    Пиковый размер резидентной памяти процесса с момента запуска
+
+    Возвращает:
+    - peak_rss (int): Пиковый размер резидентной памяти в байтах, 0 если платформа не поддерживается
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Сброс пикового размера резидентной памяти процесса до текущего, чтобы измерить пик отдельного этапа
+
+    Возвращает:
+    - reset (bool): True, если сброс поддерживается платформой (Linux)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def track_peak_rss():
+    """
+    Измерение пика резидентной памяти участка кода относительно памяти в его начале.
+    Пик процесса сбрасывается в начале каждого участка, а пик, достигнутый до сброса, сохраняется
+    во всех открытых участках, поэтому вложенное измерение не занижает пик охватывающего
+
+    Возвращает:
+    - peak (dict): {'peak_rss': прирост пика в байтах, заполняется при выходе, 'tracked': поддерживается ли сброс}
+    """
+    peak = {'peak_rss': 0, 'tracked': False, 'carried': 0}
+    with _tracked_lock:
+        current = get_peak_rss()
+        for outer in _tracked_peaks.values():
+            outer['carried'] = max(outer['carried'], current)
+        peak['tracked'] = reset_peak_rss()
+        _tracked_peaks[id(peak)] = peak
+    start = get_rss()
+    try:
+        yield peak
+    finally:
+        with _tracked_lock:
+            del _tracked_peaks[id(peak)]
+            peak['peak_rss'] = max(max(peak.pop('carried'), get_peak_rss()) - start, 0)
+
+
+def get_available_memory() -> int:
+    """
+    Память, доступная для новых процессов без вытеснения в своп (MemAvailable)
+
+    Возвращает:
+    - available (int): Доступная память в байтах, 0 если платформа не поддерживается
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
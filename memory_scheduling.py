@@ -0,0 +1,537 @@
+from __future__ import annotations
+import collections
+import logging
+import math
+import os
+import re
+import struct
+import threading
+import zlib
+from image_loading import GZIP_MAGIC, NRRD_MAGIC, read_image, read_image_buffer
+from lazy_importing import lazy_import
+from memory_monitoring import get_available_memory
+from preprocessing import CROP_MARGIN, OUTPUT_SPACING, Preprocessor
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+
+# Бюджет памяти случаев в МиБ, по умолчанию доля памяти, доступной при первом использовании планировщика
+MEMORY_BUDGET_ENV = 'RADIOMICS_MEMORY_BUDGET'
+MEMORY_BUDGET_FRACTION = 0.6
+# Бюджет, когда память платформы измерить не удалось: случаи ограничиваются только очередью задач
+UNLIMITED_BUDGET = 2 ** 62
+# Сколько байт начала файла читается для заголовка
+HEADER_READ_SIZE = 64 * 1024
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+NIFTI_FLOAT32 = 16
+# Байт на воксель для типов NRRD
+NRRD_TYPE_BYTES = {
+    'signed char': 1, 'int8': 1, 'int8_t': 1, 'uchar': 1, 'unsigned char': 1, 'uint8': 1, 'uint8_t': 1,
+    'short': 2, 'short int': 2, 'signed short': 2, 'signed short int': 2, 'int16': 2, 'int16_t': 2,
+    'ushort': 2, 'unsigned short': 2, 'unsigned short int': 2, 'uint16': 2, 'uint16_t': 2,
+    'int': 4, 'signed int': 4, 'int32': 4, 'int32_t': 4, 'uint': 4, 'unsigned int': 4, 'uint32': 4, 'uint32_t': 4,
+    'longlong': 8, 'long long': 8, 'long long int': 8, 'signed long long': 8, 'signed long long int': 8,
+    'int64': 8, 'int64_t': 8, 'ulonglong': 8, 'unsigned long long': 8, 'unsigned long long int': 8,
+    'uint64': 8, 'uint64_t': 8, 'float': 4, 'double': 8
+}
+# Маска, занимающая без сжатия больше этого размера, не читается для оценки бокса области
+MASK_BOX_LIMIT = 64 * 2 ** 20
+# Пик извлечения признаков в байтах на воксель сетки изображения и на воксель бокса области,
+# пик - большее из двух (измерено на объемах 2-40 млн вокселей)
+EXTRACTION_BYTES_PER_VOXEL = {'pyradiomics': (16, 96), 'numpy': (9, 1100)}
+# Запас на временные массивы, не учтенные моделью
+ESTIMATE_MARGIN = 1.25
+
+
+def _read_prefix(source) -> bytes:
+    # Начало файла или буфера; сжатый gzip распаковывается только до размера заголовка
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            prefix = f.read(HEADER_READ_SIZE)
+    else:
+        prefix = bytes(source[:HEADER_READ_SIZE])
+    if prefix.startswith(GZIP_MAGIC):
+        try:
+            prefix = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(prefix, HEADER_READ_SIZE)
+        except zlib.error:
+            logging.error('Scheduler: Corrupted gzip header')
+            raise ValueError('Scheduler: Corrupted gzip header')
+    return prefix
+
+
+def _nifti_header(prefix: bytes):
+    for endian in '<>':
+        if len(prefix) < 4:
+            return None
+        header_size = struct.unpack(endian + 'i', prefix[:4])[0]
+        if header_size == NIFTI1_HEADER_SIZE and len(prefix) >= NIFTI1_HEADER_SIZE:
+            dims = struct.unpack(endian + '8h', prefix[40:56])
+            datatype, bitpix = struct.unpack(endian + '2h', prefix[70:74])
+            pixdim = struct.unpack(endian + '8f', prefix[76:108])
+            slope, inter = struct.unpack(endian + '2f', prefix[112:120])
+        elif header_size == NIFTI2_HEADER_SIZE and len(prefix) >= NIFTI2_HEADER_SIZE:
+            datatype, bitpix = struct.unpack(endian + '2h', prefix[12:16])
+            dims = struct.unpack(endian + '8q', prefix[16:80])
+            pixdim = struct.unpack(endian + '8d', prefix[104:168])
+            slope, inter = struct.unpack(endian + '2d', prefix[168:184])
+        else:
+            continue
+        rank = max(min(dims[0], 7), 1)
+        size = [max(int(dims[axis]), 1) if axis <= rank else 1 for axis in (1, 2, 3)]
+        components = math.prod(max(int(dim), 1) for dim in dims[4:rank + 1])
+        spacing = [abs(float(pixdim[axis])) or 1.0 if axis <= rank else 1.0 for axis in (1, 2, 3)]
+        # Масштабированные значения ITK читает в float32
+        scaled = slope not in (0, 1) or inter != 0
+        return {
+            'size': size,
+            'spacing': spacing,
+            'pixel_bytes': (4 if scaled else max(bitpix // 8, 1)) * components,
+            'float32': (scaled or datatype == NIFTI_FLOAT32) and components == 1
+        }
+    return None
+
+
+def _nrrd_header(prefix: bytes):
+    if not prefix.startswith(NRRD_MAGIC):
+        return None
+    fields = {}
+    for line in prefix.split(b'\n')[1:]:
+        line = line.decode('latin-1').rstrip('\r')
+        if not line:
+            break
+        if ':' in line and not line.startswith('#'):
+            key, value = line.split(':', 1)
+            fields[key.strip().lower()] = value.lstrip('=').strip()
+    try:
+        sizes = [int(size) for size in fields['sizes'].split()]
+        pixel_bytes = NRRD_TYPE_BYTES[' '.join(fields['type'].lower().split())]
+    except (KeyError, ValueError):
+        logging.error('Scheduler: Invalid NRRD header')
+        raise ValueError('Scheduler: Invalid NRRD header')
+    if 'space directions' in fields:
+        # Оси без направления ('none') - компоненты вокселя
+        directions = re.findall(r'none|\([^)]*\)', fields['space directions'])
+        spacing = [None if direction == 'none' else
+                   math.sqrt(sum(float(value) ** 2 for value in direction.strip('()').split(',')))
+                   for direction in directions]
+    elif 'spacings' in fields:
+        spacing = [None if value.lower() == 'nan' else abs(float(value)) for value in fields['spacings'].split()]
+    else:
+        spacing = [1.0] * len(sizes)
+    spatial = [(size, step) for size, step in zip(sizes, spacing) if step is not None]
+    components = math.prod(size for size, step in zip(sizes, spacing) if step is None)
+    spatial += [(1, 1.0)] * (3 - len(spatial))
+    return {
+        'size': [size for size, _ in spatial[:3]],
+        'spacing': [step or 1.0 for _, step in spatial[:3]],
+        'pixel_bytes': pixel_bytes * components,
+        'float32': fields['type'].lower() == 'float' and components == 1
+    }
+
+
+def read_header(source) -> dict:
+    """
+    Чтение геометрии и типа вокселей из заголовка NIfTI-1/2 или NRRD без чтения вокселей:
+    сжатый файл распаковывается только до конца заголовка. Другие форматы читаются ImageFileReader
+    (только заголовок)
+
+    Параметры:
+    - source (str | bytes-like): Путь к файлу или содержимое файла
+
+    Возвращает:
+    - header (dict): size (x, y, z), spacing (x, y, z), pixel_bytes (байт на воксель с компонентами)
+      и float32 (воксели читаются как float32 без приведения)
+    """
+    prefix = _read_prefix(source)
+    header = _nifti_header(prefix) or _nrrd_header(prefix)
+    if header is not None:
+        return header
+    if not isinstance(source, str):
+        logging.error('Scheduler: Unknown image format')
+        raise ValueError('Scheduler: Unknown image format, expected NIfTI or NRRD')
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(source)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        logging.error('Scheduler: Cannot read image header')
+        raise ValueError(f'Scheduler: Cannot read image header of {source}')
+    size = list(reader.GetSize()) + [1] * (3 - reader.GetDimension())
+    spacing = list(reader.GetSpacing()) + [1.0] * (3 - reader.GetDimension())
+    return {
+        'size': size[:3],
+        'spacing': spacing[:3],
+        'pixel_bytes': sitk.Image([1] * reader.GetDimension(), reader.GetPixelID(),
+                                  reader.GetNumberOfComponents()).GetSizeOfPixelComponent()
+                       * reader.GetNumberOfComponents() * math.prod(size[3:]),
+        'float32': reader.GetPixelID() == sitk.sitkFloat32
+    }
+
+
+def estimate_peak(image: dict, mask: dict, normalize=True, resample=False, crop=False, box=None,
+                  in_memory=False, backend='pyradiomics') -> int:
+    """
+    Оценка пика памяти предобработки и извлечения признаков одного случая по заголовкам:
+    массивы, одновременно живущие на каждом этапе Preprocessor (чтение, приведение к float32 при нормализации,
+    коэффициенты B-сплайна float64 и выходная сетка 1 мм при ресэмплировании, маска на сетке изображения),
+    и временные массивы извлечения признаков в боксе области
+
+    Параметры:
+    - image (dict): Заголовок изображения read_header
+    - mask (dict): Заголовок маски read_header
+    - normalize (bool): Флаг нормализации
+    - resample (bool): Флаг ресэмплирования
+    - crop (bool): Флаг обработки только области маски (roi_preprocessing_step)
+    - box (tuple): Бокс области (начало x, y, z, размер x, y, z), None - неизвестен, считается все изображение
+    - in_memory (bool): Флаг, указывающий, что изображение и маска переданы прочитанными (sitk.Image)
+      и живут все время предобработки
+    - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+
+    Возвращает:
+    - peak (int): Пик памяти сверх базовой в байтах
+    """
+    size = np.array(image['size'])
+    spacing = np.array(image['spacing'])
+    pixel_bytes, mask_bytes = image['pixel_bytes'], mask['pixel_bytes']
+    voxels = int(size.prod())
+    mask_voxels = int(np.prod(mask['size']))
+    if box is None:
+        box = (0, 0, 0, *size.tolist())
+
+    def output(region):
+        return int(np.prod(np.rint(np.array(region) * spacing / OUTPUT_SPACING) if resample else region))
+
+    # Изображение, переданное прочитанным, и прочитанная маска живут все время предобработки
+    held = (voxels * pixel_bytes if in_memory else 0) + mask_voxels * mask_bytes
+    # Чтение файла временно занимает два размера изображения (буфер чтения и изображение)
+    stages = [voxels * pixel_bytes * (1 if in_memory else 2)]
+    if crop:
+        region = np.minimum(np.array(box[3:]) + 2 * CROP_MARGIN + (2 if resample else 0), size)
+        region_voxels = int(region.prod())
+        # Бокс маски ищется по логическому массиву размера маски, затем при нормализации читается
+        # все изображение для статистик, и из него вырезается область
+        if normalize and not in_memory:
+            stages.append(2 * voxels * pixel_bytes + region_voxels * pixel_bytes + 2 * mask_voxels)
+        else:
+            stages.append(2 * region_voxels * pixel_bytes + 2 * mask_voxels)
+        image_bytes = region_voxels * pixel_bytes
+        # Вырезанные области изображения и маски - собственные копии, изображение нормализуется на месте
+        in_place = image['float32']
+        held += region_voxels * mask_bytes
+    else:
+        region = size
+        region_voxels = voxels
+        image_bytes = 0 if in_memory else voxels * pixel_bytes
+        in_place = image['float32'] and not in_memory
+    if normalize and not in_place:
+        # Приведение к float32 рядом с исходным изображением
+        stages.append(image_bytes + region_voxels * 4)
+        image_bytes = region_voxels * 4
+    stages.append(image_bytes)
+    output_voxels = output(region)
+    if resample:
+        # B-сплайн интерполятор хранит коэффициенты в float64
+        stages.append(image_bytes + region_voxels * 8 + output_voxels * 4)
+        image_bytes = output_voxels * 4
+    mask_output = output_voxels * mask_bytes if resample else 0
+    grid_bytes, box_bytes = EXTRACTION_BYTES_PER_VOXEL[backend]
+    extraction = max(output_voxels * grid_bytes, output(box[3:]) * box_bytes)
+    stages.append(image_bytes + mask_output + extraction)
+    return int((held + max(stages)) * ESTIMATE_MARGIN)
+
+
+def default_budget() -> int:
+    """
+    Бюджет памяти по умолчанию: из переменной RADIOMICS_MEMORY_BUDGET (МиБ), иначе MEMORY_BUDGET_FRACTION
+    доступной памяти, иначе физической памяти. Если память платформы измерить не удалось, бюджет не ограничен
+
+    Возвращает:
+    - budget (int): Бюджет памяти в байтах
+    """
+    if os.environ.get(MEMORY_BUDGET_ENV):
+        return int(float(os.environ[MEMORY_BUDGET_ENV]) * 2 ** 20)
+    available = get_available_memory()
+    if available <= 0:
+        try:
+            available = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            available = 0
+        logging.warning('Scheduler: Cannot measure available memory, budget is based on '
+                        + ('physical memory' if available > 0 else 'nothing and is unlimited'))
+    return int(available * MEMORY_BUDGET_FRACTION) if available > 0 else UNLIMITED_BUDGET
+
+
+def mask_box(mask, mask_name=None):
+    """
+    Бокс метки области, как у roi_preprocessing_step. Маска читается целиком, поэтому функция выполняется
+    в процессе пула, а не в потоке запроса; маска больше MASK_BOX_LIMIT без сжатия не читается
+
+    Параметры:
+    - mask (str | bytes-like): Путь к маске или ее содержимое
+    - mask_name (str): Имя файла маски для содержимого в памяти
+
+    Возвращает:
+    - box (tuple | None): Бокс (начало x, y, z, размер x, y, z), None - маска слишком большая,
+      не читается или метки нет
+    """
+    try:
+        header = read_header(mask)
+        if math.prod(header['size']) * header['pixel_bytes'] > MASK_BOX_LIMIT:
+            return None
+        image = read_image(mask) if isinstance(mask, str) else read_image_buffer(mask, mask_name)
+        index, size = Preprocessor.mask_bounding_box(image)
+    except (OSError, RuntimeError, ValueError) as e:
+        logging.warning(f'Scheduler: Cannot find mask bounding box: {e}')
+        return None
+    return (*index.tolist(), *size.tolist())
+
+
+class Admission:
+    """
+    Класс Admission - решение планировщика для одного случая
+
+    Атрибуты:
+    - cost (int): Резервируемая память в байтах
+    - crop (bool): Флаг, указывающий, что случай обрабатывается только в области маски
+    - estimates (dict): Оценки пика памяти {'full': байты, 'crop': байты или None}
+    - oversized (bool): Флаг, указывающий, что случай не помещается в бюджет и выполняется один
+    """
+
+    def __init__(self, cost: int, crop: bool, estimates: dict, oversized=False):
+        self.cost = cost
+        self.crop = crop
+        self.estimates = estimates
+        self.oversized = oversized
+
+    def __repr__(self) -> str:
+        return f'Admission(cost={self.cost / 2 ** 20:.0f} MiB, crop={self.crop}, oversized={self.oversized})'
+
+
+class MemoryScheduler:
+    """
+    Класс MemoryScheduler предназначен для допуска случаев к обработке по оценке пика памяти:
+    оценка строится по заголовкам изображения и маски и по боксу маски, найденному в процессе пула,
+    случай, не помещающийся в бюджет целиком, обрабатывается только в области маски, а случаи,
+    не помещающиеся в оставшийся бюджет, ждут в очереди. Случай больше всего бюджета выполняется один.
+    Общий для очереди задач приложения и пакетной обработки
+
+    Атрибуты:
+    - budget (int): Бюджет памяти одновременно выполняемых случаев в байтах
+    - reserved (int): Память, зарезервированная выполняющимися случаями
+    - waiting (int): Количество случаев в очереди
+
+    Методы:
+    - __init__(self, budget=None): Инициализация класса MemoryScheduler
+    - plan(self, image, mask, normalize=True, resample=False, crop=False, ..., box=None) -> Admission: Оценка
+      по заголовкам и выбор пути
+    - submit(self, admission, start): Запуск случая, когда для него есть память
+    - submit_measured(self, executor, start, image, mask, ...): Поиск бокса маски в пуле, оценка и запуск
+    - release(self, admission): Освобождение памяти завершенного случая
+    - stats(self) -> dict: Счетчики планировщика
+    - prometheus_text(self) -> str: Счетчики в текстовом формате Prometheus
+    """
+
+    def __init__(self, budget=None):
+        """
+        Инициализация класса MemoryScheduler
+
+        Параметры:
+        - budget (int): Бюджет памяти в байтах, по умолчанию default_budget() при первом обращении,
+          чтобы импорт модуля не зависел от измерения памяти
+        """
+        if budget is not None and budget <= 0:
+            logging.error('Scheduler: Invalid memory budget')
+            raise ValueError('Scheduler: Memory budget must be positive')
+        self._budget = budget
+        self.reserved = 0
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._counters = {'admitted': 0, 'cropped': 0, 'oversized': 0, 'queued': 0}
+
+    @property
+    def budget(self) -> int:
+        if self._budget is None:
+            budget = default_budget()
+            if budget <= 0:
+                logging.error('Scheduler: Invalid memory budget')
+                raise ValueError(f'Scheduler: Memory budget must be positive, check {MEMORY_BUDGET_ENV}')
+            self._budget = budget
+        return self._budget
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    def plan(self, image, mask, normalize=True, resample=False, crop=False, backend='pyradiomics',
+             image_name=None, mask_name=None, box=None) -> Admission:
+        """
+        Оценка пика памяти случая по заголовкам без чтения вокселей и выбор пути обработки: весь объем,
+        если он помещается в бюджет, иначе только область маски. Без бокса маски путь по области не оценивается,
+        а извлечение признаков оценивается по всему изображению. Если заголовок прочитать не удалось,
+        случай допускается без оценки, а ошибка будет получена при обработке
+
+        Параметры:
+        - image (str | bytes-like): Путь к изображению или его содержимое
+        - mask (str | bytes-like): Путь к маске или ее содержимое
+        - normalize (bool): Флаг нормализации
+        - resample (bool): Флаг ресэмплирования
+        - crop (bool): Флаг, требующий обработки только области маски
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+        - image_name (str): Имя файла изображения для содержимого в памяти
+        - mask_name (str): Имя файла маски для содержимого в памяти
+        - box (tuple): Бокс маски mask_box, None - неизвестен
+
+        Возвращает:
+        - admission (Admission): Резервируемая память и путь обработки
+        """
+        in_memory = not isinstance(image, str)
+        try:
+            image_header, mask_header = read_header(image), read_header(mask)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Scheduler: Cannot read headers, admitting without estimate: {e}')
+            return Admission(0, crop, {'full': None, 'crop': None})
+
+        buffers = 0 if not in_memory else 2 * (len(image) + len(mask))
+        estimates = {
+            'full': estimate_peak(image_header, mask_header, normalize, resample, False, box, in_memory,
+                                  backend) + buffers,
+            'crop': estimate_peak(image_header, mask_header, normalize, resample, True, box, in_memory,
+                                  backend) + buffers
+            if box is not None else None
+        }
+        if not crop and estimates['full'] <= self.budget or estimates['crop'] is None:
+            admission = Admission(estimates['full'], crop, estimates)
+        else:
+            admission = Admission(estimates['crop'], True, estimates)
+        admission.oversized = admission.cost > self.budget
+        if admission.crop and not crop:
+            logging.info(f'Scheduler: Full volume needs {estimates["full"] / 2 ** 20:.0f} MiB, processing mask region')
+        return admission
+
+    def submit_measured(self, executor, start, image, mask, normalize=True, resample=False, crop=False,
+                        backend='pyradiomics', image_name=None, mask_name=None) -> None:
+        """
+        Поиск бокса маски в процессе пула, затем оценка plan и запуск submit. Вызывающий поток
+        не читает маску и не ждет результата
+
+        Параметры:
+        - executor (Executor): Пул, в котором выполняется mask_box
+        - start (callable): Функция запуска, принимающая Admission
+        - image, mask, normalize, resample, crop, backend, image_name, mask_name: Параметры plan
+        """
+        def submit_planned(box) -> None:
+            try:
+                admission = self.plan(image, mask, normalize, resample, crop, backend, image_name, mask_name, box)
+            except Exception as e:
+                logging.error(f'Scheduler: Failed to plan case, admitting without estimate: {e}')
+                admission = Admission(0, crop, {'full': None, 'crop': None})
+            self.submit(admission, lambda: start(admission))
+
+        def measured(future) -> None:
+            try:
+                box = future.result()
+            except Exception as e:
+                logging.warning(f'Scheduler: Cannot find mask bounding box: {e}')
+                box = None
+            submit_planned(box)
+
+        try:
+            future = executor.submit(mask_box, mask, mask_name)
+        except RuntimeError as e:
+            logging.warning(f'Scheduler: Cannot measure mask, planning without bounding box: {e}')
+            submit_planned(None)
+            return
+        future.add_done_callback(measured)
+
+    def _fits(self, admission: Admission) -> bool:
+        # Случай больше всего бюджета запускается, когда других нет
+        return self.reserved + admission.cost <= self.budget or self.reserved == 0
+
+    def submit(self, admission: Admission, start) -> None:
+        """
+        Запуск случая, когда для него есть память, в порядке поступления. Функция запуска вызывается
+        в потоке планировщика и должна только поставить работу (например, в пул процессов),
+        по ее завершении вызывается release
+
+        Параметры:
+        - admission (Admission): Решение plan
+        - start (callable): Функция без аргументов, запускающая обработку
+        """
+        with self._condition:
+            if admission.oversized:
+                logging.warning(f'Scheduler: {admission} exceeds the budget of {self.budget / 2 ** 20:.0f} MiB, '
+                                f'it will run alone')
+            # Случай ждет памяти, если ее не хватает с учетом случаев впереди в очереди
+            ahead = self.reserved + sum(queued.cost for queued, _ in self._queue)
+            if ahead and ahead + admission.cost > self.budget:
+                self._counters['queued'] += 1
+                logging.info(f'Scheduler: {admission} waits for memory, {ahead / 2 ** 20:.0f} MiB reserved or queued')
+            self._queue.append((admission, start))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, name='MemoryScheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue and self._fits(self._queue[0][0]))
+                admission, start = self._queue.popleft()
+                self.reserved += admission.cost
+                self._counters['admitted'] += 1
+                self._counters['cropped'] += admission.crop
+                self._counters['oversized'] += admission.oversized
+            try:
+                start()
+            except Exception as e:
+                logging.error(f'Scheduler: Failed to start case: {e}')
+                self.release(admission)
+
+    def release(self, admission: Admission) -> None:
+        """
+        Освобождение памяти завершенного случая
+
+        Параметры:
+        - admission (Admission): Решение plan, переданное в submit
+        """
+        with self._condition:
+            self.reserved -= admission.cost
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Счетчики планировщика
+
+        Возвращает:
+        - stats (dict): Бюджет и зарезервированная память в байтах, случаи в очереди, количество допущенных,
+          обработанных по области маски, превысивших бюджет и ожидавших случаев
+        """
+        with self._condition:
+            return {'budget': self.budget, 'reserved': self.reserved, 'waiting': len(self._queue), **self._counters}
+
+    def prometheus_text(self) -> str:
+        """
+        Счетчики планировщика в текстовом формате Prometheus
+
+        Возвращает:
+        - text (str): Метрики radiomics_memory_*
+        """
+        stats = self.stats()
+        lines = [
+            '# TYPE radiomics_memory_budget_bytes gauge',
+            f'radiomics_memory_budget_bytes {stats["budget"]}',
+            '# TYPE radiomics_memory_reserved_bytes gauge',
+            f'radiomics_memory_reserved_bytes {stats["reserved"]}',
+            '# TYPE radiomics_memory_waiting_cases gauge',
+            f'radiomics_memory_waiting_cases {stats["waiting"]}',
+        ]
+        for name in ('admitted', 'cropped', 'oversized', 'queued'):
+            lines += [f'# TYPE radiomics_memory_{name}_cases_total counter',
+                      f'radiomics_memory_{name}_cases_total {stats[name]}']
+        return '\n'.join(lines) + '\n'
+
+
+# Планировщик процесса, общий для очереди задач приложения и пакетной обработки
+memory_scheduler = MemoryScheduler()
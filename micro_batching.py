@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from predicting import Predictor
+
+MAX_BATCH_SIZE = 64
+# Окно накопления запросов в секундах
+MAX_DELAY = 0.005
+
+
+class MicroBatcher:
+    """
+    Класс MicroBatcher предназначен для объединения одиночных запросов предсказания, пришедших
+    одновременно из разных потоков, в один вызов Predictor.predict_batch. Первый запрос ждет
+    не дольше окна накопления, пачка ограничена по размеру
+
+    Атрибуты:
+    - predictor (Predictor): Классификатор модели
+    - max_batch_size (int): Максимальный размер пачки
+    - max_delay (float): Окно накопления запросов в секундах
+
+    Методы:
+    - __init__(self, predictor, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY): Инициализация класса MicroBatcher
+    - submit(self, record) -> Future: Постановка записи в очередь предсказания
+    - predict(self, record) -> tuple: Предсказание и вероятности для одной записи
+    - close(self): Остановка фонового потока
+    """
+
+    def __init__(self, predictor: Predictor, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY):
+        """
+        Инициализация класса MicroBatcher
+
+        Параметры:
+        - predictor (Predictor): Классификатор модели
+        - max_batch_size (int): Максимальный размер пачки
+        - max_delay (float): Окно накопления запросов в секундах
+        """
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        # Поток запускается при первом запросе, поэтому объект можно создавать до fork процессов-обработчиков
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            records, futures = zip(*batch)
+            try:
+                predictions, probabilities = self.predictor.predict_batch(list(records))
+            except Exception as e:
+                # Ошибочная запись не должна ронять соседние запросы: пачка повторяется по одной записи
+                logging.warning(f'MicroBatcher: Batch prediction failed, retrying one by one: {e}')
+                for record, future in batch:
+                    try:
+                        prediction, probability = self.predictor.predict_batch([record])
+                        future.set_result((prediction[0], probability[0]))
+                    except Exception as record_error:
+                        future.set_exception(record_error)
+                continue
+            for future, prediction, probability in zip(futures, predictions, probabilities):
+                future.set_result((prediction, probability))
+
+    def submit(self, record: dict) -> Future:
+        """
+        Постановка записи в очередь предсказания
+
+        Параметры:
+        - record (dict): Признаки и клинические данные
+
+        Возвращает:
+        - future (Future): Результат (класс, вероятности классов)
+        """
+        future = Future()
+        self._start()
+        self._queue.put((record, future))
+        return future
+
+    def predict(self, record: dict) -> tuple:
+        """
+        Предсказание для одной записи через общую пачку
+
+        Параметры:
+        - record (dict): Признаки и клинические данные
+
+        Возвращает:
+        - prediction: Предсказанный класс
+        - probabilities (np.ndarray): Вероятности классов
+        """
+        return self.submit(record).result()
+
+    def close(self) -> None:
+        """
+        Остановка фонового потока после обработки уже поставленных запросов
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
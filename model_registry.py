@@ -0,0 +1,178 @@
+import glob
+import logging
+import os
+import threading
+import time
+from feature_extracting import FeatureExtractor
+from memory_monitoring import get_rss
+from micro_batching import MicroBatcher
+from preprocessing import Preprocessor
+from predicting import Predictor
+from tree_ensemble import TREES_SUFFIX
+
+PARAMS_SUFFIX = '_extracting_params.yaml'
+MODEL_SUFFIX = '_model.joblib'
+
+
+class RegisteredModel:
+    """
+    Класс RegisteredModel хранит загруженные объекты одной модели
+
+    Атрибуты:
+    - name (str): Название модели
+    - backend (str): Реализация извлечения признаков
+    - workers (int): Количество процессов для вычисления классов признаков одного случая
+    - feature_extractor (FeatureExtractor): Экстрактор признаков модели
+    - predictor (Predictor): Классификатор модели
+    - batcher (MicroBatcher): Объединение одновременных запросов предсказания в пачки
+    - mtimes (tuple): Время изменения файлов параметров, модели и экспортированных деревьев на момент загрузки
+    - load_time (float): Время загрузки в секундах
+    - memory (int): Прирост резидентной памяти процесса при загрузке в байтах
+    """
+
+    def __init__(self, name: str, mtimes: tuple, backend='pyradiomics', workers=1):
+        """
+        Загрузка экстрактора признаков и классификатора модели
+
+        Параметры:
+        - name (str): Название модели
+        - mtimes (tuple): Время изменения файлов параметров, модели и экспортированных деревьев
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+        - workers (int): Количество процессов для вычисления классов признаков одного случая, None - авто
+        """
+        logging.info(f'Registry: Loading model {name}')
+        rss_before = get_rss()
+        start = time.perf_counter()
+        self.name = name
+        self.backend = backend
+        self.workers = workers
+        self.feature_extractor = FeatureExtractor(name, desired_order_bool=False, backend=backend, workers=workers)
+        self.predictor = Predictor(name)
+        self.batcher = MicroBatcher(self.predictor)
+        self.load_time = time.perf_counter() - start
+        self.memory = max(get_rss() - rss_before, 0)
+        self.mtimes = mtimes
+        logging.info(f'Registry: Model {name} loaded in {self.load_time:.3f} s, {self.memory / 2 ** 20:.1f} MiB')
+
+
+class ModelRegistry:
+    """
+    Класс ModelRegistry предназначен для однократной загрузки моделей в процессе
+    и их совместного использования сессиями Streamlit и пакетной обработкой
+
+    Атрибуты:
+    - params_dir (str): Папка с параметрами извлечения признаков
+    - models_dir (str): Папка с моделями
+
+    Методы:
+    - __init__(self, params_dir='params', models_dir='models'): Инициализация класса ModelRegistry
+    - available_models(self): Поиск моделей, для которых есть и параметры, и файл модели
+    - get(self, model, backend='pyradiomics', workers=1): Получение загруженной модели, перезагрузка при изменении файлов
+    - preprocessor(self, mri_modality): Получение предобработчика для модальности
+    - report(self): Время загрузки и объем памяти загруженных моделей
+    """
+
+    def __init__(self, params_dir='params', models_dir='models'):
+        """
+        Инициализация класса ModelRegistry
+
+        Параметры:
+        - params_dir (str): Папка с параметрами извлечения признаков
+        - models_dir (str): Папка с моделями
+        """
+        self.params_dir = params_dir
+        self.models_dir = models_dir
+        self._models = {}
+        self._preprocessors = {}
+        self._lock = threading.Lock()
+        # Блокировки загрузки по ключу модели: загрузка одной модели не задерживает обращения к другим
+        self._loading = {}
+
+    def _mtimes(self, model: str) -> tuple:
+        # Файлы параметров и модели обязательны, экспортированные деревья - нет (None, если их нет)
+        mtimes = tuple(os.path.getmtime(path) for path in (os.path.join(self.params_dir, model + PARAMS_SUFFIX),
+                                                            os.path.join(self.models_dir, model + MODEL_SUFFIX)))
+        trees_path = os.path.join(self.models_dir, model + TREES_SUFFIX)
+        return mtimes + (os.path.getmtime(trees_path) if os.path.isfile(trees_path) else None,)
+
+    def available_models(self) -> list:
+        """
+        Поиск моделей, для которых есть и параметры извлечения признаков, и файл модели
+
+        Возвращает:
+        - models (list): Отсортированный список названий моделей
+        """
+        params = {os.path.basename(path)[:-len(PARAMS_SUFFIX)]
+                  for path in glob.glob(os.path.join(self.params_dir, '*' + PARAMS_SUFFIX))}
+        models = {os.path.basename(path)[:-len(MODEL_SUFFIX)]
+                  for path in glob.glob(os.path.join(self.models_dir, '*' + MODEL_SUFFIX))}
+        return sorted(params & models)
+
+    def get(self, model: str, backend='pyradiomics', workers=1) -> RegisteredModel:
+        """
+        Получение загруженной модели. Модель загружается при первом обращении
+        и перезагружается, если изменилось время модификации файлов параметров, модели или экспортированных
+        деревьев. Загрузка выполняется под блокировкой своего ключа, обращения к другим моделям ее не ждут
+
+        Параметры:
+        - model (str): Название модели
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+        - workers (int): Количество процессов для вычисления классов признаков одного случая, None - авто
+
+        Возвращает:
+        - registered_model (RegisteredModel): Загруженная модель
+        """
+        try:
+            mtimes = self._mtimes(model)
+        except (OSError, TypeError):
+            logging.error('Registry: Model not found')
+            raise ValueError('Registry: Model not found')
+
+        key = (model, backend, workers)
+        with self._lock:
+            registered_model = self._models.get(key)
+            if registered_model is not None and registered_model.mtimes == mtimes:
+                return registered_model
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            # Модель могла загрузить другая сессия, пока эта ждала блокировку
+            with self._lock:
+                registered_model = self._models.get(key)
+            if registered_model is None or registered_model.mtimes != mtimes:
+                if registered_model is not None:
+                    logging.info(f'Registry: Model {model} files changed, reloading')
+                registered_model = RegisteredModel(model, mtimes, backend, workers)
+                with self._lock:
+                    self._models[key] = registered_model
+        return registered_model
+
+    def preprocessor(self, mri_modality: str) -> Preprocessor:
+        """
+        Получение предобработчика для модальности, создаваемого один раз
+
+        Параметры:
+        - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+
+        Возвращает:
+        - preprocessor (Preprocessor): Предобработчик
+        """
+        with self._lock:
+            if mri_modality not in self._preprocessors:
+                self._preprocessors[mri_modality] = Preprocessor(mri_modality=mri_modality)
+            return self._preprocessors[mri_modality]
+
+    def report(self) -> dict:
+        """
+        Время загрузки и прирост памяти для загруженных моделей
+
+        Возвращает:
+        - report (dict): Словарь {(модель, реализация, процессы): {'load_time': секунды, 'memory': байты}}
+        """
+        with self._lock:
+            return {key: {'load_time': entry.load_time, 'memory': entry.memory}
+                    for key, entry in self._models.items()}
+
+
+# Общий реестр процесса: один на все сессии Streamlit и на каждый процесс пакетной обработки
+model_registry = ModelRegistry()
@@ -0,0 +1,295 @@
+from __future__ import annotations
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from lazy_importing import lazy_import
+from model_registry import model_registry
+from parallel_feature_extracting import START_METHOD
+from preprocessing import CROP_MARGIN
+from tracing import annotate, traced
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+
+# Режимы поиска образований: 'labels' - каждая метка маски, 'components' - связные компоненты бинарной маски,
+# 'auto' - метки, если в маске больше одной метки, иначе связные компоненты
+LESION_MODES = ('auto', 'labels', 'components')
+# Образования меньше этого числа вокселей считаются шумом разметки
+MIN_LESION_VOXELS = 10
+LESION_COLUMNS = ['lesion', 'voxels', 'volume_mm3', 'center_x', 'center_y', 'center_z', 'prediction',
+                  'probability', 'error']
+
+
+def _init_worker(model: str, backend: str) -> None:
+    """
+    Инициализация процесса-обработчика: экстрактор признаков загружается один раз на процесс
+
+    Параметры:
+    - model (str): Название модели
+    - backend (str): Реализация извлечения признаков
+    """
+    logging.info('MultiLesion: Initializing worker')
+    model_registry.get(model, backend)
+
+
+def _extract_lesion(model: str, backend: str, image: sitk.Image, mask: sitk.Image) -> dict:
+    """
+    Извлечение признаков одного образования (выполняется в процессе пула или в текущем процессе)
+
+    Параметры:
+    - model (str): Название модели
+    - backend (str): Реализация извлечения признаков
+    - image (sitk.Image): Изображение, обрезанное по образованию
+    - mask (sitk.Image): Маска образования с меткой 1
+
+    Возвращает:
+    - features (dict): Признаки образования
+    """
+    return model_registry.get(model, backend).feature_extractor.extract_features(image, mask)
+
+
+class MultiLesionProcessor:
+    """
+    Класс MultiLesionProcessor предназначен для обработки случая с несколькими образованиями за один проход:
+    изображение читается, нормализуется и ресэмплируется один раз, образования находятся по меткам маски
+    или по связным компонентам, признаки каждого образования извлекаются из его области (параллельно
+    по образованиям), предсказания выполняются одним вызовом классификатора
+
+    Атрибуты:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - backend (str): Реализация извлечения признаков
+    - workers (int): Количество процессов для извлечения признаков образований
+    - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+    - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+    - mode (str): Режим поиска образований
+    - min_size (int): Минимальный размер образования в вокселях
+
+    Методы:
+    - __init__(self, model, mri_modality='T2', backend='pyradiomics', workers=1, normalize=True, resample=False,
+      mode='auto', min_size=MIN_LESION_VOXELS): Инициализация класса MultiLesionProcessor
+    - find_lesions(mask, mode='auto', min_size=MIN_LESION_VOXELS) -> tuple: Поиск образований
+    - crop(image, label_image, lesion) -> tuple: Область одного образования
+    - process(self, image_path, mask_path, clinical_data) -> list: Результаты по образованиям
+    - shutdown(self): Остановка пула процессов
+    """
+
+    def __init__(self, model: str, mri_modality='T2', backend='pyradiomics', workers=1, normalize=True,
+                 resample=False, mode='auto', min_size=MIN_LESION_VOXELS):
+        """
+        Инициализация класса MultiLesionProcessor
+
+        Параметры:
+        - model (str): Название модели
+        - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy'
+        - workers (int): Количество процессов для извлечения признаков образований, None - число ядер
+        - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+        - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        - mode (str): Режим поиска образований: 'auto', 'labels' или 'components'
+        - min_size (int): Минимальный размер образования в вокселях
+        """
+        logging.info('MultiLesion: Initializing MultiLesionProcessor class')
+        if mode not in LESION_MODES:
+            logging.error('MultiLesion: Unknown lesion mode')
+            raise ValueError(f'MultiLesion: Unknown lesion mode, choose one of {LESION_MODES}')
+        self.model = model
+        self.mri_modality = mri_modality
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        if self.workers < 1:
+            logging.error('MultiLesion: Workers must be positive')
+            raise ValueError('MultiLesion: Workers must be positive')
+        self.normalize = normalize
+        self.resample = resample
+        self.mode = mode
+        self.min_size = min_size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Пул создается при первом случае с несколькими образованиями и переиспользуется
+        with self._lock:
+            if self._executor is None:
+                logging.info(f'MultiLesion: Starting {self.workers} workers')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(START_METHOD),
+                                                     initializer=_init_worker, initargs=(self.model, self.backend))
+            return self._executor
+
+    @staticmethod
+    def find_lesions(mask: sitk.Image, mode='auto', min_size=MIN_LESION_VOXELS) -> tuple:
+        """
+        Поиск образований в маске: метки или связные компоненты и их границы за один проход статистики меток
+
+        Параметры:
+        - mask (sitk.Image): Маска
+        - mode (str): Режим поиска: 'auto', 'labels' или 'components'
+        - min_size (int): Минимальный размер образования в вокселях
+
+        Возвращает:
+        - label_image (sitk.Image): Маска меток образований
+        - lesions (list): Образования по убыванию размера: словари с ключами label, voxels, volume_mm3,
+          bounding_box (начало x, y, z, размер x, y, z) и center (физические координаты центра масс)
+        """
+        if mask.GetPixelID() in (sitk.sitkFloat32, sitk.sitkFloat64):
+            mask = sitk.Cast(mask, sitk.sitkUInt16)
+        statistics = sitk.LabelShapeStatisticsImageFilter()
+        statistics.ComputePerimeterOff()
+        statistics.Execute(mask)
+        label_image = mask
+        if mode == 'components' or mode == 'auto' and len(statistics.GetLabels()) <= 1:
+            # Связные компоненты с 26-соседством: касающиеся по ребру или вершине воксели - одно образование
+            label_image = sitk.ConnectedComponent(mask != 0, True)
+            statistics.Execute(label_image)
+
+        voxel_volume = float(np.prod(mask.GetSpacing()))
+        lesions = [{
+            'label': label,
+            'voxels': statistics.GetNumberOfPixels(label),
+            'volume_mm3': statistics.GetNumberOfPixels(label) * voxel_volume,
+            'bounding_box': statistics.GetBoundingBox(label),
+            'center': statistics.GetCentroid(label)
+        } for label in statistics.GetLabels() if statistics.GetNumberOfPixels(label) >= min_size]
+        lesions.sort(key=lambda lesion: -lesion['voxels'])
+        logging.info(f'MultiLesion: Found {len(lesions)} lesions')
+        return label_image, lesions
+
+    @staticmethod
+    def crop(image: sitk.Image, label_image: sitk.Image, lesion: dict, margin=CROP_MARGIN) -> tuple:
+        """
+        Область одного образования: изображение и маска обрезаются по границам образования с отступом,
+        в маске остается только это образование с меткой 1
+
+        Параметры:
+        - image (sitk.Image): Предобработанное изображение
+        - label_image (sitk.Image): Маска меток образований
+        - lesion (dict): Образование из find_lesions
+        - margin (int): Отступ вокруг образования в вокселях
+
+        Возвращает:
+        - image (sitk.Image): Обрезанное изображение
+        - mask (sitk.Image): Бинарная маска образования
+        """
+        start, size = lesion['bounding_box'][:3], lesion['bounding_box'][3:]
+        region = tuple(slice(max(start[i] - margin, 0), min(start[i] + size[i] + margin, image.GetSize()[i]))
+                       for i in range(3))
+        return image[region], sitk.Cast(label_image[region] == lesion['label'], sitk.sitkUInt8)
+
+    @traced('lesions')
+    def process(self, image_path, mask_path, clinical_data: dict) -> list:
+        """
+        Обработка случая с несколькими образованиями
+
+        Параметры:
+        - image_path (str | sitk.Image): Путь к изображению или изображение
+        - mask_path (str | sitk.Image): Путь к маске или маска с несколькими метками или компонентами
+        - clinical_data (dict): Клинические данные пациента
+
+        Возвращает:
+        - rows (list): Результаты по образованиям (словари со столбцами LESION_COLUMNS)
+        """
+        image, mask = model_registry.preprocessor(self.mri_modality).preprocessing_step(
+            image_path, mask_path, normalize=self.normalize, resample=self.resample
+        )
+        if (mask.GetSize(), mask.GetSpacing(), mask.GetOrigin(), mask.GetDirection()) != \
+                (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()):
+            # Границы образований используются как индексы изображения, поэтому маска переносится на сетку
+            # изображения до поиска образований, как correctMask
+            logging.info('MultiLesion: Resampling mask to image grid')
+            mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor)
+        label_image, lesions = self.find_lesions(mask, self.mode, self.min_size)
+        annotate(lesions=len(lesions))
+        crops = [self.crop(image, label_image, lesion) for lesion in lesions]
+
+        if self.workers > 1 and len(lesions) > 1:
+            executor = self._pool()
+            futures = [executor.submit(_extract_lesion, self.model, self.backend, *crop) for crop in crops]
+        else:
+            futures = None
+
+        rows, records = [], []
+        for index, (lesion, crop) in enumerate(zip(lesions, crops)):
+            row = {'lesion': lesion['label'], 'voxels': lesion['voxels'], 'volume_mm3': lesion['volume_mm3'],
+                   'center_x': lesion['center'][0], 'center_y': lesion['center'][1],
+                   'center_z': lesion['center'][2], 'prediction': None, 'probability': None, 'error': ''}
+            try:
+                features = futures[index].result() if futures else _extract_lesion(self.model, self.backend, *crop)
+                records.append((row, features | clinical_data))
+            except Exception as e:
+                # Ошибка одного образования не прерывает обработку остальных
+                logging.error(f'MultiLesion: Lesion {lesion["label"]} failed: {e}')
+                row['error'] = repr(e)
+            rows.append(row)
+
+        if records:
+            predictions, probabilities = model_registry.get(self.model, self.backend).predictor.predict_batch(
+                [record for _, record in records]
+            )
+            for (row, _), prediction, probability in zip(records, predictions, probabilities):
+                row['prediction'] = int(prediction)
+                row['probability'] = float(probability[-1])
+        return rows
+
+    def shutdown(self) -> None:
+        """
+        Остановка пула процессов
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def write_results(rows: list, output_path: str) -> None:
+    """
+    Запись таблицы результатов по образованиям
+
+    Параметры:
+    - rows (list): Результаты MultiLesionProcessor.process
+    - output_path (str): Путь к CSV-таблице
+    """
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=LESION_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    from batch_processing import read_clinical_data
+
+    parser = argparse.ArgumentParser(description='Per-lesion prediction for a case with several lesions')
+    parser.add_argument('image', help='Image file')
+    parser.add_argument('mask', help='Mask with one label per lesion, or a binary mask with separate lesions')
+    parser.add_argument('clinical', help='Clinical data file, e.g. "Age: 64, Sex: M, Manufacturer: Philips"')
+    parser.add_argument('output', help='CSV table with one row per lesion')
+    parser.add_argument('--model', default='liver_t2w_xgboost')
+    parser.add_argument('--modality', default='T2', choices=['T1', 'T2'])
+    parser.add_argument('--mode', default='auto', choices=LESION_MODES)
+    parser.add_argument('--min-size', type=int, default=MIN_LESION_VOXELS, help='Smallest lesion in voxels')
+    parser.add_argument('--workers', type=int, default=None, help='Processes across lesions (default: all cores)')
+    parser.add_argument('--backend', default='pyradiomics', choices=['pyradiomics', 'numpy'])
+    parser.add_argument('--no-normalize', action='store_true')
+    parser.add_argument('--resample', action='store_true')
+    args = parser.parse_args()
+
+    processor = MultiLesionProcessor(args.model, mri_modality=args.modality, backend=args.backend,
+                                     workers=args.workers, normalize=not args.no_normalize, resample=args.resample,
+                                     mode=args.mode, min_size=args.min_size)
+    try:
+        rows = processor.process(args.image, args.mask, read_clinical_data(args.clinical))
+    finally:
+        processor.shutdown()
+    write_results(rows, args.output)
+    positive = sum(row['prediction'] == 1 for row in rows)
+    failed = sum(bool(row['error']) for row in rows)
+    logging.info(f'MultiLesion: {len(rows)} lesions written to {args.output}, {positive} positive, {failed} failed')
+
+
+if __name__ == "__main__":
+    logging.info('MultiLesion: Multi-lesion processing started')
+    main()
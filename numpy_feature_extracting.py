@@ -0,0 +1,530 @@
+import itertools
+import logging
+import sys
+import numpy as np
+import SimpleITK as sitk
+from scipy import sparse
+from scipy.sparse import csgraph
+from radiomics import featureextractor, imageoperations
+
+EPS = np.spacing(1)
+# Направления соседства для расстояния 1: 26 соседей и 13 направлений без учета знака
+NEIGHBOUR_OFFSETS = np.array([offset for offset in itertools.product((-1, 0, 1), repeat=3) if any(offset)])
+# Настройки pyradiomics, при которых результат совпадает с реализацией на NumPy
+SUPPORTED_SETTINGS = {
+    'normalize': False,
+    'resampledPixelSpacing': None,
+    'removeOutliers': None,
+    'resegmentRange': None,
+    'force2D': False,
+    'weightingNorm': None,
+    'voxelArrayShift': 0,
+    'distances': [1],
+}
+
+
+def _firstorder(values: np.ndarray, counts: np.ndarray) -> dict:
+    p = counts / counts.sum()
+    variance = np.nanstd(values) ** 2
+    return {
+        'Energy': lambda: np.nansum(values ** 2),
+        'Entropy': lambda: -np.sum(p * np.log2(p + EPS)),
+        'Minimum': lambda: np.nanmin(values),
+        'Maximum': lambda: np.nanmax(values),
+        'Mean': lambda: np.nanmean(values),
+        'Median': lambda: np.nanmedian(values),
+        'Range': lambda: np.nanmax(values) - np.nanmin(values),
+        'StandardDeviation': lambda: np.nanstd(values),
+        'Uniformity': lambda: np.sum(p ** 2),
+        'Variance': lambda: variance,
+    }
+
+
+def _glcm(p_glcm: np.ndarray, gray_levels: np.ndarray) -> dict:
+    # p_glcm: (углы, Ng, Ng), уже нормированная по каждому углу
+    i, j = np.meshgrid(gray_levels, gray_levels, indexing='ij', sparse=True)
+    ux = np.sum(i * p_glcm, (1, 2), keepdims=True)
+    uy = np.sum(j * p_glcm, (1, 2), keepdims=True)
+
+    def correlation():
+        sigx = np.sum(p_glcm * (i - ux) ** 2, (1, 2), keepdims=True) ** 0.5
+        sigy = np.sum(p_glcm * (j - uy) ** 2, (1, 2), keepdims=True) ** 0.5
+        corm = np.sum(p_glcm * (i - ux) * (j - uy), (1, 2), keepdims=True)
+        corr = corm / (sigx * sigy + EPS)
+        corr[sigx * sigy == 0] = 1
+        return np.nanmean(corr)
+
+    return {
+        'Contrast': lambda: np.nanmean(np.sum(p_glcm * (i - j) ** 2, (1, 2))),
+        'Correlation': correlation,
+        'JointAverage': lambda: np.nanmean(ux),
+        'JointEnergy': lambda: np.nanmean(np.sum(p_glcm ** 2, (1, 2))),
+        'JointEntropy': lambda: np.nanmean(-np.sum(p_glcm * np.log2(p_glcm + EPS), (1, 2))),
+        'SumSquares': lambda: np.nanmean(np.sum(p_glcm * (i - ux) ** 2, (1, 2))),
+    }
+
+
+def _gldm(p_gldm: np.ndarray, gray_levels: np.ndarray) -> dict:
+    # p_gldm: (Ng, размер зависимости)
+    jvector = np.arange(1, p_gldm.shape[1] + 1, dtype=np.float64)
+    pd = p_gldm.sum(0)
+    pg = p_gldm.sum(1)
+    non_empty = pd != 0
+    p_gldm, jvector, pd = p_gldm[:, non_empty], jvector[non_empty], pd[non_empty]
+    nz = pd.sum() or 1
+    i = gray_levels[:, None]
+    return {
+        'DependenceNonUniformity': lambda: np.sum(pd ** 2) / nz,
+        'DependenceNonUniformityNormalized': lambda: np.sum(pd ** 2) / nz ** 2,
+        'GrayLevelNonUniformity': lambda: np.sum(pg ** 2) / nz,
+        'HighGrayLevelEmphasis': lambda: np.sum(pg * gray_levels ** 2) / nz,
+        'LargeDependenceEmphasis': lambda: np.sum(pd * jvector ** 2) / nz,
+        'LargeDependenceLowGrayLevelEmphasis': lambda: np.sum(p_gldm * jvector ** 2 / i ** 2) / nz,
+        'LowGrayLevelEmphasis': lambda: np.sum(pg / gray_levels ** 2) / nz,
+        'SmallDependenceEmphasis': lambda: np.sum(pd / jvector ** 2) / nz,
+    }
+
+
+def _glrlm(p_glrlm: np.ndarray, gray_levels: np.ndarray) -> dict:
+    # p_glrlm: (углы, Ng, длина серии)
+    nr = p_glrlm.sum((1, 2))
+    non_empty_angles = nr != 0
+    if len(nr) > 1 and not non_empty_angles.all():
+        p_glrlm, nr = p_glrlm[non_empty_angles], nr[non_empty_angles]
+    nr = np.where(nr == 0, np.nan, nr)
+    pr = p_glrlm.sum(1)
+    pg = p_glrlm.sum(2)
+    jvector = np.arange(1, p_glrlm.shape[2] + 1, dtype=np.float64)
+    non_empty = pr.sum(0) != 0
+    p_glrlm, jvector, pr = p_glrlm[:, :, non_empty], jvector[non_empty], pr[:, non_empty]
+    i = gray_levels[:, None]
+    return {
+        'GrayLevelNonUniformity': lambda: np.nanmean(np.sum(pg ** 2, 1) / nr),
+        'LongRunEmphasis': lambda: np.nanmean(np.sum(pr * jvector ** 2, 1) / nr),
+        'LongRunLowGrayLevelEmphasis': lambda: np.nanmean(np.sum(p_glrlm * jvector ** 2 / i ** 2, (1, 2)) / nr),
+        'LowGrayLevelRunEmphasis': lambda: np.nanmean(np.sum(pg / gray_levels ** 2, 1) / nr),
+        'RunLengthNonUniformity': lambda: np.nanmean(np.sum(pr ** 2, 1) / nr),
+        'ShortRunEmphasis': lambda: np.nanmean(np.sum(pr / jvector ** 2, 1) / nr),
+    }
+
+
+def _glszm(p_glszm: np.ndarray, gray_levels: np.ndarray) -> dict:
+    # p_glszm: (Ng, размер зоны)
+    ps = p_glszm.sum(0)
+    pg = p_glszm.sum(1)
+    jvector = np.arange(1, p_glszm.shape[1] + 1, dtype=np.float64)
+    nz = p_glszm.sum() or 1
+    non_empty = ps != 0
+    p_glszm, jvector, ps = p_glszm[:, non_empty], jvector[non_empty], ps[non_empty]
+
+    def zone_entropy():
+        p = p_glszm / nz
+        return -np.sum(p * np.log2(p + EPS))
+
+    return {
+        'GrayLevelNonUniformity': lambda: np.sum(pg ** 2) / nz,
+        'HighGrayLevelZoneEmphasis': lambda: np.sum(pg * gray_levels ** 2) / nz,
+        'LargeAreaEmphasis': lambda: np.sum(ps * jvector ** 2) / nz,
+        'LowGrayLevelZoneEmphasis': lambda: np.sum(pg / gray_levels ** 2) / nz,
+        'SizeZoneNonUniformity': lambda: np.sum(ps ** 2) / nz,
+        'SmallAreaEmphasis': lambda: np.sum(ps / jvector ** 2) / nz,
+        'ZoneEntropy': zone_entropy,
+    }
+
+
+def _ngtdm(p_ngtdm: np.ndarray) -> dict:
+    # p_ngtdm: (Ng, 3) со столбцами n_i, s_i, i; уровни без вокселей удалены
+    p_ngtdm = p_ngtdm[p_ngtdm[:, 0] != 0]
+    nvp = p_ngtdm[:, 0].sum()
+    p_i = p_ngtdm[:, 0] / nvp
+    s_i = p_ngtdm[:, 1]
+    i = p_ngtdm[:, 2]
+
+    def coarseness():
+        sum_coarse = np.sum(p_i * s_i)
+        return 1 / sum_coarse if sum_coarse != 0 else 1e6
+
+    def complexity():
+        pi_si = p_i * s_i
+        divisor = p_i[:, None] + p_i[None, :]
+        divisor[divisor == 0] = 1
+        return np.sum(np.abs(i[:, None] - i[None, :]) * (pi_si[:, None] + pi_si[None, :]) / divisor) / nvp
+
+    return {
+        'Coarseness': coarseness,
+        'Complexity': complexity,
+    }
+
+
+FEATURE_FUNCTIONS = {
+    'firstorder': _firstorder,
+    'glcm': _glcm,
+    'gldm': _gldm,
+    'glrlm': _glrlm,
+    'glszm': _glszm,
+    'ngtdm': _ngtdm,
+}
+SUPPORTED_FEATURES = {
+    'firstorder': {'Energy', 'Entropy', 'Minimum', 'Maximum', 'Mean', 'Median', 'Range', 'StandardDeviation',
+                   'Uniformity', 'Variance'},
+    'glcm': {'Contrast', 'Correlation', 'JointAverage', 'JointEnergy', 'JointEntropy', 'SumSquares'},
+    'gldm': {'DependenceNonUniformity', 'DependenceNonUniformityNormalized', 'GrayLevelNonUniformity',
+             'HighGrayLevelEmphasis', 'LargeDependenceEmphasis', 'LargeDependenceLowGrayLevelEmphasis',
+             'LowGrayLevelEmphasis', 'SmallDependenceEmphasis'},
+    'glrlm': {'GrayLevelNonUniformity', 'LongRunEmphasis', 'LongRunLowGrayLevelEmphasis', 'LowGrayLevelRunEmphasis',
+              'RunLengthNonUniformity', 'ShortRunEmphasis'},
+    'glszm': {'GrayLevelNonUniformity', 'HighGrayLevelZoneEmphasis', 'LargeAreaEmphasis', 'LowGrayLevelZoneEmphasis',
+              'SizeZoneNonUniformity', 'SmallAreaEmphasis', 'ZoneEntropy'},
+    'ngtdm': {'Coarseness', 'Complexity'},
+}
+
+
+class NumpyFeatureExtractor:
+    """
+    Класс NumpyFeatureExtractor предназначен для извлечения признаков, включенных в файле параметров,
+    векторизованными вычислениями NumPy. Изображение дискретизируется один раз, затем строятся только
+    матрицы, нужные включенным признакам. Признаки, которые не реализованы, считаются pyradiomics.
+    Ключи и значения совпадают с RadiomicsFeatureExtractor.execute (без диагностик)
+
+    Атрибуты:
+    - extractor (RadiomicsFeatureExtractor): Экстрактор pyradiomics с параметрами модели
+    - settings (dict): Настройки извлечения признаков
+    - numpy_features (dict): Признаки по классам, вычисляемые на NumPy
+    - fallback_features (dict): Признаки по классам, вычисляемые pyradiomics
+
+    Методы:
+    - __init__(self, extractor): Инициализация класса NumpyFeatureExtractor
+    - execute(self, image, mask): Извлечение признаков из изображения и маски
+    - execute_bin_counts(self, image, mask, bin_counts) -> list: Признаки для нескольких чисел интервалов
+    """
+
+    def __init__(self, extractor: featureextractor.RadiomicsFeatureExtractor):
+        """
+        Инициализация класса NumpyFeatureExtractor
+
+        Параметры:
+        - extractor (RadiomicsFeatureExtractor): Экстрактор pyradiomics с загруженными параметрами модели
+        """
+        logging.info('NumpyExtractor: Initializing NumpyFeatureExtractor class')
+        self.extractor = extractor
+        self.settings = extractor.settings
+        self.numpy_features = {}
+        self.fallback_features = {}
+
+        supported_settings = (
+            all(self.settings.get(key, value) == value for key, value in SUPPORTED_SETTINGS.items())
+            and list(extractor.enabledImagetypes) == ['Original'] and not extractor.enabledImagetypes['Original']
+        )
+        for feature_class, names in extractor.enabledFeatures.items():
+            supported = SUPPORTED_FEATURES.get(feature_class, set()) if supported_settings else set()
+            if names:
+                self.numpy_features[feature_class] = [name for name in names if name in supported]
+                fallback = [name for name in names if name not in supported]
+            else:
+                # Пустой список означает все признаки класса
+                fallback = names
+            if fallback != []:
+                self.fallback_features[feature_class] = fallback
+
+        self.fallback_extractor = None
+        self._bin_count_extractors = {}
+        if self.fallback_features:
+            logging.info(f'NumpyExtractor: Falling back to pyradiomics for {self.fallback_features}')
+            self.fallback_extractor = featureextractor.RadiomicsFeatureExtractor(dict(
+                setting=self.settings,
+                imageType=extractor.enabledImagetypes,
+                featureClass=self.fallback_features,
+            ))
+
+    def _with_bin_count(self, extractor: featureextractor.RadiomicsFeatureExtractor, bin_count):
+        # Экстрактор pyradiomics с другим числом интервалов дискретизации, создается один раз на число
+        if bin_count is None or bin_count == extractor.settings.get('binCount'):
+            return extractor
+        key = (id(extractor), bin_count)
+        if key not in self._bin_count_extractors:
+            self._bin_count_extractors[key] = featureextractor.RadiomicsFeatureExtractor(dict(
+                setting=dict(extractor.settings, binCount=bin_count),
+                imageType=extractor.enabledImagetypes,
+                featureClass=extractor.enabledFeatures,
+            ))
+        return self._bin_count_extractors[key]
+
+    def _roi(self, image: sitk.Image, mask: sitk.Image) -> tuple:
+        """
+        Обрезка изображения по маске и проверки области интереса
+
+        Возвращает:
+        - values (np.ndarray): Исходные значения вокселей маски
+        - roi (np.ndarray): Маска, обрезанная по границам области
+        """
+        roi = sitk.GetArrayViewFromImage(mask) == self.settings.get('label', 1)
+        bounds = [np.flatnonzero(roi.any(axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+        if any(bound.size == 0 for bound in bounds):
+            logging.error('NumpyExtractor: Label not found in mask')
+            raise ValueError('NumpyExtractor: Label not found in mask')
+        box = tuple(slice(bound[0], bound[-1] + 1) for bound in bounds)
+        roi = roi[box]
+        # Те же проверки области интереса, что и в imageoperations.checkMask
+        if sum(size > 1 for size in roi.shape) < self.settings.get('minimumROIDimensions', 2):
+            logging.error('NumpyExtractor: ROI has too few dimensions')
+            raise ValueError('NumpyExtractor: ROI has too few dimensions')
+        if np.count_nonzero(roi) <= (self.settings.get('minimumROISize') or 0):
+            logging.error('NumpyExtractor: ROI is too small')
+            raise ValueError('NumpyExtractor: ROI is too small')
+        return sitk.GetArrayViewFromImage(image)[box][roi], roi
+
+    @staticmethod
+    def _discretize(values: np.ndarray, roi: np.ndarray, settings: dict) -> tuple:
+        """
+        Дискретизация уровней серого внутри маски
+
+        Возвращает:
+        - matrix (np.ndarray): Дискретизированное изображение с полем 1 воксель, 0 вне маски
+        - gray_levels (np.ndarray): Уровни серого, присутствующие в маске
+        """
+        bin_edges = imageoperations.getBinEdges(values, **settings)
+        matrix = np.zeros(np.array(roi.shape) + 2, dtype=np.int32)
+        matrix[1:-1, 1:-1, 1:-1][roi] = np.digitize(values, bin_edges)
+        gray_levels = np.unique(matrix[1:-1, 1:-1, 1:-1][roi])
+        return matrix, gray_levels
+
+    @staticmethod
+    def _neighbours(roi: np.ndarray, offsets: np.ndarray) -> tuple:
+        """
+        Плоские индексы вокселей маски и их соседей по заданным смещениям в изображении с полем 1 воксель.
+        Зависят только от маски, уровни серого любой дискретизации выбираются по ним одной индексацией
+
+        Возвращает:
+        - flat_index (np.ndarray): Плоские индексы вокселей маски, форма (N,)
+        - neighbour_index (np.ndarray): Плоские индексы соседей, форма (смещения, N)
+        - flat_offsets (np.ndarray): Плоские смещения
+        """
+        shape = np.array(roi.shape) + 2
+        padded = np.zeros(shape, dtype=bool)
+        padded[1:-1, 1:-1, 1:-1] = roi
+        flat_index = np.flatnonzero(padded)
+        flat_offsets = offsets @ np.array([shape[1] * shape[2], shape[2], 1])
+        return flat_index, flat_index[None, :] + flat_offsets[:, None], flat_offsets
+
+    @staticmethod
+    def _glcm_matrix(centre, angle_neighbours, gray_levels, symmetrical) -> np.ndarray:
+        ng = int(gray_levels[-1])
+        n_angles = len(angle_neighbours)
+        valid = angle_neighbours > 0
+        angle_index = np.broadcast_to(np.arange(n_angles)[:, None], valid.shape)[valid]
+        index = (angle_index * ng + centre[None, :].repeat(n_angles, 0)[valid] - 1) * ng + angle_neighbours[valid] - 1
+        p_glcm = np.bincount(index, minlength=n_angles * ng * ng).reshape(n_angles, ng, ng).astype(np.float64)
+        p_glcm = p_glcm[:, gray_levels - 1][:, :, gray_levels - 1]
+        if symmetrical:
+            p_glcm += p_glcm.transpose(0, 2, 1)
+        sum_p = p_glcm.sum((1, 2))
+        if n_angles > 1 and (sum_p == 0).any():
+            p_glcm, sum_p = p_glcm[sum_p != 0], sum_p[sum_p != 0]
+        sum_p[sum_p == 0] = np.nan
+        return p_glcm / sum_p[:, None, None]
+
+    def _gldm_matrix(self, centre, neighbours, gray_levels) -> np.ndarray:
+        ng = int(gray_levels[-1])
+        alpha = self.settings.get('gldm_a', 0)
+        dependence = np.sum((neighbours > 0) & (np.abs(neighbours - centre[None, :]) <= alpha), 0)
+        n_dependence = len(neighbours) + 1
+        p_gldm = np.bincount((centre - 1) * n_dependence + dependence, minlength=ng * n_dependence)
+        return p_gldm.reshape(ng, n_dependence)[gray_levels - 1].astype(np.float64)
+
+    @staticmethod
+    def _glrlm_matrix(matrix, flat_index, flat_angle_offsets, gray_levels) -> np.ndarray:
+        ng = int(gray_levels[-1])
+        nr = max(np.array(matrix.shape) - 2)
+        flat = matrix.ravel()
+        n_angles = len(flat_angle_offsets)
+        centre = flat[flat_index]
+        # Серия начинается в вокселе, предыдущий воксель которого вдоль направления имеет другой уровень
+        starts = flat[flat_index[None, :] - flat_angle_offsets[:, None]] != centre[None, :]
+        angle = np.broadcast_to(np.arange(n_angles)[:, None], starts.shape)[starts]
+        position = np.broadcast_to(flat_index[None, :], starts.shape)[starts]
+        level = flat[position]
+        run_length = np.ones(len(position), dtype=np.int64)
+
+        # Все серии всех направлений продлеваются одновременно, по одному шагу за итерацию
+        active = np.arange(len(position))
+        while active.size:
+            position[active] += flat_angle_offsets[angle[active]]
+            active = active[flat[position[active]] == level[active]]
+            run_length[active] += 1
+
+        index = (angle * ng + level - 1) * nr + run_length - 1
+        p_glrlm = np.bincount(index, minlength=n_angles * ng * nr).reshape(n_angles, ng, nr).astype(np.float64)
+        return p_glrlm[:, gray_levels - 1]
+
+    @staticmethod
+    def _glszm_matrix(matrix, centre, angle_neighbours, flat_index, flat_angle_offsets, gray_levels) -> np.ndarray:
+        ng = int(gray_levels[-1])
+        ns = len(centre)
+        # Зоны - компоненты связности (26-связность) графа соседних вокселей с одинаковым уровнем серого
+        roi_index = np.full(matrix.size, -1, dtype=np.int64)
+        roi_index[flat_index] = np.arange(ns)
+        same = angle_neighbours == centre[None, :]
+        source = np.broadcast_to(np.arange(ns)[None, :], same.shape)[same]
+        target = roi_index[(flat_index[None, :] + flat_angle_offsets[:, None])[same]]
+        graph = sparse.coo_matrix((np.ones(len(source), dtype=np.int8), (source, target)), shape=(ns, ns))
+        n_zones, zone = csgraph.connected_components(graph, directed=False)
+        zone_size = np.bincount(zone, minlength=n_zones)
+        zone_level = np.zeros(n_zones, dtype=np.int64)
+        zone_level[zone] = centre
+        p_glszm = np.bincount((zone_level - 1) * ns + zone_size - 1, minlength=ng * ns).reshape(ng, ns)
+        return p_glszm[gray_levels - 1].astype(np.float64)
+
+    @staticmethod
+    def _ngtdm_matrix(centre, neighbours, gray_levels) -> np.ndarray:
+        ng = int(gray_levels[-1])
+        valid = neighbours > 0
+        count = valid.sum(0)
+        has_neighbours = count > 0
+        average = np.where(valid, neighbours, 0).sum(0)[has_neighbours] / count[has_neighbours]
+        levels = centre[has_neighbours]
+        p_ngtdm = np.zeros((ng, 3), dtype=np.float64)
+        p_ngtdm[:, 0] = np.bincount(levels - 1, minlength=ng)
+        p_ngtdm[:, 1] = np.bincount(levels - 1, weights=np.abs(levels - average), minlength=ng)
+        p_ngtdm[:, 2] = np.arange(1, ng + 1)
+        return p_ngtdm
+
+    def _compute_numpy_features(self, image: sitk.Image, mask: sitk.Image, bin_counts=(None,)) -> list:
+        """
+        Вычисление поддерживаемых признаков на NumPy для каждого числа интервалов дискретизации:
+        область маски, ее значения и индексы соседей вычисляются один раз
+        """
+        values, roi = self._roi(image, mask)
+        float_values = values.astype(np.float64)
+        flat_index, neighbour_index, flat_offsets = self._neighbours(roi, NEIGHBOUR_OFFSETS)
+        results = []
+        for bin_count in bin_counts:
+            settings = self.settings if bin_count is None else dict(self.settings, binCount=bin_count)
+            matrix, gray_levels = self._discretize(values, roi, settings)
+            results.append(self._compute_discretized_features(float_values, matrix, gray_levels, flat_index,
+                                                              neighbour_index, flat_offsets))
+        return results
+
+    def _compute_discretized_features(self, values, matrix, gray_levels, flat_index, neighbour_index,
+                                      flat_offsets) -> dict:
+        flat = matrix.ravel()
+        centre, neighbours = flat[flat_index], flat[neighbour_index]
+        # Вторая половина смещений соседства - 13 направлений без учета знака
+        angle_neighbours = neighbours[len(neighbours) // 2:]
+        float_levels = gray_levels.astype(np.float64)
+
+        matrices = {
+            'firstorder': lambda: (values, np.unique(centre, return_counts=True)[1]),
+            'glcm': lambda: (self._glcm_matrix(centre, angle_neighbours, gray_levels,
+                                               self.settings.get('symmetricalGLCM', True)), float_levels),
+            'gldm': lambda: (self._gldm_matrix(centre, neighbours, gray_levels), float_levels),
+            'glrlm': lambda: (self._glrlm_matrix(matrix, flat_index, flat_offsets[len(flat_offsets) // 2:],
+                                                 gray_levels), float_levels),
+            'glszm': lambda: (self._glszm_matrix(matrix, centre, angle_neighbours, flat_index,
+                                                 flat_offsets[len(flat_offsets) // 2:], gray_levels), float_levels),
+            'ngtdm': lambda: (self._ngtdm_matrix(centre, neighbours, gray_levels),),
+        }
+
+        features = {}
+        for feature_class, names in self.numpy_features.items():
+            if not names:
+                continue
+            functions = FEATURE_FUNCTIONS[feature_class](*matrices[feature_class]())
+            for name in names:
+                features[f'original_{feature_class}_{name}'] = float(functions[name]())
+        return features
+
+    def _geometry_matches(self, image: sitk.Image, mask: sitk.Image) -> bool:
+        return (image.GetSize() == mask.GetSize()
+                and np.allclose(image.GetOrigin(), mask.GetOrigin())
+                and np.allclose(image.GetSpacing(), mask.GetSpacing())
+                and np.allclose(image.GetDirection(), mask.GetDirection()))
+
+    def execute(self, image: sitk.Image, mask: sitk.Image) -> dict:
+        """
+        Извлечение признаков из изображения и маски
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - mask (sitk.Image): Входная маска
+
+        Возвращает:
+        - features (dict): Признаки в порядке pyradiomics
+        """
+        return self.execute_bin_counts(image, mask, [None])[0]
+
+    def execute_bin_counts(self, image: sitk.Image, mask: sitk.Image, bin_counts) -> list:
+        """
+        Извлечение признаков для нескольких чисел интервалов дискретизации (binCount) одной маски:
+        обрезка, проверки области и индексы соседей выполняются один раз, повторяются только
+        дискретизация и матрицы текстурных признаков
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - mask (sitk.Image): Входная маска
+        - bin_counts (list): Числа интервалов, None - значение из файла параметров
+
+        Возвращает:
+        - features (list): Признаки в порядке pyradiomics для каждого числа интервалов
+        """
+        if not self._geometry_matches(image, mask):
+            logging.info('NumpyExtractor: Image and mask geometry differ, using pyradiomics')
+            return [self._with_bin_count(self.extractor, bin_count).execute(image, mask) for bin_count in bin_counts]
+
+        logging.info(f'NumpyExtractor: Extracting features for {len(bin_counts)} discretizations')
+        results = []
+        for bin_count, numpy_result in zip(bin_counts, self._compute_numpy_features(image, mask, bin_counts)):
+            fallback_result = self._with_bin_count(self.fallback_extractor, bin_count).execute(image, mask) \
+                if self.fallback_extractor else {}
+            results.append(self._merge(numpy_result, fallback_result))
+        return results
+
+    def _merge(self, numpy_result: dict, fallback_result: dict) -> dict:
+        # Порядок pyradiomics: сначала признаки формы, затем классы в порядке файла параметров
+        feature_classes = sorted(self.extractor.enabledFeatures, key=lambda name: not name.startswith('shape'))
+        features = {}
+        for feature_class in feature_classes:
+            prefix = f'original_{feature_class}_'
+            names = self.extractor.enabledFeatures[feature_class]
+            if names:
+                for name in names:
+                    key = prefix + name
+                    features[key] = numpy_result[key] if key in numpy_result else fallback_result[key]
+            else:
+                features.update((key, value) for key, value in fallback_result.items() if key.startswith(prefix))
+        return features
+
+
+def compare_with_pyradiomics(params_path: str, image: sitk.Image, mask: sitk.Image, rtol=1e-6) -> dict:
+    """
+    Сравнение признаков NumpyFeatureExtractor с pyradiomics для проверки совпадения.
+    Вычисляются все признаки, реализованные на NumPy, с настройками из файла параметров
+
+    Параметры:
+    - params_path (str): Путь к файлу параметров извлечения признаков
+    - image (sitk.Image): Входное изображение
+    - mask (sitk.Image): Входная маска
+    - rtol (float): Допустимая относительная погрешность
+
+    Возвращает:
+    - mismatches (dict): Признаки вне допуска {ключ: (pyradiomics, numpy)}
+    """
+    extractor = featureextractor.RadiomicsFeatureExtractor(params_path)
+    extractor.disableAllFeatures()
+    extractor.enableFeaturesByName(**{name: sorted(features) for name, features in SUPPORTED_FEATURES.items()})
+    expected = {key: float(value) for key, value in extractor.execute(image, mask).items()
+                if 'diagnostics' not in key}
+    actual = NumpyFeatureExtractor(extractor).execute(image, mask)
+
+    if list(expected) != list(actual):
+        logging.error('NumpyExtractor: Feature keys differ from pyradiomics')
+        raise ValueError('NumpyExtractor: Feature keys differ from pyradiomics')
+    return {key: (expected[key], actual[key]) for key in expected
+            if not np.isclose(actual[key], expected[key], rtol=rtol, atol=0, equal_nan=True)}
+
+
+if __name__ == "__main__":
+    # Проверка совпадения с pyradiomics: python numpy_feature_extracting.py <params.yaml> <image> <mask> ...
+    params, *paths = sys.argv[1:]
+    for image_path, mask_path in zip(paths[::2], paths[1::2]):
+        result = compare_with_pyradiomics(params, sitk.ReadImage(image_path), sitk.ReadImage(mask_path))
+        print(image_path, 'OK' if not result else result)
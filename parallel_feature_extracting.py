@@ -0,0 +1,244 @@
+from __future__ import annotations
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from lazy_importing import lazy_import
+
+sitk = lazy_import('SimpleITK')
+radiomics = lazy_import('radiomics')
+featureextractor = lazy_import('radiomics.featureextractor')
+generalinfo = lazy_import('radiomics.generalinfo')
+imageoperations = lazy_import('radiomics.imageoperations')
+
+# forkserver безопаснее fork в многопоточном процессе Streamlit и быстрее spawn
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Версии pyradiomics, для которых prepare повторяет RadiomicsFeatureExtractor.execute
+SUPPORTED_PYRADIOMICS = ('v3.0.',)
+
+
+def supports_pyradiomics() -> bool:
+    """
+    Проверка, что установленная версия pyradiomics совпадает с той, чью подготовку повторяет prepare
+
+    Возвращает:
+    - supported (bool): Флаг поддерживаемой версии
+    """
+    version = str(getattr(radiomics, '__version__', ''))
+    return any(('v' + version.lstrip('v')).startswith(prefix) for prefix in SUPPORTED_PYRADIOMICS)
+
+
+def compute_feature_class(feature_class: str, feature_names, image: sitk.Image, mask: sitk.Image,
+                           image_type: str, settings: dict) -> list:
+    """
+    Вычисление признаков одного класса на подготовленных изображении и маске (выполняется в процессе пула)
+
+    Параметры:
+    - feature_class (str): Название класса признаков pyradiomics
+    - feature_names (list | None): Включенные признаки класса, пустой список или None - все признаки
+    - image (sitk.Image): Обрезанное по маске изображение
+    - mask (sitk.Image): Обрезанная маска
+    - image_type (str): Тип изображения pyradiomics, например 'original'
+    - settings (dict): Настройки извлечения признаков
+
+    Возвращает:
+    - features (list): Пары (ключ, значение) в порядке pyradiomics
+    """
+    calculator = radiomics.getFeatureClasses()[feature_class](image, mask, **settings)
+    for name in feature_names or []:
+        calculator.enableFeatureByName(name)
+    return [(f'{image_type}_{feature_class}_{name}', value) for name, value in calculator.execute().items()]
+
+
+class ParallelFeatureExtractor:
+    """
+    Класс ParallelFeatureExtractor предназначен для извлечения признаков одного случая с параллельным
+    вычислением классов признаков. Изображение и маска загружаются, проверяются и обрезаются один раз,
+    затем каждый класс признаков считается в отдельном процессе. Используются процессы, а не потоки:
+    матрицы pyradiomics строятся в C-расширении, которое не освобождает GIL.
+    Ключи, значения и порядок совпадают с RadiomicsFeatureExtractor.execute. Подготовка повторяет execute
+    pyradiomics 3.0, с другой версией признаки извлекаются последовательно через execute
+
+    Атрибуты:
+    - extractor (RadiomicsFeatureExtractor): Экстрактор pyradiomics с параметрами модели
+    - workers (int): Количество процессов
+
+    Методы:
+    - __init__(self, extractor, workers=None): Инициализация класса ParallelFeatureExtractor
+    - prepare(self, image, mask): Загрузка, проверка маски, признаки формы и обрезка изображения
+    - execute(self, image, mask): Извлечение признаков из изображения и маски
+    - shutdown(self): Остановка пула процессов
+    """
+
+    def __init__(self, extractor: featureextractor.RadiomicsFeatureExtractor, workers=None):
+        """
+        Инициализация класса ParallelFeatureExtractor
+
+        Параметры:
+        - extractor (RadiomicsFeatureExtractor): Экстрактор pyradiomics с загруженными параметрами модели
+        - workers (int): Количество процессов, по умолчанию - число классов признаков, но не больше числа ядер
+        """
+        logging.info('ParallelExtractor: Initializing ParallelFeatureExtractor class')
+        self.extractor = extractor
+        feature_classes = [name for name in extractor.enabledFeatures if not name.startswith('shape')]
+        if workers is None:
+            workers = min(len(feature_classes), os.cpu_count() or 1)
+        if workers < 1:
+            logging.error('ParallelExtractor: Workers must be positive')
+            raise ValueError('ParallelExtractor: Workers must be positive')
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Пул создается при первом вызове и переиспользуется, чтобы не платить за запуск процессов на каждый случай
+        with self._lock:
+            if self._executor is None:
+                logging.info(f'ParallelExtractor: Starting {self.workers} workers')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(START_METHOD))
+            return self._executor
+
+    def prepare(self, image: sitk.Image, mask: sitk.Image) -> tuple:
+        """
+        Загрузка, проверка маски и обрезка изображения, как в RadiomicsFeatureExtractor.execute
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - mask (sitk.Image): Входная маска
+
+        Возвращает:
+        - features (dict): Диагностики и признаки формы
+        - inputs (list): Обрезанные изображения для каждого типа изображения: (изображение, маска, тип, настройки)
+        """
+        settings = self.extractor.settings.copy()
+        label = settings.get('label', 1)
+        if featureextractor.geometryTolerance != settings.get('geometryTolerance'):
+            self.extractor._setTolerance()
+
+        general_info = None
+        if settings.get('additionalInfo', False):
+            general_info = generalinfo.GeneralInfo()
+            general_info.addGeneralSettings(settings)
+            general_info.addEnabledImageTypes(self.extractor.enabledImagetypes)
+
+        image, mask = self.extractor.loadImage(image, mask, general_info, **settings)
+        bounding_box, corrected_mask = imageoperations.checkMask(image, mask, **settings)
+        if corrected_mask is not None:
+            if general_info is not None:
+                general_info.addMaskElements(image, corrected_mask, label, 'corrected')
+            mask = corrected_mask
+
+        resegmented_mask = None
+        if settings.get('resegmentRange', None) is not None:
+            resegmented_mask = imageoperations.resegmentMask(image, mask, **settings)
+            bounding_box, _ = imageoperations.checkMask(image, resegmented_mask, **settings)
+            if general_info is not None:
+                general_info.addMaskElements(image, resegmented_mask, label, 'resegmented')
+
+        features = {}
+        if general_info is not None:
+            features.update(general_info.getGeneralInfo())
+        resegment_shape = settings.get('resegmentShape', False)
+        if resegment_shape and resegmented_mask is not None:
+            mask = resegmented_mask
+        features.update(self.extractor.computeShape(image, mask, bounding_box, **settings))
+        if not resegment_shape and resegmented_mask is not None:
+            mask = resegmented_mask
+
+        inputs = []
+        for image_type, custom_settings in self.extractor.enabledImagetypes.items():
+            image_type_settings = settings.copy()
+            image_type_settings.update(custom_settings)
+            generator = getattr(imageoperations, f'get{image_type}Image')(image, mask, **image_type_settings)
+            for input_image, image_type_name, input_settings in generator:
+                input_image, input_mask = imageoperations.cropToTumorMask(input_image, mask, bounding_box)
+                inputs.append((input_image, input_mask, image_type_name, input_settings))
+        return features, inputs
+
+    def execute(self, image: sitk.Image, mask: sitk.Image) -> dict:
+        """
+        Извлечение признаков из изображения и маски
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - mask (sitk.Image): Входная маска
+
+        Возвращает:
+        - features (dict): Признаки в порядке pyradiomics
+        """
+        logging.info('ParallelExtractor: Extracting features')
+        if not supports_pyradiomics():
+            logging.warning(f'ParallelExtractor: pyradiomics {radiomics.__version__} is not supported, '
+                            f'extracting serially')
+            return self.extractor.execute(image, mask)
+        features, inputs = self.prepare(image, mask)
+        executor = self._pool()
+        futures = [executor.submit(compute_feature_class, feature_class, feature_names,
+                                   input_image, input_mask, image_type, settings)
+                   for input_image, input_mask, image_type, settings in inputs
+                   for feature_class, feature_names in self.extractor.enabledFeatures.items()
+                   if not feature_class.startswith('shape')]
+        # Результаты объединяются в порядке отправки, то есть в порядке pyradiomics
+        for future in futures:
+            features.update(future.result())
+        return features
+
+    def shutdown(self) -> None:
+        """
+        Остановка пула процессов
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def benchmark(params_path: str, image: sitk.Image, mask: sitk.Image, workers=None, repeats=3) -> dict:
+    """
+    Сравнение времени извлечения признаков одного случая: последовательно и параллельно по классам
+
+    Параметры:
+    - params_path (str): Путь к файлу параметров извлечения признаков
+    - image (sitk.Image): Входное изображение
+    - mask (sitk.Image): Входная маска
+    - workers (int): Количество процессов
+    - repeats (int): Количество повторов, берется лучшее время
+
+    Возвращает:
+    - result (dict): Время в секундах, ускорение и признак совпадения результатов
+    """
+    extractor = featureextractor.RadiomicsFeatureExtractor(params_path)
+    parallel_extractor = ParallelFeatureExtractor(extractor, workers)
+    try:
+        # Прогрев пула, чтобы в замер не попал запуск процессов
+        expected, actual = extractor.execute(image, mask), parallel_extractor.execute(image, mask)
+        serial_times, parallel_times = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            extractor.execute(image, mask)
+            serial_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            parallel_extractor.execute(image, mask)
+            parallel_times.append(time.perf_counter() - start)
+    finally:
+        parallel_extractor.shutdown()
+
+    features = [key for key in expected if 'diagnostics' not in key]
+    return {
+        'workers': parallel_extractor.workers,
+        'serial': min(serial_times),
+        'parallel': min(parallel_times),
+        'speedup': min(serial_times) / min(parallel_times),
+        'identical': list(expected) == list(actual) and all(expected[key] == actual[key] for key in features)
+    }
+
+
+if __name__ == "__main__":
+    # Замер ускорения: python parallel_feature_extracting.py <params.yaml> <image> <mask> [workers]
+    params, image_path, mask_path, *rest = sys.argv[1:]
+    print(benchmark(params, sitk.ReadImage(image_path), sitk.ReadImage(mask_path),
+                    workers=int(rest[0]) if rest else None))
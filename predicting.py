@@ -1,7 +1,19 @@
+from __future__ import annotations
 import logging
+import operator
 import os
-import joblib
-import pandas as pd
+import sys
+from feature_cache import content_digest
+from lazy_importing import lazy_import
+from tracing import annotate, traced
+from tree_ensemble import TREES_SUFFIX, TreeEnsemble
+
+joblib = lazy_import('joblib')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+compose = lazy_import('sklearn.compose')
+pipeline = lazy_import('sklearn.pipeline')
+sklearn_preprocessing = lazy_import('sklearn.preprocessing')
 
 class Predictor:
     """
@@ -9,26 +21,182 @@ class Predictor:
 
     Атрибуты:
     - model: Название модели, используемой для предсказания
+    - schema (list | None): Порядок и кодирование входных столбцов, разобранные из модели при загрузке,
+      None - модель не поддерживает быстрый путь и предсказание идет через pandas
+    - columns (list): Входные поля записей, нужные модели
+    - ensemble (TreeEnsemble | None): Экспортированные деревья модели, None - предсказание через xgboost
+    - classes (np.ndarray): Метки классов
 
     Методы:
-    - __init__(self, model: str): Инициализация класса Predictor
+    - __init__(self, model: str, trees=True): Инициализация класса Predictor
     - predict(self, data: dict, **kwargs): Предсказание на основе входных данных
+    - to_matrix(self, records: list) -> np.ndarray: Сборка матрицы признаков по схеме модели
+    - predict_batch(self, records: list) -> tuple: Предсказание и вероятности для набора записей
     """
 
-    def __init__(self, model: str):
+    def __init__(self, model: str, trees=True):
         """
         Инициализация класса Predictor
 
         Параметры:
         - model (str): Название модели, используемой для предсказания
+        - trees (bool): Флаг, разрешающий использовать экспортированные деревья модели, если они
+          получены из текущего файла модели
         """
         logging.info("Predictor: Loading model")
-        if isinstance(model, str) and os.path.isfile(f'models/{model}_model.joblib'):
-            self.classifier = joblib.load(f'models/{model}_model.joblib')
-        else:
+        model_path = f'models/{model}_model.joblib'
+        if not (isinstance(model, str) and os.path.isfile(model_path)):
             logging.error('Predictor: Model not found')
             raise ValueError('Predictor: Model not found.')
 
+        self.ensemble = self._load_trees(model, model_path) if trees else None
+        if self.ensemble is not None:
+            # Деревья загружаются за миллисекунды, sklearn и xgboost не импортируются
+            self.classifier = None
+            self.schema = self.ensemble.schema
+            self.columns = [column[1] for column in self.schema]
+            self.classes = self.ensemble.classes
+            return
+
+        self.classifier = joblib.load(model_path)
+        self.classes = self.classifier.classes_
+        self.schema = self._compile_schema(self.classifier)
+        if self.schema is None:
+            logging.info('Predictor: Model layout not supported for fast path, using pandas')
+            self.columns = list(getattr(self.classifier, 'feature_names_in_', []))
+        else:
+            self.columns = [column[1] for column in self.schema]
+            self.estimator = self.classifier.steps[-1][1]
+
+    @staticmethod
+    def _load_trees(model: str, model_path: str):
+        # Экспортированные деревья или None, если их нет или они получены из другой версии модели
+        trees_path = f'models/{model}{TREES_SUFFIX}'
+        if not os.path.isfile(trees_path):
+            return None
+        try:
+            ensemble = TreeEnsemble.load(trees_path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f'Predictor: Cannot load exported trees: {e}')
+            return None
+        if ensemble.source_digest != content_digest(model_path):
+            logging.warning('Predictor: Exported trees are stale, re-export them, using the model file')
+            return None
+        logging.info('Predictor: Using exported trees')
+        return ensemble
+
+    @staticmethod
+    def _compile_schema(classifier):
+        """
+        Разбор порядка входных столбцов и кодирования категорий из конвейера sklearn:
+        ColumnTransformer из passthrough и OneHotEncoder, затем классификатор
+
+        Параметры:
+        - classifier: Загруженная модель
+
+        Возвращает:
+        - schema (list | None): Столбцы ('numeric', поле) и ('categorical', поле, {категория: столбец},
+          число столбцов, handle_unknown) в порядке выхода ColumnTransformer, None - если разбор невозможен
+        """
+        if not isinstance(classifier, pipeline.Pipeline) or len(classifier.steps) != 2:
+            return None
+        transformer = classifier.steps[0][1]
+        if not isinstance(transformer, compose.ColumnTransformer):
+            return None
+
+        schema = []
+        for _, encoder, columns in transformer.transformers_:
+            if encoder == 'drop' or len(columns) == 0:
+                continue
+            if not all(isinstance(column, str) for column in columns):
+                return None
+            if encoder == 'passthrough' or isinstance(encoder, sklearn_preprocessing.FunctionTransformer) and encoder.func is None:
+                schema.extend(('numeric', column) for column in columns)
+            elif isinstance(encoder, sklearn_preprocessing.OneHotEncoder) and getattr(encoder, 'infrequent_categories_', None) is None:
+                drop_indices = encoder.drop_idx_ if encoder.drop_idx_ is not None else [None] * len(columns)
+                for column, categories, drop_index in zip(columns, encoder.categories_, drop_indices):
+                    kept = [category for index, category in enumerate(categories) if index != drop_index]
+                    positions = {category: position for position, category in enumerate(kept)}
+                    # Удаленная категория кодируется нулями, как в OneHotEncoder
+                    if drop_index is not None:
+                        positions[categories[drop_index]] = None
+                    schema.append(('categorical', column, positions, len(kept), encoder.handle_unknown))
+            else:
+                return None
+
+        width = sum(1 if column[0] == 'numeric' else column[3] for column in schema)
+        if width != getattr(classifier.steps[-1][1], 'n_features_in_', width):
+            return None
+        return schema
+
+    def to_matrix(self, records: list) -> np.ndarray:
+        """
+        Сборка непрерывной матрицы признаков по схеме модели
+
+        Параметры:
+        - records (list): Записи признаков и клинических данных (dict)
+
+        Возвращает:
+        - matrix (np.ndarray): Матрица float32 размера (число записей, число входов классификатора)
+        """
+        # Порядок столбцов (order='F'): матрица заполняется по столбцам, деревья выбирают столбцы узлов
+        matrix = np.zeros((len(records), sum(1 if column[0] == 'numeric' else column[3] for column in self.schema)),
+                          dtype=np.float32, order='F')
+        numeric, offset = {}, 0
+        for column in self.schema:
+            if column[0] == 'numeric':
+                numeric[column[1]] = offset
+            offset += 1 if column[0] == 'numeric' else column[3]
+        try:
+            if numeric and records:
+                # Числовые поля всех записей читаются одним проходом
+                values = list(map(operator.itemgetter(*numeric), records))
+                matrix[:, list(numeric.values())] = np.array(values, dtype=np.float32).reshape(len(records), -1)
+            offset = 0
+            for column in self.schema:
+                if column[0] == 'numeric':
+                    offset += 1
+                    continue
+                _, name, positions, width, handle_unknown = column
+                rows, hot = [], []
+                for row, value in enumerate([record[name] for record in records]):
+                    if value not in positions:
+                        if handle_unknown == 'error':
+                            logging.error('Predictor: Unknown category')
+                            raise ValueError(f'Predictor: Unknown category {value!r} for {name}')
+                        continue
+                    if positions[value] is not None:
+                        rows.append(row)
+                        hot.append(offset + positions[value])
+                matrix[rows, hot] = 1
+                offset += width
+        except KeyError as e:
+            logging.error('Predictor: Missing input column')
+            raise ValueError(f'Predictor: Missing input column {e.args[0]}')
+        return matrix
+
+    @traced('predict')
+    def predict_batch(self, records: list) -> tuple:
+        """
+        Предсказание для набора записей одним вызовом классификатора
+
+        Параметры:
+        - records (list): Записи признаков и клинических данных (dict)
+
+        Возвращает:
+        - predictions (np.ndarray): Предсказанные классы
+        - probabilities (np.ndarray): Вероятности классов размера (число записей, число классов)
+        """
+        logging.info(f'Predictor: Predicting batch of {len(records)}')
+        annotate(batch_size=len(records))
+        if self.ensemble is not None:
+            probabilities = self.ensemble.predict_proba(self.to_matrix(records))
+        elif self.schema is None:
+            probabilities = self.classifier.predict_proba(pd.DataFrame(records))
+        else:
+            probabilities = self.estimator.predict_proba(self.to_matrix(records))
+        return self.classes[np.argmax(probabilities, axis=1)], probabilities
+
     def predict(self, data: dict) -> int:
         """
         Предсказание на основе входных данных
@@ -40,5 +208,40 @@ class Predictor:
         - prediction (int): Предсказание
         """
         logging.info("Predictor: Predicting")
-        prediction = self.classifier.predict(pd.DataFrame([data]))
-        return prediction[0]
+        predictions, _ = self.predict_batch([data])
+        return predictions[0]
+
+
+def export_trees(model: str, validation_rows=10000) -> str:
+    """
+    Экспорт классификатора модели в массивы деревьев (models/<модель>_trees.npz). Перед записью
+    вероятности проверяются на совпадение с xgboost на проверочных строках у порогов деревьев
+
+    Параметры:
+    - model (str): Название модели
+    - validation_rows (int): Количество проверочных строк
+
+    Возвращает:
+    - trees_path (str): Путь к файлу деревьев
+    """
+    predictor = Predictor(model, trees=False)
+    if predictor.schema is None:
+        logging.error('Predictor: Model layout not supported for export')
+        raise ValueError('Predictor: Model layout not supported for export')
+    ensemble = TreeEnsemble.from_xgboost(predictor.estimator, predictor.schema,
+                                         content_digest(f'models/{model}_model.joblib'))
+    matrix = ensemble.validation_matrix(validation_rows)
+    expected = predictor.estimator.predict_proba(matrix)
+    mismatches = int(np.count_nonzero(np.any(ensemble.predict_proba(matrix) != expected, axis=1)))
+    if mismatches:
+        logging.error('Predictor: Exported trees do not match the model')
+        raise ValueError(f'Predictor: Exported trees differ from the model on {mismatches} of {validation_rows} rows')
+    trees_path = f'models/{model}{TREES_SUFFIX}'
+    ensemble.save(trees_path)
+    return trees_path
+
+
+if __name__ == "__main__":
+    # Экспорт деревьев: python predicting.py [модель ...]
+    for model_name in sys.argv[1:] or ['liver_t2w_xgboost']:
+        print(export_trees(model_name))
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from image_viewing import ImageViewer
+from lazy_importing import lazy_import, load_times
+from model_registry import model_registry
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+
+# Размер синтетического куба для прогрева извлечения признаков
+WARM_UP_SIZE = 16
+
+
+def warm_up_model(model: str, mri_modality='T2', backend='pyradiomics', workers=1) -> dict:
+    """
+    Прогрев модели в текущем процессе: загрузка в реестр, создание предобработчика, пробное извлечение
+    признаков и превью маленького синтетического изображения, чтобы загрузить классы признаков pyradiomics,
+    его C-расширение и кодировщик JPEG до первого случая
+
+    Параметры:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - backend (str): Реализация извлечения признаков
+    - workers (int): Количество процессов для вычисления классов признаков одного случая
+
+    Возвращает:
+    - timings (dict): Время этапов прогрева в секундах
+    """
+    timings = {}
+    start = time.perf_counter()
+    registered_model = model_registry.get(model, backend, workers)
+    preprocessor = model_registry.preprocessor(mri_modality)
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    array = np.random.default_rng(0).normal(100, 20, (WARM_UP_SIZE,) * 3).astype(np.float32)
+    mask = np.zeros(array.shape, dtype=np.uint8)
+    margin = WARM_UP_SIZE // 4
+    mask[margin:-margin, margin:-margin, margin:-margin] = 1
+    image = preprocessor.intensity_normalize(sitk.GetImageFromArray(array), in_place=True)
+    mask = sitk.GetImageFromArray(mask)
+    registered_model.feature_extractor.extract_features(image, mask)
+    timings['extract'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ImageViewer(image, mask).show()
+    timings['preview'] = time.perf_counter() - start
+    logging.info(f'Preloader: Model {model} warmed up in {sum(timings.values()):.2f} s')
+    return timings
+
+
+class Preloader:
+    """
+    Класс Preloader предназначен для прогрева в фоновом потоке: пока интерфейс отрисовывается
+    или пул процессов запускается, загружаются модели и тяжелые зависимости
+
+    Атрибуты:
+    - tasks (dict): Задачи прогрева {название: функция без аргументов}
+    - timings (dict): Время выполнения задач в секундах
+    - errors (dict): Ошибки задач
+    - results (dict): Результаты задач
+
+    Методы:
+    - __init__(self, tasks): Инициализация класса Preloader
+    - start(self) -> Preloader: Запуск прогрева в фоновом потоке
+    - ready (bool): Флаг, указывающий, что все задачи завершены
+    - wait(self, timeout=None) -> bool: Ожидание завершения прогрева
+    - report(self) -> dict: Время задач и загрузки отложенных модулей
+    """
+
+    def __init__(self, tasks: dict):
+        """
+        Инициализация класса Preloader
+
+        Параметры:
+        - tasks (dict): Задачи прогрева {название: функция без аргументов}, выполняются по порядку
+        """
+        self.tasks = tasks
+        self.timings = {}
+        self.errors = {}
+        self.results = {}
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self) -> 'Preloader':
+        """
+        Запуск прогрева в фоновом потоке
+
+        Возвращает:
+        - preloader (Preloader): Этот же объект
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='Preloader', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        for name, task in self.tasks.items():
+            start = time.perf_counter()
+            try:
+                self.results[name] = task()
+            except Exception as e:
+                # Ошибка прогрева не критична: при первом использовании загрузка будет повторена
+                logging.error(f'Preloader: Task {name} failed: {e}')
+                self.errors[name] = e
+            self.timings[name] = time.perf_counter() - start
+        self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Ожидание завершения прогрева
+
+        Параметры:
+        - timeout (float): Максимальное время ожидания в секундах, None - без ограничения
+
+        Возвращает:
+        - ready (bool): True, если все задачи завершены
+        """
+        return self._done.wait(timeout)
+
+    def report(self) -> dict:
+        """
+        Время выполнения задач прогрева и загрузки отложенных модулей
+
+        Возвращает:
+        - report (dict): {'tasks': {задача: секунды}, 'imports': {модуль: миллисекунды}}
+        """
+        return {'tasks': dict(self.timings), 'imports': load_times()}
@@ -1,10 +1,24 @@
+from __future__ import annotations
 import logging
-import numpy as np
-import SimpleITK as sitk
 import os
 from datetime import datetime
-from intensity_normalization.cli.zscore import ZScoreNormalize
-from intensity_normalization.typing import Modality
+from image_loading import read_image
+from lazy_importing import lazy_import
+from memory_monitoring import track_peak_rss
+from tracing import annotate, traced
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+normalization_typing = lazy_import('intensity_normalization.typing')
+
+# Порог фона, совпадающий с ZScoreNormalize из intensity_normalization
+FOREGROUND_THRESHOLD = 1e-6
+# Отступ вокруг маски в вокселях, достаточный для ядра B-сплайн интерполяции
+CROP_MARGIN = 8
+# Шаг сетки ресэмплирования в мм
+OUTPUT_SPACING = (1, 1, 1)
+# Версия предобработки для ключей кэша признаков, увеличивается при изменении результата предобработки
+PREPROCESSING_VERSION = 3
 
 
 class Preprocessor:
@@ -14,6 +28,7 @@ class Preprocessor:
     Атрибуты:
     - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
     - save (bool): Флаг, указывающий, нужно ли сохранять обработанные данные
+    - peak_memory (int): Прирост пиковой резидентной памяти при последней предобработке в байтах
 
     Методы:
     - __init__(self, mri_modality: str, save=False): Инициализация класса Preprocessor
@@ -21,7 +36,13 @@ class Preprocessor:
     - intensity_normalize(self, image: sitk.Image) -> sitk.Image: Нормализация интенсивности изображения
     - new_image_preprocessing(self, input_path, normalize=True, resample=True): Предобработка нового изображения
     - mask_preprocessing(self, input_path, resample=True): Предобработка маски
-    - preprocessing_step(self, image_path, mask_path, normalize=True, resample=True): Предобработка изображения и маски
+    - preprocessing_step(self, image_path, mask_path, normalize=True, resample=True, crop=False): Предобработка изображения и маски
+    - normalization_statistics(image, threshold=FOREGROUND_THRESHOLD) -> tuple: Статистики z-score нормализации за один проход
+    - apply_normalization(image, statistics, in_place=False) -> sitk.Image: Нормализация изображения по готовым статистикам
+    - resampling_grid(image) -> dict: Сетка ресэмплирования изображения
+    - resample_to_grid(image, grid, interpolator) -> sitk.Image: Ресэмплирование изображения на сетку
+    - mask_bounding_box(mask, label=1) -> tuple: Ограничивающий бокс метки в маске
+    - roi_preprocessing_step(self, image_path, mask_path, ...): Предобработка только области маски с отступом
     """
 
     def __init__(self, mri_modality: str, save=False):
@@ -34,11 +55,11 @@ class Preprocessor:
         """
         logging.info('Preprocessor: Initializing Preprocessor class.')
         self.save = save
-        self.normalizer = ZScoreNormalize()
+        self.peak_memory = 0
         if mri_modality == 'T1':
-            self.modality = Modality.T1
+            self.modality = normalization_typing.Modality.T1
         elif mri_modality == 'T2':
-            self.modality = Modality.T2
+            self.modality = normalization_typing.Modality.T2
         else:
             logging.error('Preprocessor: Invalid modality choice')
             raise ValueError("Invalid modality choice. Choose 'T1' or 'T2'")
@@ -55,35 +76,31 @@ class Preprocessor:
         - normalized_image (sitk.Image): Нормализованное изображение
         """
         logging.info('Preprocessor: Normalizing image')
-        flatten_image_array = sitk.GetArrayFromImage(image).flatten()
-        mu, std = np.mean(flatten_image_array), np.std(flatten_image_array)
-        normalized_image = (image - mu) / std
-        # normalized_image = sitk.Normalize(image)
-        return normalized_image
+        return Preprocessor.apply_normalization(image, Preprocessor.normalization_statistics(image, threshold=None))
 
-    def intensity_normalize(self, image: sitk.Image) -> sitk.Image:
+    @traced('normalize')
+    def intensity_normalize(self, image: sitk.Image, in_place=False) -> sitk.Image:
         """
-        Нормализация интенсивности изображения пакетом intensity_normalization
+        Z-score нормализация интенсивности по переднему плану, как ZScoreNormalize из intensity_normalization,
+        без полноразмерных временных массивов
 
         Параметры:
         - image (sitk.Image): Входное изображение
+        - in_place (bool): Флаг, разрешающий изменить входное изображение float32 без копирования
 
         Возвращает:
-        - normalized_image (sitk.Image): Нормализованное изображение
+        - normalized_image (sitk.Image): Нормализованное изображение float32
         """
         logging.info('Preprocessor: Normalizing image intensity')
-        array = np.asanyarray(sitk.GetArrayFromImage(image))
-        normalized_array = np.asanyarray(self.normalizer(array, modality=self.modality))
-        normalized_image = sitk.GetImageFromArray(normalized_array)
-        normalized_image.CopyInformation(image)
-        return normalized_image
+        annotate(voxels=image.GetNumberOfPixels())
+        return self.apply_normalization(image, self.normalization_statistics(image), in_place=in_place)
 
-    def image_preprocessing(self, input_path: str, normalize=True, resample=True) -> sitk.Image:
+    def image_preprocessing(self, input_path, normalize=True, resample=True) -> sitk.Image:
         """
         Предобработка изображения
 
         Параметры:
-        - input_path (str): Путь к входному изображению
+        - input_path (str | sitk.Image): Путь к входному изображению или изображение
         - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
         - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение
 
@@ -91,32 +108,21 @@ class Preprocessor:
         - final_image (sitk.Image): Предобработанное изображение
         """
         logging.info('Preprocessor: Loading image')
-        if isinstance(input_path, str) and os.path.isfile(input_path):
+        if isinstance(input_path, sitk.Image) or isinstance(input_path, str) and os.path.isfile(input_path):
             logging.info('Preprocessor: Preprocessing image')
-            image = sitk.ReadImage(input_path)
+            image = input_path if isinstance(input_path, sitk.Image) else read_image(input_path)
 
             final_image = image
 
             if normalize:
                 logging.info('Preprocessor: Normalizing image')
-                # final_image = self.normalize(image)
-                final_image = self.intensity_normalize(image)
+                # Прочитанное с диска изображение принадлежит только этому методу и нормализуется на месте
+                final_image = self.intensity_normalize(image, in_place=not isinstance(input_path, sitk.Image))
+                del image
 
             if resample:
                 logging.info('Preprocessor: Resampling image')
-                resampled_image = sitk.Resample(
-                    image1=final_image,
-                    size=np.rint(
-                        final_image.GetSize() * np.array(final_image.GetSpacing()) / (1, 1, 1)).astype(
-                        int).tolist(),
-                    transform=sitk.Transform(),
-                    interpolator=sitk.sitkBSpline,
-                    outputOrigin=final_image.GetOrigin(),
-                    outputSpacing=(1, 1, 1),
-                    outputDirection=final_image.GetDirection(),
-                    outputPixelType=final_image.GetPixelID(),
-                )
-                final_image = resampled_image
+                final_image = self.resample_to_grid(final_image, self.resampling_grid(final_image), sitk.sitkBSpline)
 
             # TODO: make file path
             if self.save:
@@ -129,38 +135,30 @@ class Preprocessor:
 
         return final_image
 
-    def mask_preprocessing(self, input_path: str, resample=True) -> sitk.Image:
+    def mask_preprocessing(self, input_path, resample=True, grid=None) -> sitk.Image:
         """
         Предобработка маски
 
         Параметры:
-        - input_path (str): Путь к входной маске
+        - input_path (str | sitk.Image): Путь к входной маске или маска
         - resample (bool): Флаг, указывающий, нужно ли ресэмплировать маску
+        - grid (dict): Сетка ресэмплирования изображения, по умолчанию строится по маске
 
         Возвращает:
         - result_mask (sitk.Image): Предобработанная маска
         """
         logging.info('Preprocessor: Loading mask')
-        if isinstance(input_path, str) and os.path.isfile(input_path):
+        if isinstance(input_path, sitk.Image) or isinstance(input_path, str) and os.path.isfile(input_path):
             logging.info('Preprocessor: Preprocessing mask')
 
-            mask = sitk.ReadImage(input_path)
+            mask = input_path if isinstance(input_path, sitk.Image) else read_image(input_path)
 
             result_mask = mask
 
             if resample:
                 logging.info('Preprocessor: Resampling mask')
-                preprocessing_mask = sitk.Resample(
-                    image1=mask,
-                    size=np.rint(mask.GetSize() * np.array(mask.GetSpacing()) / (1, 1, 1)).astype(int).tolist(),
-                    transform=sitk.Transform(),
-                    interpolator=sitk.sitkLinear,
-                    outputOrigin=mask.GetOrigin(),
-                    outputSpacing=(1, 1, 1),
-                    outputDirection=mask.GetDirection(),
-                    outputPixelType=mask.GetPixelID(),
-                )
-                result_mask = preprocessing_mask
+                # Ближайший сосед сохраняет значения меток
+                result_mask = self.resample_to_grid(mask, grid or self.resampling_grid(mask), sitk.sitkNearestNeighbor)
 
             # TODO: make file path and check labels in mask
             if self.save:
@@ -173,20 +171,262 @@ class Preprocessor:
 
         return result_mask
 
-    def preprocessing_step(self, image_path: str, mask_path: str, normalize=True, resample=True) -> tuple:
+    @traced('preprocess')
+    def preprocessing_step(self, image_path, mask_path, normalize=True, resample=True, crop=False) -> tuple:
         """
         Предобработка изображения и маски
 
         Параметры:
-        - image_path (str): Путь к входному изображению
-        - mask_path (str): Путь к входной маске
+        - image_path (str | sitk.Image): Путь к входному изображению или изображение
+        - mask_path (str | sitk.Image): Путь к входной маске или маска
         - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
         - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        - crop (bool): Флаг, указывающий, нужно ли обрабатывать только область маски
 
         Возвращает:
         - new_image (sitk.Image): Предобработанное изображение
         - new_mask (sitk.Image): Предобработанная маска
         """
-        new_image = self.image_preprocessing(image_path, normalize=normalize, resample=resample)
-        new_mask = self.mask_preprocessing(mask_path, resample=resample)
+        with track_peak_rss() as peak:
+            if crop:
+                new_image, new_mask = self.roi_preprocessing_step(image_path, mask_path, normalize=normalize,
+                                                                  resample=resample)
+            else:
+                new_image = self.image_preprocessing(image_path, normalize=normalize, resample=resample)
+                # Маска ресэмплируется на сетку изображения, чтобы воксели совпадали
+                grid = self.resampling_grid(new_image) if resample else None
+                new_mask = self.mask_preprocessing(mask_path, resample=resample, grid=grid)
+        if peak['tracked']:
+            self.peak_memory = peak['peak_rss']
+            logging.info(f'Preprocessor: Peak memory {self.peak_memory / 2 ** 20:.1f} MiB above baseline')
+        annotate(voxels=new_image.GetNumberOfPixels(), crop=crop)
         return new_image, new_mask
+
+    @staticmethod
+    def normalization_statistics(image: sitk.Image, threshold=FOREGROUND_THRESHOLD) -> tuple:
+        """
+        Статистики z-score нормализации по переднему плану всего изображения,
+        совпадающие с ZScoreNormalize из intensity_normalization. Вычисляются за один проход
+        по срезам без копирования изображения, частичные суммы объединяются в float64
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - threshold (float): Порог переднего плана, None - по всем вокселям
+
+        Возвращает:
+        - statistics (tuple): Среднее и стандартное отклонение
+        """
+        count, mean, m2 = 0, 0.0, 0.0
+        for plane in sitk.GetArrayViewFromImage(image):
+            values = plane[plane > threshold] if threshold is not None else plane.ravel()
+            if values.size == 0:
+                continue
+            plane_mean = values.mean(dtype=np.float64)
+            plane_m2 = np.square(np.subtract(values, plane_mean, dtype=np.float64)).sum()
+            # Объединение статистик по срезам (Chan et al.)
+            total = count + values.size
+            delta = plane_mean - mean
+            mean += delta * values.size / total
+            m2 += plane_m2 + delta ** 2 * count * values.size / total
+            count = total
+        if count == 0:
+            logging.error('Preprocessor: Empty foreground for normalization')
+            raise ValueError('Preprocessor: Empty foreground for normalization')
+        return float(mean), float(np.sqrt(m2 / count))
+
+    @staticmethod
+    def apply_normalization(image: sitk.Image, statistics: tuple, in_place=False) -> sitk.Image:
+        """
+        Z-score нормализация изображения по заранее вычисленным статистикам в float32.
+        Изображение float32 при in_place изменяется без копирования, иначе копируется один раз
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - statistics (tuple): Среднее и стандартное отклонение
+        - in_place (bool): Флаг, разрешающий изменить входное изображение float32
+
+        Возвращает:
+        - normalized_image (sitk.Image): Нормализованное изображение float32
+        """
+        mu, std = statistics
+        if image.GetPixelID() != sitk.sitkFloat32:
+            normalized_image = sitk.Cast(image, sitk.sitkFloat32)
+        else:
+            # Неглубокая копия разделяет буфер, при изменении SimpleITK скопирует его (копирование при записи)
+            normalized_image = image if in_place else sitk.Image(image)
+        # Операторы на месте вызываются без присваивания: возвращаемый ими объект разделяет буфер
+        # с исходным, и следующая операция на месте скопировала бы весь объем
+        normalized_image.__isub__(mu)
+        normalized_image.__imul__(1.0 / std)
+        return normalized_image
+
+    @staticmethod
+    def resampling_grid(image: sitk.Image, spacing=OUTPUT_SPACING) -> dict:
+        """
+        Сетка ресэмплирования с шагом spacing, покрывающая изображение
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - spacing (tuple): Шаг выходной сетки в мм
+
+        Возвращает:
+        - grid (dict): Размер, начало координат, шаг и направление выходной сетки
+        """
+        return {
+            'size': np.rint(np.array(image.GetSize()) * image.GetSpacing() / spacing).astype(int).tolist(),
+            'outputOrigin': image.GetOrigin(),
+            'outputSpacing': spacing,
+            'outputDirection': image.GetDirection(),
+        }
+
+    @staticmethod
+    @traced('resample')
+    def resample_to_grid(image: sitk.Image, grid: dict, interpolator: int) -> sitk.Image:
+        """
+        Ресэмплирование изображения на заданную сетку. Изображение с плавающей точкой ресэмплируется в float32,
+        маска сохраняет свой тип
+
+        Параметры:
+        - image (sitk.Image): Входное изображение
+        - grid (dict): Сетка ресэмплирования
+        - interpolator (int): Интерполятор SimpleITK
+
+        Возвращает:
+        - resampled_image (sitk.Image): Ресэмплированное изображение
+        """
+        annotate(voxels=image.GetNumberOfPixels())
+        pixel_type = image.GetPixelID() if interpolator == sitk.sitkNearestNeighbor else sitk.sitkFloat32
+        return sitk.Resample(
+            image1=image,
+            transform=sitk.Transform(),
+            interpolator=interpolator,
+            outputPixelType=pixel_type,
+            **grid
+        )
+
+    @staticmethod
+    def mask_bounding_box(mask: sitk.Image, label=1) -> tuple:
+        """
+        Ограничивающий бокс метки в маске
+
+        Параметры:
+        - mask (sitk.Image): Входная маска
+        - label (int): Метка области интереса
+
+        Возвращает:
+        - index (np.ndarray): Начальный индекс бокса в порядке (x, y, z)
+        - size (np.ndarray): Размер бокса в порядке (x, y, z)
+        """
+        roi = sitk.GetArrayViewFromImage(mask) == label
+        bounds = []
+        # Массив хранится в порядке (z, y, x), бокс возвращается в порядке SimpleITK (x, y, z)
+        for axis in (2, 1, 0):
+            nonzero = np.flatnonzero(roi.any(axis=tuple(a for a in range(3) if a != axis)))
+            if nonzero.size == 0:
+                logging.error('Preprocessor: Label not found in mask')
+                raise ValueError(f'Preprocessor: Label {label} not found in mask')
+            bounds.append((nonzero[0], nonzero[-1] + 1))
+        bounds = np.array(bounds)
+        return bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+
+    def roi_preprocessing_step(self, image_path, mask_path, normalize=True, resample=True,
+                               margin=CROP_MARGIN, label=1, statistics=None) -> tuple:
+        """
+        Предобработка только области маски: изображение читается и обрабатывается в пределах
+        ограничивающего бокса метки с отступом. Статистики нормализации берутся по всему изображению
+        или передаются заранее вычисленными, тогда изображение читается с диска только в пределах бокса.
+        Ресэмплирование выполняется на той же сетке 1 мм, что и для полного изображения
+
+        Параметры:
+        - image_path (str | sitk.Image): Путь к входному изображению или изображение
+        - mask_path (str | sitk.Image): Путь к входной маске или маска
+        - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+        - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        - margin (int): Отступ вокруг бокса в вокселях
+        - label (int): Метка области интереса
+        - statistics (tuple): Заранее вычисленные среднее и стандартное отклонение для нормализации
+
+        Возвращает:
+        - new_image (sitk.Image): Предобработанная область изображения
+        - new_mask (sitk.Image): Предобработанная область маски
+        """
+        logging.info('Preprocessor: Preprocessing ROI')
+        if isinstance(mask_path, sitk.Image):
+            mask = mask_path
+        elif isinstance(mask_path, str) and os.path.isfile(mask_path):
+            mask = read_image(mask_path)
+        else:
+            logging.error('Preprocessor: Error reading mask Filepath or SimpleITK object')
+            raise ValueError('Preprocessor: Error reading mask Filepath or SimpleITK object')
+
+        # Геометрия изображения берется из заголовка файла или из самого изображения
+        if isinstance(image_path, sitk.Image):
+            header = image_path
+        elif isinstance(image_path, str) and os.path.isfile(image_path):
+            header = sitk.ImageFileReader()
+            header.SetFileName(image_path)
+            header.ReadImageInformation()
+        else:
+            logging.error('Preprocessor: Error reading image Filepath or SimpleITK object')
+            raise ValueError('Preprocessor: Error reading image Filepath or SimpleITK object')
+
+        if header.GetSize() != mask.GetSize():
+            logging.warning('Preprocessor: Image and mask grids differ, falling back to full volume')
+            return self.preprocessing_step(image_path, mask_path, normalize=normalize, resample=resample)
+
+        image_size = np.array(header.GetSize())
+        spacing = np.array(header.GetSpacing())
+        roi_index, roi_size = self.mask_bounding_box(mask, label)
+        crop_start, crop_stop = roi_index, roi_index + roi_size
+
+        if resample:
+            # Область на полной сетке 1 мм, покрывающая бокс: ближайший сосед переносит крайний воксель маски
+            # на полшага в каждую сторону, поэтому окно расширяется на ceil(spacing / 2) + 1 выходных вокселей
+            output_size = np.rint(image_size * spacing).astype(int)
+            footprint = np.ceil(spacing / 2).astype(int) + 1
+            output_start = np.clip(np.floor(roi_index * spacing).astype(int) - footprint, 0, output_size - 1)
+            output_stop = np.clip(np.ceil((crop_stop - 1) * spacing).astype(int) + footprint + 1, 1, output_size)
+            crop_start = np.floor(output_start / spacing).astype(int)
+            crop_stop = np.ceil((output_stop - 1) / spacing).astype(int) + 1
+
+        crop_start = np.maximum(crop_start - margin, 0)
+        crop_stop = np.minimum(crop_stop + margin, image_size)
+        crop_size = (crop_stop - crop_start).tolist()
+        crop_start = crop_start.tolist()
+
+        if isinstance(header, sitk.Image) or normalize and statistics is None:
+            full_image = header if isinstance(header, sitk.Image) else read_image(image_path)
+            if normalize and statistics is None:
+                logging.info('Preprocessor: Computing normalization statistics on full image')
+                statistics = self.normalization_statistics(full_image)
+            image = sitk.RegionOfInterest(full_image, crop_size, crop_start)
+            del full_image
+        else:
+            logging.info('Preprocessor: Reading image ROI')
+            image = read_image(image_path, crop_start, crop_size)
+        mask = sitk.RegionOfInterest(mask, crop_size, crop_start)
+
+        if normalize:
+            logging.info('Preprocessor: Normalizing image ROI')
+            # Вырезанная область - собственная копия, ее можно нормализовать на месте
+            image = self.apply_normalization(image, statistics, in_place=True)
+
+        if resample:
+            logging.info('Preprocessor: Resampling image and mask ROI')
+            direction = np.array(header.GetDirection()).reshape(3, 3)
+            grid = {
+                'size': (output_stop - output_start).tolist(),
+                'outputOrigin': (np.array(header.GetOrigin()) + direction @ output_start).tolist(),
+                'outputSpacing': OUTPUT_SPACING,
+                'outputDirection': header.GetDirection(),
+            }
+            image = self.resample_to_grid(image, grid, sitk.sitkBSpline)
+            mask = self.resample_to_grid(mask, grid, sitk.sitkNearestNeighbor)
+
+        if self.save:
+            logging.info('Preprocessor: Saving image and mask ROI')
+            timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+            sitk.WriteImage(image, 'image' + timestamp + '.nii')
+            sitk.WriteImage(mask, 'mask' + timestamp + '.nii')
+
+        return image, mask
@@ -0,0 +1,305 @@
+from __future__ import annotations
+import argparse
+import csv
+import json
+import logging
+import os
+from lazy_importing import lazy_import
+from model_registry import model_registry
+from multi_lesion import MultiLesionProcessor
+from preprocessing import CROP_MARGIN
+from tracing import annotate, traced
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+
+# Радиусы возмущения маски в вокселях: отрицательный - эрозия, положительный - дилатация
+MASK_RADII = (-1, 1)
+# Числа интервалов дискретизации, проверяемые вместо значения из файла параметров
+BIN_COUNTS = (16, 24, 48, 64)
+ROBUSTNESS_COLUMNS = ['variant', 'mask_radius', 'bin_count', 'voxels', 'prediction', 'probability', 'error']
+
+
+def perturb_mask(mask: sitk.Image, radius: int, in_plane=True) -> sitk.Image:
+    """
+    Эрозия или дилатация бинарной маски шаровым ядром
+
+    Параметры:
+    - mask (sitk.Image): Бинарная маска с меткой 1
+    - radius (int): Радиус в вокселях: отрицательный - эрозия, положительный - дилатация, 0 - без изменений
+    - in_plane (bool): Флаг, указывающий, что маска меняется только в плоскости среза (толстые срезы МРТ)
+
+    Возвращает:
+    - mask (sitk.Image): Измененная маска
+    """
+    if radius == 0:
+        return mask
+    kernel = [abs(radius), abs(radius), 0 if in_plane else abs(radius)]
+    morphology = sitk.BinaryDilate if radius > 0 else sitk.BinaryErode
+    return morphology(mask, kernel, sitk.sitkBall, 0, 1)
+
+
+def variant_name(mask_radius: int, bin_count) -> str:
+    """
+    Название варианта для таблицы результатов
+
+    Параметры:
+    - mask_radius (int): Радиус возмущения маски
+    - bin_count (int | None): Число интервалов, None - значение из файла параметров
+
+    Возвращает:
+    - name (str): Например, 'reference', 'erode 1', 'dilate 2, bins 16'
+    """
+    parts = []
+    if mask_radius:
+        parts.append(f'{"dilate" if mask_radius > 0 else "erode"} {abs(mask_radius)}')
+    if bin_count is not None:
+        parts.append(f'bins {bin_count}')
+    return ', '.join(parts) or 'reference'
+
+
+def stability_summary(rows: list) -> dict:
+    """
+    Сводка устойчивости предсказания по вариантам
+
+    Параметры:
+    - rows (list): Результаты вариантов, первый - исходная маска и дискретизация
+
+    Возвращает:
+    - summary (dict): Предсказание и вероятность исходного варианта, число оцененных и неудачных вариантов,
+      доля вариантов с тем же предсказанием, флаг устойчивости, диапазон вероятности, наибольшее отклонение
+      вероятности от исходной и варианты со сменой предсказания
+    """
+    reference = rows[0]
+    scored = [row for row in rows if row['prediction'] is not None]
+    summary = {
+        'prediction': reference['prediction'],
+        'probability': reference['probability'],
+        'variants': len(scored),
+        'failed': len(rows) - len(scored),
+        'agreement': None,
+        'stable': None,
+        'probability_min': None,
+        'probability_max': None,
+        'max_deviation': None,
+        'flipped': []
+    }
+    if reference['prediction'] is None or not scored:
+        return summary
+    probabilities = [row['probability'] for row in scored]
+    summary['flipped'] = [row['variant'] for row in scored if row['prediction'] != reference['prediction']]
+    summary['agreement'] = 1 - len(summary['flipped']) / len(scored)
+    summary['stable'] = not summary['flipped']
+    summary['probability_min'] = min(probabilities)
+    summary['probability_max'] = max(probabilities)
+    summary['max_deviation'] = max(abs(probability - reference['probability']) for probability in probabilities)
+    return summary
+
+
+class RobustnessAnalyzer:
+    """
+    Класс RobustnessAnalyzer предназначен для проверки устойчивости предсказания к небольшим ошибкам сегментации
+    и выбору дискретизации: изображение предобрабатывается и обрезается по маске один раз, маска подвергается
+    эрозии и дилатации, для каждой маски признаки всех чисел интервалов извлекаются одним вызовом
+    (реализация на NumPy обрезает маску и находит соседей вокселей один раз), все варианты оцениваются
+    одним вызовом классификатора
+
+    Атрибуты:
+    - model (str): Название модели
+    - mri_modality (str): Модальность МРТ
+    - backend (str): Реализация извлечения признаков
+    - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+    - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+    - mask_radii (tuple): Радиусы эрозии (< 0) и дилатации (> 0) в вокселях
+    - bin_counts (tuple): Числа интервалов дискретизации
+    - in_plane (bool): Флаг, указывающий, что маска меняется только в плоскости среза
+    - grid (bool): Флаг, указывающий, что проверяются все сочетания масок и чисел интервалов,
+      иначе каждое возмущение отдельно
+
+    Методы:
+    - __init__(self, model, mri_modality='T2', backend='pyradiomics', normalize=True, resample=False,
+      mask_radii=MASK_RADII, bin_counts=BIN_COUNTS, in_plane=True, grid=False): Инициализация класса
+      RobustnessAnalyzer
+    - variants(self) -> list: Сочетания (радиус маски, число интервалов) в порядке оценки
+    - analyze(self, image, mask, clinical_data) -> dict: Анализ предобработанного случая
+    - process(self, image_path, mask_path, clinical_data) -> dict: Предобработка и анализ случая
+    """
+
+    def __init__(self, model: str, mri_modality='T2', backend='pyradiomics', normalize=True, resample=False,
+                 mask_radii=MASK_RADII, bin_counts=BIN_COUNTS, in_plane=True, grid=False):
+        """
+        Инициализация класса RobustnessAnalyzer
+
+        Параметры:
+        - model (str): Название модели
+        - mri_modality (str): Модальность МРТ, может быть 'T1' или 'T2'
+        - backend (str): Реализация извлечения признаков, 'pyradiomics' или 'numpy' (быстрее для интерактивной
+          работы)
+        - normalize (bool): Флаг, указывающий, нужно ли нормализовать изображение
+        - resample (bool): Флаг, указывающий, нужно ли ресэмплировать изображение и маску
+        - mask_radii (tuple): Радиусы эрозии (< 0) и дилатации (> 0) в вокселях
+        - bin_counts (tuple): Числа интервалов дискретизации вместо значения из файла параметров
+        - in_plane (bool): Флаг, указывающий, что маска меняется только в плоскости среза
+        - grid (bool): Флаг, указывающий, что проверяются все сочетания масок и чисел интервалов
+        """
+        logging.info('Robustness: Initializing RobustnessAnalyzer class')
+        if any(not isinstance(bin_count, int) or bin_count < 2 for bin_count in bin_counts):
+            logging.error('Robustness: Invalid bin count')
+            raise ValueError('Robustness: Bin counts must be integers greater than 1')
+        self.model = model
+        self.mri_modality = mri_modality
+        self.backend = backend
+        self.normalize = normalize
+        self.resample = resample
+        self.mask_radii = tuple(dict.fromkeys(int(radius) for radius in mask_radii if radius))
+        self.bin_counts = tuple(dict.fromkeys(bin_counts))
+        self.in_plane = in_plane
+        self.grid = grid
+
+    def variants(self) -> list:
+        """
+        Сочетания возмущений в порядке оценки, первое - исходная маска и дискретизация
+
+        Возвращает:
+        - variants (list): Пары (радиус маски, число интервалов или None - значение из файла параметров)
+        """
+        default_bin_count = model_registry.get(self.model, self.backend).feature_extractor.extractor.settings.get(
+            'binCount')
+        bin_counts = [None] + [bin_count for bin_count in self.bin_counts if bin_count != default_bin_count]
+        if self.grid:
+            return [(radius, bin_count) for radius in (0,) + self.mask_radii for bin_count in bin_counts]
+        return [(0, bin_count) for bin_count in bin_counts] + [(radius, None) for radius in self.mask_radii]
+
+    @traced('robustness')
+    def analyze(self, image: sitk.Image, mask: sitk.Image, clinical_data: dict) -> dict:
+        """
+        Анализ устойчивости предобработанного случая
+
+        Параметры:
+        - image (sitk.Image): Предобработанное изображение
+        - mask (sitk.Image): Предобработанная маска
+        - clinical_data (dict): Клинические данные пациента
+
+        Возвращает:
+        - result (dict): 'rows' - результаты вариантов (словари со столбцами ROBUSTNESS_COLUMNS),
+          'summary' - сводка stability_summary
+        """
+        registered_model = model_registry.get(self.model, self.backend)
+        settings = registered_model.feature_extractor.extractor.settings
+        label = settings.get('label', 1)
+        roi = sitk.Cast(mask == label, sitk.sitkUInt8)
+        if (roi.GetSize(), roi.GetSpacing(), roi.GetOrigin(), roi.GetDirection()) != \
+                (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()):
+            # Маска переносится на сетку изображения, как correctMask, чтобы возмущения и обрезка шли по индексам
+            logging.info('Robustness: Resampling mask to image grid')
+            roi = sitk.Resample(roi, image, sitk.Transform(), sitk.sitkNearestNeighbor)
+        statistics = sitk.LabelShapeStatisticsImageFilter()
+        statistics.Execute(roi)
+        if 1 not in statistics.GetLabels():
+            logging.error('Robustness: Label not found in mask')
+            raise ValueError('Robustness: Label not found in mask')
+
+        # Общая область для всех вариантов: отступ вмещает самую сильную дилатацию
+        margin = CROP_MARGIN + max([radius for radius in self.mask_radii if radius > 0], default=0)
+        image, roi = MultiLesionProcessor.crop(image, roi, {'label': 1, 'bounding_box': statistics.GetBoundingBox(1)},
+                                               margin)
+        variants = self.variants()
+        annotate(variants=len(variants))
+
+        rows, records = [], []
+        for radius in dict.fromkeys(radius for radius, _ in variants):
+            bin_counts = [bin_count for variant_radius, bin_count in variants if variant_radius == radius]
+            variant_mask = perturb_mask(roi, radius, self.in_plane)
+            voxels = int(np.count_nonzero(sitk.GetArrayViewFromImage(variant_mask)))
+            variant_rows = [{'variant': variant_name(radius, bin_count), 'mask_radius': radius,
+                             'bin_count': settings.get('binCount') if bin_count is None else bin_count,
+                             'voxels': voxels, 'prediction': None, 'probability': None, 'error': ''}
+                            for bin_count in bin_counts]
+            rows.extend(variant_rows)
+            try:
+                features = registered_model.feature_extractor.extract_bin_counts(image, variant_mask, bin_counts)
+                records.extend((row, variant_features | clinical_data)
+                               for row, variant_features in zip(variant_rows, features))
+            except Exception as e:
+                # Маска, исчезнувшая после эрозии, не прерывает проверку остальных вариантов
+                logging.error(f'Robustness: Mask radius {radius} failed: {e}')
+                for row in variant_rows:
+                    row['error'] = repr(e)
+
+        if records:
+            predictions, probabilities = registered_model.predictor.predict_batch([record for _, record in records])
+            for (row, _), prediction, probability in zip(records, predictions, probabilities):
+                row['prediction'] = int(prediction)
+                row['probability'] = float(probability[-1])
+        summary = stability_summary(rows)
+        logging.info(f'Robustness: {len(summary["flipped"])} of {summary["variants"]} variants change the prediction')
+        return {'rows': rows, 'summary': summary}
+
+    def process(self, image_path, mask_path, clinical_data: dict) -> dict:
+        """
+        Предобработка и анализ устойчивости случая
+
+        Параметры:
+        - image_path (str | sitk.Image): Путь к изображению или изображение
+        - mask_path (str | sitk.Image): Путь к маске или маска
+        - clinical_data (dict): Клинические данные пациента
+
+        Возвращает:
+        - result (dict): Результат analyze
+        """
+        image, mask = model_registry.preprocessor(self.mri_modality).preprocessing_step(
+            image_path, mask_path, normalize=self.normalize, resample=self.resample
+        )
+        return self.analyze(image, mask, clinical_data)
+
+
+def write_results(rows: list, output_path: str) -> None:
+    """
+    Запись таблицы результатов по вариантам
+
+    Параметры:
+    - rows (list): Результаты RobustnessAnalyzer.analyze
+    - output_path (str): Путь к CSV-таблице
+    """
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=ROBUSTNESS_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    from batch_processing import read_clinical_data
+
+    parser = argparse.ArgumentParser(description='Prediction stability under mask and discretization perturbations')
+    parser.add_argument('image', help='Image file')
+    parser.add_argument('mask', help='Mask file')
+    parser.add_argument('clinical', help='Clinical data file, e.g. "Age: 64, Sex: M, Manufacturer: Philips"')
+    parser.add_argument('output', help='CSV table with one row per variant')
+    parser.add_argument('--summary', default=None,
+                        help='JSON file with the stability summary (default: <output>_summary.json)')
+    parser.add_argument('--model', default='liver_t2w_xgboost')
+    parser.add_argument('--modality', default='T2', choices=['T1', 'T2'])
+    parser.add_argument('--radii', type=int, nargs='*', default=list(MASK_RADII),
+                        help='Mask radii in voxels: negative erodes, positive dilates')
+    parser.add_argument('--bin-counts', type=int, nargs='*', default=list(BIN_COUNTS))
+    parser.add_argument('--grid', action='store_true', help='Combine every mask with every bin count')
+    parser.add_argument('--3d', dest='in_plane', action='store_false', help='Erode and dilate across slices too')
+    parser.add_argument('--backend', default='pyradiomics', choices=['pyradiomics', 'numpy'])
+    parser.add_argument('--no-normalize', action='store_true')
+    parser.add_argument('--resample', action='store_true')
+    args = parser.parse_args()
+
+    analyzer = RobustnessAnalyzer(args.model, mri_modality=args.modality, backend=args.backend,
+                                  normalize=not args.no_normalize, resample=args.resample, mask_radii=args.radii,
+                                  bin_counts=args.bin_counts, in_plane=args.in_plane, grid=args.grid)
+    result = analyzer.process(args.image, args.mask, read_clinical_data(args.clinical))
+    write_results(result['rows'], args.output)
+    summary_path = args.summary or os.path.splitext(args.output)[0] + '_summary.json'
+    with open(summary_path, 'w') as f:
+        json.dump(result['summary'], f, indent=2)
+    logging.info(f'Robustness: Variants written to {args.output}, summary to {summary_path}')
+
+
+if __name__ == "__main__":
+    logging.info('Robustness: Robustness analysis started')
+    main()
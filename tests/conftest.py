@@ -0,0 +1,46 @@
+import logging
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODEL = 'liver_t2w_xgboost'
+CASE_DIR = os.path.join(ROOT, 'test_data', 'Liver165')
+IMAGE_PATH = os.path.join(CASE_DIR, 'image.nii.gz')
+MASK_PATH = os.path.join(CASE_DIR, 'segmentation.nii.gz')
+CLINICAL_DATA = {'age': 64, 'sex': 'M', 'manufacturer': 'Philips'}
+# Вероятность положительного класса для Liver165 с настройками по умолчанию
+PROBABILITY = 0.7779461
+
+
+@pytest.fixture(scope='session', autouse=True)
+def repo_root():
+    # Пути к моделям и параметрам заданы относительно корня репозитория
+    previous = os.getcwd()
+    os.chdir(ROOT)
+    logging.getLogger('radiomics').setLevel(logging.ERROR)
+    yield ROOT
+    os.chdir(previous)
+
+
+@pytest.fixture(scope='session')
+def registered_model():
+    from model_registry import model_registry
+    return model_registry.get(MODEL)
+
+
+def relative_difference(expected: dict, actual: dict) -> dict:
+    """
+    Относительное отклонение признаков
+
+    Параметры:
+    - expected (dict): Эталонные признаки
+    - actual (dict): Проверяемые признаки
+
+    Возвращает:
+    - difference (dict): Относительное отклонение каждого признака эталона
+    """
+    return {name: abs(float(actual[name]) - float(value)) / max(abs(float(value)), 1e-12)
+            for name, value in expected.items()}
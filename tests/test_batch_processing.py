@@ -0,0 +1,40 @@
+import csv
+import os
+import shutil
+import pytest
+from batch_processing import BatchProcessor, read_clinical_data
+from conftest import CASE_DIR, CLINICAL_DATA, MODEL, PROBABILITY, ROOT
+
+
+def read_rows(path: str) -> list:
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    shutil.copytree(CASE_DIR, tmp_path / 'cohort' / 'Liver165')
+    # Случай без изображения завершается ошибкой
+    shutil.copytree(os.path.join(ROOT, 'test_data', 'Liver184'), tmp_path / 'cohort' / 'Liver184')
+    return tmp_path / 'cohort'
+
+
+def test_read_clinical_data():
+    assert read_clinical_data(os.path.join(CASE_DIR, 'clinical_data.txt')) == CLINICAL_DATA
+
+
+def test_run_writes_results_and_keeps_errors_on_resume(cohort, tmp_path):
+    output_path = str(tmp_path / 'results.csv')
+    errors_path = str(tmp_path / 'results_errors.csv')
+    processor = BatchProcessor(MODEL, workers=1, cache_path=None)
+
+    assert processor.run(str(cohort), output_path) == {'processed': 1, 'skipped': 0, 'failed': 1}
+    results = read_rows(output_path)
+    assert [row['case'] for row in results] == ['Liver165']
+    assert float(results[0]['probability']) == pytest.approx(PROBABILITY, abs=1e-6)
+    assert [row['case'] for row in read_rows(errors_path)] == ['Liver184']
+
+    # Повторный запуск пропускает готовые случаи и дописывает ошибки к прежним
+    assert processor.run(str(cohort), output_path) == {'processed': 0, 'skipped': 1, 'failed': 1}
+    assert len(read_rows(output_path)) == 1
+    assert [row['case'] for row in read_rows(errors_path)] == ['Liver184', 'Liver184']
@@ -0,0 +1,58 @@
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import pytest
+import SimpleITK as sitk
+import image_loading
+from conftest import IMAGE_PATH, ROOT
+from image_loading import read_image, read_image_buffer
+from volume_store import VOLUME_STORE_ENV, VolumeStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = VolumeStore(str(tmp_path / 'volumes'))
+    monkeypatch.setattr(image_loading, 'volume_store', store)
+    return store
+
+
+def stored_files(store: VolumeStore) -> list:
+    return [name for name in os.listdir(store.path) if name.endswith('.npy')] if os.path.isdir(store.path) else []
+
+
+@pytest.mark.parametrize('environment, enabled', [({}, False), ({VOLUME_STORE_ENV: ''}, False),
+                                                  ({VOLUME_STORE_ENV: 'cache/volumes'}, True)])
+def test_volume_store_is_opt_in(environment, enabled):
+    env = {name: value for name, value in os.environ.items() if name != VOLUME_STORE_ENV} | environment
+    code = 'from volume_store import volume_store; print(volume_store.enabled)'
+    completed = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True,
+                               check=True)
+    assert completed.stdout.strip() == str(enabled)
+
+
+def test_uploaded_buffer_skips_volume_store(store):
+    with open(IMAGE_PATH, 'rb') as f:
+        image = read_image_buffer(f.read(), 'image.nii.gz')
+    assert image.GetSize() == sitk.ReadImage(IMAGE_PATH).GetSize()
+    assert stored_files(store) == []
+    assert store.misses == 0
+
+
+def test_file_is_read_through_enabled_store(store):
+    expected = sitk.GetArrayFromImage(sitk.ReadImage(IMAGE_PATH))
+    for _ in range(2):
+        assert (sitk.GetArrayFromImage(read_image(IMAGE_PATH)) == expected).all()
+    assert len(stored_files(store)) == 1
+    assert (store.misses, store.hits) == (1, 1)
+
+
+def test_buffer_without_memory_dir_warns_and_removes_file(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(image_loading, 'MEMORY_DIR', None)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    with open(IMAGE_PATH, 'rb') as f, caplog.at_level(logging.WARNING):
+        image = read_image_buffer(f.read(), 'image.nii.gz')
+    assert image.GetSize() == sitk.ReadImage(IMAGE_PATH).GetSize()
+    assert 'No in-memory directory' in caplog.text
+    assert os.listdir(tmp_path) == []
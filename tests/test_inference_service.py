@@ -0,0 +1,131 @@
+import http.client
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler
+from conftest import CLINICAL_DATA, IMAGE_PATH, MASK_PATH, PROBABILITY
+from inference_service import BoundedThreadingHTTPServer, InferenceService, parse_multipart
+
+BOUNDARY = 'test-boundary'
+CONTENT_TYPE = f'multipart/form-data; boundary={BOUNDARY}'
+
+
+def encode_multipart(fields: dict) -> bytes:
+    """
+    Сборка тела multipart/form-data
+
+    Параметры:
+    - fields (dict): {имя поля: (имя файла или None, содержимое bytes)}
+
+    Возвращает:
+    - body (bytes): Тело запроса
+    """
+    body = b''
+    for name, (filename, content) in fields.items():
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        body += f'--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + content + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+
+def case_fields() -> dict:
+    with open(IMAGE_PATH, 'rb') as image_file, open(MASK_PATH, 'rb') as mask_file:
+        return {'image': ('image.nii.gz', image_file.read()), 'mask': ('segmentation.nii.gz', mask_file.read()),
+                'clinical': (None, json.dumps(CLINICAL_DATA).encode())}
+
+
+def post(service: InferenceService, body: bytes) -> tuple:
+    host, port = service.server.server_address[:2]
+    connection = http.client.HTTPConnection(host, port, timeout=120)
+    try:
+        connection.request('POST', '/predict', body, {'Content-Type': CONTENT_TYPE})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+@pytest.fixture(scope='module')
+def service():
+    service = InferenceService(port=0, workers=1, max_pending=2)
+    service.start()
+    yield service
+    service.shutdown()
+
+
+def test_parse_multipart_keeps_file_content():
+    fields = {'image': ('image.nii.gz', b'\x00\r\n--data\r\n'), 'clinical': (None, b'{}')}
+    parts = parse_multipart(CONTENT_TYPE, encode_multipart(fields))
+    assert {name: (filename, bytes(content)) for name, (filename, content) in parts.items()} == fields
+
+
+@pytest.mark.parametrize('content_type, body', [
+    ('application/json', encode_multipart({'clinical': (None, b'{}')})),
+    (CONTENT_TYPE, f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="image"\r\n\r\ntruncated'.encode())
+])
+def test_parse_multipart_rejects_invalid_body(content_type, body):
+    with pytest.raises(ValueError):
+        parse_multipart(content_type, body)
+
+
+def test_predict(service):
+    status, _, body = post(service, encode_multipart(case_fields()))
+    assert status == 200
+    result = json.loads(body)
+    assert result['class'] == 1
+    assert result['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+    assert set(result['timings']) >= {'parse', 'predict', 'queue', 'total'}
+
+
+def test_missing_field_is_rejected(service):
+    fields = case_fields()
+    del fields['mask']
+    status, _, body = post(service, encode_multipart(fields))
+    assert status == 400
+    assert 'mask' in json.loads(body)['error']
+
+
+def test_busy_service_rejects_before_reading_body(service):
+    # Отправляются только заголовки: ответ приходит без передачи тела
+    uploads = service.server.uploads
+    for _ in range(service.job_queue.max_pending):
+        uploads.acquire()
+    connection = http.client.HTTPConnection(*service.server.server_address[:2], timeout=10)
+    try:
+        connection.putrequest('POST', '/predict')
+        connection.putheader('Content-Type', CONTENT_TYPE)
+        connection.putheader('Content-Length', str(2 ** 20))
+        connection.endheaders()
+        response = connection.getresponse()
+    finally:
+        connection.close()
+        for _ in range(service.job_queue.max_pending):
+            uploads.release()
+    assert response.status == 503
+    assert response.getheader('Retry-After') == '5'
+    assert response.getheader('Connection') == 'close'
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.mark.parametrize('max_connections, expected', [(1, 200), (0, 503)])
+def test_connections_over_limit_are_rejected(max_connections, expected):
+    server = BoundedThreadingHTTPServer(('127.0.0.1', 0), OkHandler, max_connections)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*server.server_address[:2], timeout=10)
+        connection.request('GET', '/')
+        assert connection.getresponse().status == expected
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,141 @@
+import pytest
+from conftest import CLINICAL_DATA, IMAGE_PATH, MASK_PATH, MODEL, PROBABILITY
+import job_queue as job_queue_module
+from feature_cache import FEATURE_CACHE_ENV
+from job_queue import JobQueue, process_case
+from memory_scheduling import Admission, memory_scheduler
+from robustness_analysis import RobustnessAnalyzer
+
+
+def read_case() -> dict:
+    with open(IMAGE_PATH, 'rb') as image_file, open(MASK_PATH, 'rb') as mask_file:
+        return {'image_buffer': image_file.read(), 'image_name': 'image.nii.gz',
+                'mask_buffer': mask_file.read(), 'mask_name': 'segmentation.nii.gz'}
+
+
+@pytest.fixture(scope='module')
+def job_queue():
+    queue = JobQueue(workers=1, max_pending=4)
+    queue.warm_up()
+    yield queue
+    queue.shutdown()
+
+
+@pytest.fixture
+def batch_sizes(registered_model, monkeypatch):
+    # Размеры пачек, предсказанных общим MicroBatcher основного процесса
+    sizes = []
+    predict_batch = registered_model.predictor.predict_batch
+
+    def recording_predict_batch(records):
+        sizes.append(len(records))
+        return predict_batch(records)
+
+    monkeypatch.setattr(registered_model.predictor, 'predict_batch', recording_predict_batch)
+    return sizes
+
+
+def test_process_case_predicts_through_batcher(batch_sizes):
+    result = process_case(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+    assert result['prediction'] == 1
+    assert result['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+    assert batch_sizes == [1]
+
+
+def test_process_case_without_prediction_returns_record():
+    result = process_case(**read_case(), clinical_data=CLINICAL_DATA, show=False, predict=False)
+    assert result['prediction'] is None and result['probability'] is None
+    assert result['record']['age'] == CLINICAL_DATA['age']
+
+
+def test_robustness_uses_shared_bin_count_extraction(monkeypatch):
+    backends = []
+
+    class RecordingAnalyzer(RobustnessAnalyzer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            backends.append(self.backend)
+
+    monkeypatch.setattr(job_queue_module, 'RobustnessAnalyzer', RecordingAnalyzer)
+    result = process_case(**read_case(), clinical_data=CLINICAL_DATA, show=False, robustness=True, predict=False)
+    assert backends == ['numpy']
+    expected = RobustnessAnalyzer(MODEL).process(IMAGE_PATH, MASK_PATH, CLINICAL_DATA)['summary']
+    assert result['robustness']['flipped'] == expected['flipped']
+    assert result['robustness']['probability'] == pytest.approx(expected['probability'], abs=1e-6)
+    assert result['robustness']['max_deviation'] == pytest.approx(expected['max_deviation'], abs=1e-6)
+
+
+def test_job_is_predicted_in_parent_batcher(job_queue, batch_sizes):
+    job_id = job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+    status = job_queue.wait(job_id, timeout=120)
+    assert status['state'] == 'done'
+    assert status['result']['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+    assert 'record' not in status['result']
+    assert batch_sizes == [1]
+
+
+def test_failed_job_does_not_affect_others(job_queue):
+    case = read_case()
+    failed = job_queue.submit(**(case | {'image_buffer': b'not an image'}), clinical_data=CLINICAL_DATA, show=False)
+    succeeded = job_queue.submit(**case, clinical_data=CLINICAL_DATA, show=False)
+    assert job_queue.wait(failed, timeout=120)['state'] == 'failed'
+    assert job_queue.wait(failed)['error']
+    status = job_queue.wait(succeeded, timeout=120)
+    assert status['state'] == 'done'
+    assert status['result']['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+
+
+def test_job_cancelled_in_queue_never_runs(job_queue):
+    # Весь бюджет памяти занят, поэтому задача ждет в очереди планировщика
+    blocker = Admission(memory_scheduler.budget, False, {})
+    memory_scheduler.submit(blocker, lambda: None)
+    try:
+        job_id = job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+        assert job_queue.status(job_id)['state'] == 'queued'
+        assert job_queue.cancel(job_id)
+    finally:
+        memory_scheduler.release(blocker)
+    assert job_queue.wait(job_id, timeout=120)['state'] == 'cancelled'
+    # Задача после отмененной выполняется
+    other = job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+    assert job_queue.wait(other, timeout=120)['state'] == 'done'
+    assert job_queue.status(job_id)['stage'] == 'queued'
+
+
+def test_finished_job_cannot_be_cancelled(job_queue):
+    job_id = job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+    assert job_queue.wait(job_id, timeout=120)['state'] == 'done'
+    assert not job_queue.cancel(job_id)
+
+
+def test_preview_and_stages(job_queue):
+    job_id = job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=True, preview_mode='triplanar')
+    status = job_queue.wait(job_id, timeout=120)
+    assert status['state'] == 'done' and status['progress'] == 1.0
+    assert status['result']['preview'][:2] == b'\xff\xd8'
+
+
+def test_full_queue_rejects_jobs(job_queue, monkeypatch):
+    monkeypatch.setattr(job_queue, 'max_pending', 0)
+    with pytest.raises(ValueError, match='Queue is full'):
+        job_queue.submit(**read_case(), clinical_data=CLINICAL_DATA, show=False)
+
+
+def test_unknown_job(job_queue):
+    with pytest.raises(ValueError, match='Job not found'):
+        job_queue.status('missing')
+    assert job_queue.load()['workers'] == 1
+
+
+def test_upload_features_stay_in_memory_by_default(monkeypatch, tmp_path):
+    monkeypatch.delenv(FEATURE_CACHE_ENV, raising=False)
+    monkeypatch.setattr(job_queue_module, '_feature_cache', None)
+    process_case(**read_case(), clinical_data=CLINICAL_DATA, show=False, predict=False)
+    feature_cache = job_queue_module._get_feature_cache()
+    assert feature_cache.path is None
+    assert feature_cache.stats()['entries'] == 1
+
+    path = tmp_path / 'features.sqlite'
+    monkeypatch.setenv(FEATURE_CACHE_ENV, str(path))
+    monkeypatch.setattr(job_queue_module, '_feature_cache', None)
+    assert job_queue_module._get_feature_cache().path == str(path) and path.exists()
@@ -0,0 +1,172 @@
+import gzip
+import os
+import queue
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import SimpleITK as sitk
+import memory_scheduling
+from conftest import IMAGE_PATH, MASK_PATH, ROOT
+from memory_scheduling import Admission, MemoryScheduler, mask_box, read_header
+from preprocessing import Preprocessor
+
+MIB = 2 ** 20
+
+
+def expected_header(path: str) -> dict:
+    image = sitk.ReadImage(path)
+    return {'size': list(image.GetSize()), 'spacing': pytest.approx(list(image.GetSpacing()), rel=1e-6)}
+
+
+def started(scheduler: MemoryScheduler, costs: list) -> tuple:
+    # Случаи ставятся в очередь по порядку, запущенные приходят в очередь started
+    admissions, started_queue = [Admission(cost, False, {}, cost > scheduler.budget) for cost in costs], queue.Queue()
+    for index, admission in enumerate(admissions):
+        scheduler.submit(admission, lambda index=index: started_queue.put(index))
+    return admissions, started_queue
+
+
+def drain(started_queue: queue.Queue) -> list:
+    indices = []
+    while True:
+        try:
+            indices.append(started_queue.get(timeout=0.2))
+        except queue.Empty:
+            return indices
+
+
+@pytest.mark.parametrize('suffix', ['.nii', '.nii.gz', '.nrrd'])
+def test_read_header(tmp_path, suffix):
+    path = str(tmp_path / f'image{suffix}')
+    sitk.WriteImage(sitk.ReadImage(IMAGE_PATH), path)
+    header = read_header(path)
+    assert {key: header[key] for key in ('size', 'spacing')} == expected_header(IMAGE_PATH)
+    assert header['pixel_bytes'] == sitk.ReadImage(IMAGE_PATH).GetSizeOfPixelComponent()
+
+
+def test_read_header_from_buffer():
+    with open(IMAGE_PATH, 'rb') as f:
+        buffer = f.read()
+    assert read_header(buffer) == read_header(IMAGE_PATH)
+    assert read_header(gzip.decompress(buffer)) == read_header(IMAGE_PATH)
+
+
+def test_plan_reads_headers_only(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('Voxels must not be read while planning')
+
+    monkeypatch.setattr(memory_scheduling, 'read_image', fail)
+    monkeypatch.setattr(memory_scheduling, 'read_image_buffer', fail)
+    with open(IMAGE_PATH, 'rb') as image_file, open(MASK_PATH, 'rb') as mask_file:
+        admission = MemoryScheduler(budget=2 ** 40).plan(image_file.read(), mask_file.read())
+    assert admission.cost > 0 and not admission.crop
+    assert admission.estimates['crop'] is None
+
+
+def test_mask_box():
+    index, size = Preprocessor.mask_bounding_box(sitk.ReadImage(MASK_PATH))
+    expected = (*index.tolist(), *size.tolist())
+    assert mask_box(MASK_PATH) == expected
+    with open(MASK_PATH, 'rb') as f:
+        assert mask_box(f.read(), 'segmentation.nii.gz') == expected
+
+
+def test_mask_box_skips_large_and_unreadable_masks(monkeypatch):
+    assert mask_box(b'not a mask') is None
+    monkeypatch.setattr(memory_scheduling, 'MASK_BOX_LIMIT', 0)
+    assert mask_box(MASK_PATH) is None
+
+
+@pytest.mark.parametrize('resample', [False, True])
+def test_plan_routes_to_crop_when_full_volume_does_not_fit(resample):
+    box = mask_box(MASK_PATH)
+    estimates = MemoryScheduler(budget=2 ** 40).plan(IMAGE_PATH, MASK_PATH, resample=resample, box=box).estimates
+    assert estimates['crop'] < estimates['full']
+
+    fits = MemoryScheduler(budget=estimates['full']).plan(IMAGE_PATH, MASK_PATH, resample=resample, box=box)
+    assert (fits.crop, fits.cost, fits.oversized) == (False, estimates['full'], False)
+    budget = (estimates['crop'] + estimates['full']) // 2
+    cropped = MemoryScheduler(budget=budget).plan(IMAGE_PATH, MASK_PATH, resample=resample, box=box)
+    assert (cropped.crop, cropped.cost, cropped.oversized) == (True, estimates['crop'], False)
+    oversized = MemoryScheduler(budget=estimates['crop'] - 1).plan(IMAGE_PATH, MASK_PATH, resample=resample, box=box)
+    assert oversized.crop and oversized.oversized
+    # Без бокса путь по области не оценивается
+    unknown = MemoryScheduler(budget=budget).plan(IMAGE_PATH, MASK_PATH, resample=resample)
+    assert not unknown.crop and unknown.oversized
+
+
+def test_unreadable_header_is_admitted_without_estimate():
+    admission = MemoryScheduler(budget=MIB).plan(b'not an image', b'not a mask')
+    assert (admission.cost, admission.crop, admission.oversized) == (0, False, False)
+    assert admission.estimates == {'full': None, 'crop': None}
+
+
+def test_cases_wait_in_fifo_order():
+    scheduler = MemoryScheduler(budget=100)
+    admissions, started_queue = started(scheduler, [60, 60, 30])
+    # Третий случай помещается в остаток бюджета, но ждет второго
+    assert drain(started_queue) == [0]
+    assert scheduler.stats()['waiting'] == 2
+    scheduler.release(admissions[0])
+    assert drain(started_queue) == [1, 2]
+    assert scheduler.reserved == 90
+    for admission in admissions[1:]:
+        scheduler.release(admission)
+    assert scheduler.stats()['reserved'] == 0
+
+
+def test_oversized_case_runs_alone():
+    scheduler = MemoryScheduler(budget=100)
+    admissions, started_queue = started(scheduler, [10, 150, 10])
+    assert drain(started_queue) == [0]
+    scheduler.release(admissions[0])
+    assert drain(started_queue) == [1]
+    scheduler.release(admissions[1])
+    assert drain(started_queue) == [2]
+    scheduler.release(admissions[2])
+    assert scheduler.stats()['oversized'] == 1
+
+
+def test_submit_measured_plans_with_mask_box():
+    scheduler = MemoryScheduler(budget=2 ** 40)
+    admissions = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        scheduler.submit_measured(executor, admissions.put, IMAGE_PATH, MASK_PATH)
+        admission = admissions.get(timeout=30)
+    assert admission.estimates['crop'] is not None
+    scheduler.release(admission)
+
+
+def test_submit_measured_without_executor_plans_without_box():
+    scheduler = MemoryScheduler(budget=2 ** 40)
+    executor = ThreadPoolExecutor(max_workers=1)
+    executor.shutdown()
+    admissions = queue.Queue()
+    scheduler.submit_measured(executor, admissions.put, IMAGE_PATH, MASK_PATH)
+    admission = admissions.get(timeout=30)
+    assert admission.cost > 0 and admission.estimates['crop'] is None
+    scheduler.release(admission)
+
+
+def test_budget_without_measurable_memory(monkeypatch):
+    monkeypatch.delenv(memory_scheduling.MEMORY_BUDGET_ENV, raising=False)
+    monkeypatch.setattr(memory_scheduling, 'get_available_memory', lambda: 0)
+    scheduler = MemoryScheduler()
+    assert 0 < scheduler.budget < memory_scheduling.UNLIMITED_BUDGET
+
+    def unsupported(name):
+        raise ValueError(name)
+
+    monkeypatch.setattr(memory_scheduling.os, 'sysconf', unsupported)
+    assert MemoryScheduler().budget == memory_scheduling.UNLIMITED_BUDGET
+
+
+def test_entry_points_import_without_measurable_memory():
+    code = ('import memory_monitoring; memory_monitoring.get_available_memory = lambda: 0; '
+            'import batch_processing, inference_service, job_queue; '
+            'from memory_scheduling import memory_scheduler; print(memory_scheduler.budget > 0)')
+    env = {name: value for name, value in os.environ.items() if name != memory_scheduling.MEMORY_BUDGET_ENV}
+    completed = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert completed.returncode == 0, completed.stderr[-500:]
+    assert completed.stdout.split()[-1] == 'True'
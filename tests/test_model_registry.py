@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+import pytest
+import model_registry as registry_module
+from conftest import MODEL
+from model_registry import MODEL_SUFFIX, PARAMS_SUFFIX, ModelRegistry
+from tree_ensemble import TREES_SUFFIX
+
+
+class FakeModel:
+    # Замена RegisteredModel без загрузки файлов; модель 'slow' загружается до события release
+    loads = []
+    release = threading.Event()
+
+    def __init__(self, name, mtimes, backend='pyradiomics', workers=1):
+        self.loads.append(name)
+        if name == 'slow':
+            self.release.wait(10)
+        self.name = name
+        self.mtimes = mtimes
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    for name in ('fast', 'slow'):
+        (tmp_path / (name + PARAMS_SUFFIX)).touch()
+        (tmp_path / (name + MODEL_SUFFIX)).touch()
+    FakeModel.loads = []
+    FakeModel.release.clear()
+    monkeypatch.setattr(registry_module, 'RegisteredModel', FakeModel)
+    return ModelRegistry(params_dir=str(tmp_path), models_dir=str(tmp_path))
+
+
+def test_get_reloads_when_trees_file_changes(registry, tmp_path):
+    first = registry.get('fast')
+    assert registry.get('fast') is first
+
+    trees_path = tmp_path / ('fast' + TREES_SUFFIX)
+    trees_path.touch()
+    second = registry.get('fast')
+    assert second is not first
+    os.utime(trees_path, (time.time() + 10, time.time() + 10))
+    assert registry.get('fast') is not second
+    assert FakeModel.loads == ['fast', 'fast', 'fast']
+
+
+def test_loading_one_model_does_not_block_others(registry):
+    loader = threading.Thread(target=registry.get, args=('slow',))
+    loader.start()
+    while 'slow' not in FakeModel.loads:
+        time.sleep(0.01)
+    start = time.perf_counter()
+    registry.get('fast')
+    assert time.perf_counter() - start < 1
+    assert loader.is_alive()
+    FakeModel.release.set()
+    loader.join()
+
+
+def test_concurrent_gets_load_once(registry):
+    threads = [threading.Thread(target=registry.get, args=('slow',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    FakeModel.release.set()
+    for thread in threads:
+        thread.join()
+    assert FakeModel.loads == ['slow']
+
+
+def test_missing_model():
+    with pytest.raises(ValueError, match='Model not found'):
+        ModelRegistry().get('missing')
+
+
+def test_real_model_is_shared(registered_model):
+    assert registry_module.model_registry.get(MODEL) is registered_model
@@ -0,0 +1,86 @@
+import csv
+import logging
+import os
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from conftest import CASE_DIR, CLINICAL_DATA, IMAGE_PATH, MASK_PATH, MODEL, PROBABILITY
+import multi_lesion
+from image_loading import read_image
+from multi_lesion import MultiLesionProcessor
+
+
+def synthetic_mask(labels: bool) -> sitk.Image:
+    # Два образования 4x4x4 и 3x3x3 вокселя и одно шумовое в 2 вокселя
+    array = np.zeros((20, 20, 20), dtype=np.uint8)
+    array[2:6, 2:6, 2:6] = 1
+    array[10:13, 10:13, 10:13] = 2 if labels else 1
+    array[17, 17, 17:19] = 3 if labels else 1
+    mask = sitk.GetImageFromArray(array)
+    mask.SetSpacing((0.5, 0.5, 2.0))
+    return mask
+
+
+@pytest.fixture(scope='module')
+def processor():
+    processor = MultiLesionProcessor(MODEL, workers=1)
+    yield processor
+    processor.shutdown()
+
+
+@pytest.mark.parametrize('labels, mode', [(True, 'auto'), (True, 'labels'), (False, 'auto'), (False, 'components')])
+def test_find_lesions_splits_lesions(labels, mode):
+    label_image, lesions = MultiLesionProcessor.find_lesions(synthetic_mask(labels), mode=mode)
+    assert [lesion['voxels'] for lesion in lesions] == [64, 27]
+    assert lesions[0]['volume_mm3'] == pytest.approx(64 * 0.5)
+    assert lesions[0]['bounding_box'] == (2, 2, 2, 4, 4, 4)
+    crop_image, crop_mask = MultiLesionProcessor.crop(label_image, label_image, lesions[1], margin=1)
+    assert crop_image.GetSize() == (5, 5, 5)
+    assert sitk.GetArrayViewFromImage(crop_mask).sum() == 27
+
+
+def test_labels_and_components_differ_for_touching_labels():
+    # Воксель метки 2 касается образования 1: метки остаются раздельными, компоненты сливаются
+    mask = synthetic_mask(labels=True)
+    mask[5, 5, 6] = 2
+    _, lesions = MultiLesionProcessor.find_lesions(mask, mode='labels', min_size=1)
+    assert [lesion['voxels'] for lesion in lesions] == [64, 28, 2]
+    _, components = MultiLesionProcessor.find_lesions(mask, mode='components', min_size=1)
+    assert [lesion['voxels'] for lesion in components] == [65, 27, 2]
+
+
+def test_process_single_lesion(processor):
+    rows = processor.process(IMAGE_PATH, MASK_PATH, CLINICAL_DATA)
+    assert len(rows) == 1
+    assert rows[0]['error'] == ''
+    assert rows[0]['prediction'] == 1
+    assert rows[0]['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+
+
+def test_mask_on_other_grid_is_resampled_before_search(processor):
+    # Маска на более грубой сдвинутой сетке: границы образования должны считаться на сетке изображения
+    image, mask = read_image(IMAGE_PATH), read_image(MASK_PATH)
+    coarse = sitk.Image([size // 2 for size in mask.GetSize()[:2]] + [mask.GetSize()[2]], mask.GetPixelID())
+    coarse.SetSpacing([spacing * 2 for spacing in mask.GetSpacing()[:2]] + [mask.GetSpacing()[2]])
+    coarse.SetOrigin(np.add(mask.GetOrigin(), (3.0, -2.0, 0.0)).tolist())
+    coarse.SetDirection(mask.GetDirection())
+    coarse = sitk.Resample(mask, coarse, sitk.Transform(), sitk.sitkNearestNeighbor)
+    on_image_grid = sitk.Resample(coarse, image, sitk.Transform(), sitk.sitkNearestNeighbor)
+
+    rows = processor.process(image, coarse, CLINICAL_DATA)
+    assert rows == processor.process(image, on_image_grid, CLINICAL_DATA)
+    assert rows[0]['voxels'] == int(sitk.GetArrayViewFromImage(on_image_grid).astype(bool).sum())
+
+
+def test_main_writes_rows_and_logs_summary(monkeypatch, tmp_path, capsys, caplog):
+    output = str(tmp_path / 'lesions.csv')
+    monkeypatch.setattr(sys, 'argv', ['multi_lesion.py', IMAGE_PATH, MASK_PATH,
+                                      os.path.join(CASE_DIR, 'clinical_data.txt'), output, '--workers', '1'])
+    with caplog.at_level(logging.INFO):
+        multi_lesion.main()
+    assert capsys.readouterr().out == ''
+    with open(output, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1 and rows[0]['prediction'] == '1'
+    assert f'MultiLesion: 1 lesions written to {output}, 1 positive, 0 failed' in caplog.text
@@ -0,0 +1,48 @@
+import pytest
+from radiomics import featureextractor
+from conftest import IMAGE_PATH, MASK_PATH, relative_difference
+from feature_extracting import FeatureExtractor
+from numpy_feature_extracting import SUPPORTED_FEATURES, NumpyFeatureExtractor, compare_with_pyradiomics
+from preprocessing import Preprocessor
+
+PARAMS_PATH = 'params/liver_t2w_xgboost_extracting_params.yaml'
+# Допустимое относительное отклонение от pyradiomics для всех классов признаков: суммы в другом порядке
+TOLERANCE = 1e-12
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['native', 'resampled'])
+def features(request):
+    image, mask = Preprocessor('T2').preprocessing_step(IMAGE_PATH, MASK_PATH, resample=request.param)
+    extractor = featureextractor.RadiomicsFeatureExtractor(PARAMS_PATH)
+    extractor.disableAllFeatures()
+    extractor.enableFeaturesByName(**{name: sorted(names) for name, names in SUPPORTED_FEATURES.items()})
+    expected = {key: float(value) for key, value in extractor.execute(image, mask).items()
+                if 'diagnostics' not in key}
+    return expected, NumpyFeatureExtractor(extractor).execute(image, mask)
+
+
+def test_feature_keys_match(features):
+    expected, actual = features
+    assert list(actual) == list(expected)
+
+
+@pytest.mark.parametrize('feature_class', sorted(SUPPORTED_FEATURES))
+def test_feature_class_matches_pyradiomics(features, feature_class):
+    expected, actual = features
+    selected = {key: value for key, value in expected.items() if f'_{feature_class}_' in key}
+    assert len(selected) == len(SUPPORTED_FEATURES[feature_class])
+    difference = relative_difference(selected, actual)
+    assert max(difference.values()) <= TOLERANCE, difference
+
+
+def test_compare_with_pyradiomics_reports_no_mismatches():
+    image, mask = Preprocessor('T2').preprocessing_step(IMAGE_PATH, MASK_PATH, resample=False)
+    assert compare_with_pyradiomics(PARAMS_PATH, image, mask) == {}
+
+
+def test_numpy_backend_matches_model_features(registered_model):
+    image, mask = Preprocessor('T2').preprocessing_step(IMAGE_PATH, MASK_PATH, resample=False)
+    expected = registered_model.feature_extractor.extract_features(image, mask)
+    actual = FeatureExtractor(registered_model.name, desired_order_bool=False, backend='numpy').extract_features(
+        image, mask)
+    assert max(relative_difference(expected, actual).values()) <= 1e-12
@@ -0,0 +1,54 @@
+import pytest
+from radiomics import featureextractor
+from conftest import IMAGE_PATH, MASK_PATH
+import parallel_feature_extracting
+from parallel_feature_extracting import ParallelFeatureExtractor, supports_pyradiomics
+from preprocessing import Preprocessor
+
+PARAMS_PATH = 'params/liver_t2w_xgboost_extracting_params.yaml'
+
+
+@pytest.fixture(scope='module')
+def case():
+    return Preprocessor('T2').preprocessing_step(IMAGE_PATH, MASK_PATH, resample=False)
+
+
+@pytest.fixture(scope='module')
+def parallel_extractor():
+    extractor = ParallelFeatureExtractor(featureextractor.RadiomicsFeatureExtractor(PARAMS_PATH), workers=2)
+    yield extractor
+    extractor.shutdown()
+
+
+def assert_same_features(expected: dict, actual: dict) -> None:
+    # Диагностики содержат время и версии окружения, сравниваются только их ключи
+    assert list(actual) == list(expected)
+    for key, value in expected.items():
+        if 'diagnostics' not in key:
+            assert float(actual[key]) == float(value), key
+
+
+def test_supported_version_installed():
+    assert supports_pyradiomics()
+
+
+def test_execute_matches_pyradiomics(case, parallel_extractor):
+    image, mask = case
+    assert_same_features(parallel_extractor.extractor.execute(image, mask), parallel_extractor.execute(image, mask))
+
+
+def test_prepare_matches_pyradiomics_shape_features(case, parallel_extractor):
+    image, mask = case
+    features, inputs = parallel_extractor.prepare(image, mask)
+    expected = parallel_extractor.extractor.execute(image, mask)
+    assert list(features) == [key for key in expected if '_shape_' in key or 'diagnostics' in key]
+    assert [image_type for _, _, image_type, _ in inputs] == [name.lower() for name in
+                                                               parallel_extractor.extractor.enabledImagetypes]
+
+
+def test_unsupported_version_falls_back_to_execute(case, parallel_extractor, monkeypatch):
+    # Модуль может держать отложенный заместитель radiomics с собственной копией атрибутов
+    monkeypatch.setattr(parallel_feature_extracting.radiomics, '__version__', 'v4.0.0')
+    assert not supports_pyradiomics()
+    image, mask = case
+    assert_same_features(parallel_extractor.extractor.execute(image, mask), parallel_extractor.execute(image, mask))
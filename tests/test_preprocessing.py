@@ -0,0 +1,16 @@
+import pytest
+import SimpleITK as sitk
+from conftest import IMAGE_PATH, MASK_PATH, relative_difference
+from preprocessing import Preprocessor
+
+
+@pytest.mark.parametrize('resample', [False, True])
+def test_crop_matches_full_volume(registered_model, resample):
+    preprocessor = Preprocessor('T2')
+    full_image, full_mask = preprocessor.preprocessing_step(IMAGE_PATH, MASK_PATH, resample=resample)
+    crop_image, crop_mask = preprocessor.preprocessing_step(IMAGE_PATH, MASK_PATH, resample=resample, crop=True)
+
+    assert sitk.GetArrayViewFromImage(crop_mask).sum() == sitk.GetArrayViewFromImage(full_mask).sum()
+    full = registered_model.feature_extractor.extract_features(full_image, full_mask)
+    crop = registered_model.feature_extractor.extract_features(crop_image, crop_mask)
+    assert max(relative_difference(full, crop).values()) < 1e-5
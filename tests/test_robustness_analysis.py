@@ -0,0 +1,110 @@
+import csv
+import json
+import os
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from conftest import CASE_DIR, CLINICAL_DATA, IMAGE_PATH, MASK_PATH, MODEL, PROBABILITY
+import robustness_analysis
+from robustness_analysis import RobustnessAnalyzer, perturb_mask, stability_summary, variant_name
+
+
+def cube_mask() -> sitk.Image:
+    array = np.zeros((9, 9, 9), dtype=np.uint8)
+    array[3:6, 3:6, 3:6] = 1
+    return sitk.GetImageFromArray(array)
+
+
+def row(variant: str, prediction, probability) -> dict:
+    return {'variant': variant, 'prediction': prediction, 'probability': probability}
+
+
+@pytest.fixture(scope='module')
+def analyzer():
+    return RobustnessAnalyzer(MODEL)
+
+
+@pytest.fixture(scope='module')
+def result(analyzer):
+    return analyzer.process(IMAGE_PATH, MASK_PATH, CLINICAL_DATA)
+
+
+@pytest.mark.parametrize('radius, in_plane, voxels', [(0, True, 27), (-1, True, 3), (1, True, 75), (1, False, 117)])
+def test_perturb_mask(radius, in_plane, voxels):
+    mask = cube_mask()
+    perturbed = perturb_mask(mask, radius, in_plane)
+    assert sitk.GetArrayViewFromImage(perturbed).sum() == voxels
+    if radius == 0:
+        assert perturbed is mask
+
+
+@pytest.mark.parametrize('mask_radius, bin_count, name', [(0, None, 'reference'), (-1, None, 'erode 1'),
+                                                          (2, 16, 'dilate 2, bins 16'), (0, 48, 'bins 48')])
+def test_variant_name(mask_radius, bin_count, name):
+    assert variant_name(mask_radius, bin_count) == name
+
+
+def test_stability_summary():
+    rows = [row('reference', 1, 0.7), row('bins 16', 1, 0.8), row('erode 1', 0, 0.4), row('dilate 1', None, None)]
+    summary = stability_summary(rows)
+    assert (summary['variants'], summary['failed']) == (3, 1)
+    assert summary['flipped'] == ['erode 1']
+    assert summary['agreement'] == pytest.approx(2 / 3)
+    assert summary['stable'] is False
+    assert (summary['probability_min'], summary['probability_max']) == (0.4, 0.8)
+    assert summary['max_deviation'] == pytest.approx(0.3)
+
+
+def test_stability_summary_without_reference():
+    summary = stability_summary([row('reference', None, None), row('bins 16', 1, 0.8)])
+    assert summary['stable'] is None and summary['agreement'] is None
+
+
+def test_variants_skip_default_bin_count():
+    default_bin_count = RobustnessAnalyzer(MODEL, bin_counts=()).variants()
+    assert default_bin_count == [(0, None), (-1, None), (1, None)]
+    separate = RobustnessAnalyzer(MODEL, mask_radii=(1,), bin_counts=(16, 32)).variants()
+    assert separate == [(0, None), (0, 16), (1, None)]
+    grid = RobustnessAnalyzer(MODEL, mask_radii=(1,), bin_counts=(16,), grid=True).variants()
+    assert grid == [(0, None), (0, 16), (1, None), (1, 16)]
+
+
+def test_invalid_bin_count_is_rejected():
+    with pytest.raises(ValueError):
+        RobustnessAnalyzer(MODEL, bin_counts=(1,))
+
+
+def test_analyze_liver_case(analyzer, result):
+    rows = {row['variant']: row for row in result['rows']}
+    assert [variant_name(*variant) for variant in analyzer.variants()] == list(rows)
+    assert all(row['error'] == '' for row in rows.values())
+    assert rows['reference']['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+    assert rows['erode 1']['voxels'] < rows['reference']['voxels'] < rows['dilate 1']['voxels']
+    assert rows['bins 16']['bin_count'] == 16
+    assert result['summary']['probability'] == rows['reference']['probability']
+    assert result['summary']['variants'] == len(rows)
+
+
+def test_vanished_mask_does_not_stop_other_variants():
+    result = RobustnessAnalyzer(MODEL, mask_radii=(-50,), bin_counts=()).process(IMAGE_PATH, MASK_PATH,
+                                                                                 CLINICAL_DATA)
+    reference, eroded = result['rows']
+    assert reference['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
+    assert eroded['voxels'] == 0 and eroded['prediction'] is None and eroded['error']
+    assert result['summary']['failed'] == 1
+
+
+def test_main_writes_summary_file(monkeypatch, tmp_path, capsys):
+    output = str(tmp_path / 'robustness.csv')
+    monkeypatch.setattr(sys, 'argv', ['robustness_analysis.py', IMAGE_PATH, MASK_PATH,
+                                      os.path.join(CASE_DIR, 'clinical_data.txt'), output,
+                                      '--radii', '--bin-counts', '16', '--backend', 'numpy'])
+    robustness_analysis.main()
+    assert capsys.readouterr().out == ''
+    with open(output, newline='') as f:
+        assert [row['variant'] for row in csv.DictReader(f)] == ['reference', 'bins 16']
+    with open(tmp_path / 'robustness_summary.json') as f:
+        summary = json.load(f)
+    assert summary['variants'] == 2
+    assert summary['probability'] == pytest.approx(PROBABILITY, abs=1e-6)
@@ -0,0 +1,71 @@
+import threading
+import time
+import numpy as np
+import pytest
+from conftest import IMAGE_PATH, MASK_PATH
+from memory_monitoring import reset_peak_rss, track_peak_rss
+from preprocessing import Preprocessor
+from tracing import tracer as shared_tracer
+
+ALLOCATION = 768 * 2 ** 20
+
+
+def allocate_and_free() -> None:
+    # Память заполняется, чтобы страницы попали в резидентную память, и сразу освобождается
+    np.ones(ALLOCATION, dtype=np.uint8).sum()
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    # Декоратор traced пишет интервалы в общий трассировщик
+    if not reset_peak_rss():
+        pytest.skip('Peak RSS reset is not supported')
+    monkeypatch.setattr(shared_tracer, 'enabled', True)
+    monkeypatch.setattr(shared_tracer, 'trace_file', None)
+    return shared_tracer
+
+
+def test_nested_tracking_keeps_outer_peak():
+    with track_peak_rss() as outer:
+        allocate_and_free()
+        with track_peak_rss() as inner:
+            pass
+    if not outer['tracked']:
+        pytest.skip('Peak RSS reset is not supported')
+    assert outer['peak_rss'] >= ALLOCATION * 0.9
+    assert inner['peak_rss'] < ALLOCATION * 0.5
+
+
+def test_child_span_does_not_reset_parent_peak(tracer):
+    with tracer.request() as spans:
+        with tracer.span('batch'):
+            allocate_and_free()
+            with tracer.span('preprocess'):
+                pass
+    peaks = {span['name']: span['peak_rss'] for span in spans}
+    assert peaks['batch'] >= ALLOCATION * 0.9
+    assert peaks['preprocess'] < ALLOCATION * 0.5
+
+
+def test_preprocessing_keeps_enclosing_span_peak(tracer):
+    with tracer.request() as spans:
+        with tracer.span('process_case'):
+            allocate_and_free()
+            Preprocessor('T2').preprocessing_step(IMAGE_PATH, MASK_PATH)
+    peaks = {span['name']: span['peak_rss'] for span in spans}
+    assert peaks['process_case'] >= ALLOCATION * 0.9
+    assert peaks['preprocess'] < peaks['process_case']
+
+
+def test_span_cpu_includes_other_threads(tracer):
+    def spin(seconds: float) -> None:
+        end = time.process_time() + seconds
+        while time.process_time() < end:
+            pass
+
+    with tracer.request() as spans:
+        with tracer.span('threads'):
+            thread = threading.Thread(target=spin, args=(0.3,))
+            thread.start()
+            thread.join()
+    assert spans[0]['cpu'] >= 0.25
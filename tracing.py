@@ -0,0 +1,266 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from memory_monitoring import track_peak_rss
+
+# Трассировка включается переменной окружения или Tracer.enable()
+TRACING_ENV = 'RADIOMICS_TRACING'
+# Файл, в который дописываются завершенные интервалы в формате JSON Lines
+TRACE_FILE_ENV = 'RADIOMICS_TRACE_FILE'
+# Границы корзин гистограмм длительности в секундах
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+# Количество последних интервалов, хранимых в памяти
+SPANS_LIMIT = 10000
+METRIC_PREFIX = 'radiomics'
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_sink = contextvars.ContextVar('sink', default=None)
+
+
+class Tracer:
+    """
+    Класс Tracer предназначен для записи интервалов выполнения этапов (span) с временем, процессорным временем,
+    размерами входных данных, попаданиями в кэш и пиковой памятью, привязанных к идентификатору запроса,
+    и для агрегирования их в гистограммы в текстовом формате Prometheus.
+    При выключенной трассировке декорированные функции вызываются напрямую
+
+    Атрибуты:
+    - enabled (bool): Флаг, указывающий, включена ли трассировка
+    - spans (deque): Последние завершенные интервалы
+    - trace_file (str | None): Файл JSON Lines для завершенных интервалов
+
+    Методы:
+    - __init__(self, enabled=None, trace_file=None): Инициализация класса Tracer
+    - enable(self, trace_file=None): Включение трассировки
+    - disable(self): Выключение трассировки
+    - request(self, request_id=None): Контекст запроса, собирающий его интервалы
+    - span(self, name, **attributes): Контекст интервала
+    - ingest(self, spans): Добавление интервалов, записанных в другом процессе
+    - prometheus_text(self) -> str: Метрики в текстовом формате Prometheus
+    - write_prometheus(self, path): Запись метрик в файл
+    """
+
+    def __init__(self, enabled=None, trace_file=None):
+        """
+        Инициализация класса Tracer
+
+        Параметры:
+        - enabled (bool): Флаг включения, по умолчанию берется из переменной окружения RADIOMICS_TRACING
+        - trace_file (str): Файл JSON Lines, по умолчанию из переменной окружения RADIOMICS_TRACE_FILE
+        """
+        if enabled is None:
+            enabled = os.environ.get(TRACING_ENV, '').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.trace_file = trace_file or os.environ.get(TRACE_FILE_ENV)
+        self.spans = deque(maxlen=SPANS_LIMIT)
+        self._histograms = {}
+        self._counters = {}
+        self._peaks = {}
+        self._lock = threading.Lock()
+
+    def enable(self, trace_file=None) -> None:
+        """
+        Включение трассировки
+
+        Параметры:
+        - trace_file (str): Файл JSON Lines для завершенных интервалов
+        """
+        self.enabled = True
+        if trace_file:
+            self.trace_file = trace_file
+
+    def disable(self) -> None:
+        """
+        Выключение трассировки
+        """
+        self.enabled = False
+
+    @contextmanager
+    def request(self, request_id=None):
+        """
+        Контекст запроса: интервалы внутри получают идентификатор запроса и собираются в список
+
+        Параметры:
+        - request_id (str): Идентификатор запроса, по умолчанию случайный
+
+        Возвращает:
+        - spans (list): Интервалы запроса, заполняется по мере их завершения
+        """
+        spans = []
+        if not self.enabled:
+            yield spans
+            return
+        request_token = _request_id.set(request_id or uuid.uuid4().hex)
+        sink_token = _sink.set(spans)
+        try:
+            yield spans
+        finally:
+            _sink.reset(sink_token)
+            _request_id.reset(request_token)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Контекст интервала. Процессорное время - время всего процесса, включая потоки ITK и pyradiomics;
+        при параллельных запросах в одном процессе в него входит и работа других запросов.
+        Работа в пуле процессов записывается интервалами самих процессов-обработчиков
+
+        Параметры:
+        - name (str): Название этапа
+        - attributes: Атрибуты интервала (размеры, попадания в кэш и т.д.)
+
+        Возвращает:
+        - span (dict | None): Запись интервала или None при выключенной трассировке
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = _current_span.get()
+        record = {
+            'name': name,
+            'request_id': _request_id.get(),
+            'span_id': uuid.uuid4().hex[:16],
+            'parent_id': parent['span_id'] if parent else None,
+            'pid': os.getpid(),
+            'start': time.time(),
+            'attributes': dict(attributes)
+        }
+        token = _current_span.set(record)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with track_peak_rss() as peak:
+                yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['wall'] = time.perf_counter() - wall_start
+            record['cpu'] = time.process_time() - cpu_start
+            record['peak_rss'] = peak['peak_rss']
+            _current_span.reset(token)
+            self._finish(record)
+
+    def _finish(self, record: dict) -> None:
+        sink = _sink.get()
+        if sink is not None:
+            sink.append(record)
+        self.ingest([record])
+        if self.trace_file:
+            with self._lock, open(self.trace_file, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def ingest(self, spans) -> None:
+        """
+        Добавление завершенных интервалов в агрегаты, в том числе записанных в процессах-обработчиках
+
+        Параметры:
+        - spans (list): Записи интервалов
+        """
+        with self._lock:
+            for record in spans or []:
+                self.spans.append(record)
+                name = record['name']
+                for metric in ('wall', 'cpu'):
+                    counts, total = self._histograms.get((name, metric), ([0] * len(DURATION_BUCKETS), 0.0))
+                    for index, bound in enumerate(DURATION_BUCKETS):
+                        if record[metric] <= bound:
+                            counts[index] += 1
+                    self._histograms[(name, metric)] = (counts, total + record[metric])
+                self._peaks[name] = max(self._peaks.get(name, 0), record['peak_rss'])
+                for key in ('voxels', 'roi_voxels'):
+                    if key in record['attributes']:
+                        self._counters[(name, key)] = self._counters.get((name, key), 0) + record['attributes'][key]
+                if 'cache_hit' in record['attributes']:
+                    key = (name, 'cache_hits' if record['attributes']['cache_hit'] else 'cache_misses')
+                    self._counters[key] = self._counters.get(key, 0) + 1
+                if 'error' in record:
+                    self._counters[(name, 'errors')] = self._counters.get((name, 'errors'), 0) + 1
+
+    def prometheus_text(self) -> str:
+        """
+        Агрегированные метрики в текстовом формате Prometheus
+
+        Возвращает:
+        - text (str): Гистограммы длительности и процессорного времени по этапам, пиковая память и счетчики
+        """
+        lines = []
+        with self._lock:
+            for metric, description in (('wall', 'Stage wall-clock time'), ('cpu', 'Stage process CPU time, all threads')):
+                family = f'{METRIC_PREFIX}_stage_{metric}_seconds'
+                lines += [f'# HELP {family} {description}', f'# TYPE {family} histogram']
+                for (name, key), (counts, total) in sorted(self._histograms.items()):
+                    if key != metric:
+                        continue
+                    for bound, count in zip(DURATION_BUCKETS, counts):
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{family}_bucket{{stage="{name}",le="{le}"}} {count}')
+                    lines.append(f'{family}_sum{{stage="{name}"}} {total}')
+                    lines.append(f'{family}_count{{stage="{name}"}} {counts[-1]}')
+
+            family = f'{METRIC_PREFIX}_stage_peak_rss_bytes'
+            lines += [f'# HELP {family} Largest peak resident memory growth during a stage', f'# TYPE {family} gauge']
+            lines += [f'{family}{{stage="{name}"}} {peak}' for name, peak in sorted(self._peaks.items())]
+
+            counter_names = sorted({key for _, key in self._counters})
+            for key in counter_names:
+                family = f'{METRIC_PREFIX}_stage_{key}_total'
+                lines += [f'# TYPE {family} counter']
+                lines += [f'{family}{{stage="{name}"}} {value}'
+                          for (name, counter), value in sorted(self._counters.items()) if counter == key]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Запись метрик в файл для textfile-коллектора Prometheus
+
+        Параметры:
+        - path (str): Путь к файлу
+        """
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+        logging.info(f'Tracing: Metrics written to {path}')
+
+
+# Общий трассировщик процесса
+tracer = Tracer()
+
+
+def traced(name: str):
+    """
+    Декоратор, записывающий вызов функции как интервал. При выключенной трассировке функция вызывается напрямую
+
+    Параметры:
+    - name (str): Название этапа
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes) -> None:
+    """
+    Добавление атрибутов к текущему интервалу; без трассировки ничего не делает
+
+    Параметры:
+    - attributes: Атрибуты интервала
+    """
+    if tracer.enabled:
+        record = _current_span.get()
+        if record is not None:
+            record['attributes'].update(attributes)
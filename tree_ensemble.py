@@ -0,0 +1,327 @@
+from __future__ import annotations
+import ctypes
+import ctypes.util
+import json
+import logging
+import sys
+from lazy_importing import lazy_import
+
+np = lazy_import('numpy')
+
+TREES_SUFFIX = '_trees.npz'
+TREES_FORMAT_VERSION = 1
+# Верхняя граница аргумента expf в сигмоиде, как в xgboost::common::Sigmoid
+SIGMOID_LIMIT = 88.7
+SIGMOID_EPSILON = 1e-16
+# Расстояние до середины между соседними float32 в долях их разности, ближе которого результат
+# берется из libm платформы: expf/logf libm не всегда округляют точно, как округленное значение float64
+ROUNDING_MARGIN = 0.01
+# Для небольших массивов функция libm вызывается для каждого значения, это быстрее векторной проверки
+LIBM_DIRECT_SIZE = 16
+# Листья дерева - биты uint64
+MAX_LEAVES = 64
+ALL_LEAVES = (1 << MAX_LEAVES) - 1
+
+_libm_functions = {}
+
+
+def _libm_function(name: str):
+    # Функция float32 -> float32 из libm платформы, None - библиотека недоступна
+    if name not in _libm_functions:
+        function = None
+        path = 'ucrtbase' if sys.platform == 'win32' else ctypes.util.find_library('m')
+        try:
+            function = getattr(ctypes.CDLL(path), name)
+            function.restype = ctypes.c_float
+            function.argtypes = [ctypes.c_float]
+        except (OSError, AttributeError, TypeError):
+            logging.warning(f'TreeEnsemble: {name} from libm is not available, using float64 rounding')
+        _libm_functions[name] = function
+    return _libm_functions[name]
+
+
+def libm_float32(name: str, values):
+    """
+    Вычисление expf или logf с тем же результатом, что у libm платформы, которую использует xgboost:
+    небольшие массивы вычисляются самой libm, в остальных значение считается в float64 и округляется
+    до float32, а редкие значения у середины между соседними float32 вычисляются libm
+
+    Параметры:
+    - name (str): Имя функции, 'expf' или 'logf'
+    - values (np.ndarray): Аргументы float32
+
+    Возвращает:
+    - result (np.ndarray): Значения float32
+    """
+    values = np.asarray(values, dtype=np.float32)
+    function = _libm_function(name)
+    if function is not None and values.size <= LIBM_DIRECT_SIZE:
+        return np.array([function(value) for value in values.reshape(-1).tolist()],
+                        dtype=np.float32).reshape(values.shape)
+    exact = {'expf': np.exp, 'logf': np.log}[name](values.astype(np.float64))
+    result = exact.astype(np.float32)
+    neighbour = np.nextafter(result, np.where(exact > result, np.float32(np.inf), np.float32(-np.inf)))
+    step = np.abs(neighbour.astype(np.float64) - result)
+    midpoint = (neighbour.astype(np.float64) + result) / 2
+    ambiguous = np.flatnonzero(np.abs(exact - midpoint) < ROUNDING_MARGIN * step)
+    if ambiguous.size and function is not None:
+        result = result.copy()
+        flat = result.reshape(-1)
+        for index, value in zip(ambiguous, values.reshape(-1)[ambiguous]):
+            flat[index] = function(float(value))
+    return result
+
+
+class TreeEnsemble:
+    """
+    Класс TreeEnsemble - компактное представление бинарного классификатора xgboost (gbtree, binary:logistic)
+    в массивах. Листья каждого дерева пронумерованы слева направо, внутренний узел хранит битовую маску
+    листьев, остающихся, если значение идет вправо (без листьев левого поддерева). Все узлы всех деревьев
+    проверяются для всех строк одной операцией, выходной лист дерева - младший бит пересечения масок.
+    Суммирование листьев и сигмоида повторяют вычисления xgboost в float32, поэтому вероятности
+    совпадают с predict_proba побитово
+
+    Атрибуты:
+    - feature (np.ndarray): Индекс признака внутреннего узла
+    - threshold (np.ndarray): Порог узла float32, значение меньше порога идет влево
+    - default_left (np.ndarray): Направление для пропущенного значения (NaN)
+    - mask (np.ndarray): Листья дерева (uint64), остающиеся при переходе вправо
+    - tree_start (np.ndarray): Первый узел каждого дерева в порядке бустинга
+    - leaf_value (np.ndarray): Значения листьев float32
+    - leaf_start (np.ndarray): Первый лист каждого дерева
+    - base_margin (np.float32): Начальное значение отступа
+    - classes (np.ndarray): Метки классов
+    - schema (list): Порядок и кодирование входных столбцов, как Predictor.schema
+    - source_digest (str): Хэш файла модели, из которого получено представление
+
+    Методы:
+    - __init__(self, arrays, meta): Инициализация класса TreeEnsemble
+    - from_xgboost(estimator, schema, source_digest='') -> TreeEnsemble: Преобразование XGBClassifier
+    - save(self, path): Сохранение в .npz
+    - load(path) -> TreeEnsemble: Загрузка из .npz
+    - margins(self, matrix) -> np.ndarray: Отступы для строк матрицы
+    - predict_proba(self, matrix) -> np.ndarray: Вероятности классов
+    - validation_matrix(self, rows=10000, seed=0) -> np.ndarray: Строки у порогов деревьев для проверки
+    """
+
+    ARRAYS = ('feature', 'threshold', 'default_left', 'mask', 'tree_start', 'leaf_value', 'leaf_start')
+
+    def __init__(self, arrays: dict, meta: dict):
+        """
+        Инициализация класса TreeEnsemble
+
+        Параметры:
+        - arrays (dict): Массивы feature, threshold, default_left, mask, tree_start, leaf_value и leaf_start
+        - meta (dict): base_score, classes, schema и source_digest
+        """
+        self.feature = np.asarray(arrays['feature'], dtype=np.intp)
+        self.threshold = np.asarray(arrays['threshold'], dtype=np.float32)
+        self.default_left = np.asarray(arrays['default_left'], dtype=bool)
+        self.mask = np.asarray(arrays['mask'], dtype=np.uint64)
+        self.tree_start = np.asarray(arrays['tree_start'], dtype=np.intp)
+        self.leaf_value = np.asarray(arrays['leaf_value'], dtype=np.float32)
+        self.leaf_start = np.asarray(arrays['leaf_start'], dtype=np.intp)
+        # Маски хранятся в наименьшем беззнаковом типе, вмещающем листья самого большого дерева
+        leaves = int(np.diff(np.append(self.leaf_start, self.leaf_value.size)).max(initial=1))
+        self._mask_type = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                               if np.iinfo(dtype).bits >= leaves)
+        self._masks = self.mask.astype(self._mask_type)[:, None]
+        self._thresholds = self.threshold[:, None]
+        self._default_left = self.default_left[:, None] if self.default_left.any() else None
+        self._trees = list(zip(self.tree_start.tolist(), np.append(self.tree_start[1:], self.feature.size).tolist(),
+                               [self.leaf_value[start:] for start in self.leaf_start.tolist()]))
+        # Номер младшего установленного бита для масок до 16 бит
+        self._lowest_bit = None
+        if np.iinfo(self._mask_type).bits <= 16:
+            values = np.arange(1, 1 << np.iinfo(self._mask_type).bits)
+            self._lowest_bit = np.zeros(values.size + 1, dtype=np.intp)
+            self._lowest_bit[1:] = np.log2(values & -values).astype(np.intp)
+        self.meta = meta
+        # Начальный отступ - ProbToMargin логистической функции потерь xgboost в float32
+        base_score = np.float32(meta['base_score'])
+        self.base_margin = -libm_float32('logf', np.float32(1) / base_score - np.float32(1))
+        self.classes = np.array(meta['classes'])
+        self.schema = [tuple(column) if column[0] == 'numeric' else
+                       (column[0], column[1], {category: position for category, position in column[2]},
+                        column[3], column[4]) for column in meta['schema']]
+        self.source_digest = meta['source_digest']
+
+    @classmethod
+    def from_xgboost(cls, estimator, schema: list, source_digest='') -> TreeEnsemble:
+        """
+        Преобразование обученного XGBClassifier в массивы узлов и листьев
+
+        Параметры:
+        - estimator: Обученный xgboost.XGBClassifier
+        - schema (list): Порядок и кодирование входных столбцов (Predictor.schema)
+        - source_digest (str): Хэш файла модели
+
+        Возвращает:
+        - ensemble (TreeEnsemble): Представление модели
+        """
+        booster = estimator.get_booster()
+        learner = json.loads(booster.save_raw('json'))['learner']
+        model = learner['gradient_booster'].get('model', {})
+        parameters = learner['learner_model_param']
+        if learner['objective']['name'] != 'binary:logistic' or learner['gradient_booster']['name'] != 'gbtree' \
+                or int(parameters.get('num_target', 1)) != 1 or len(estimator.classes_) != 2:
+            logging.error('TreeEnsemble: Unsupported model')
+            raise ValueError('TreeEnsemble: Only binary:logistic gbtree classifiers are supported')
+
+        trees = model['trees']
+        # После ранней остановки predict_proba использует деревья до лучшей итерации
+        best_iteration = booster.attr('best_iteration')
+        if best_iteration is not None:
+            trees = trees[:model['iteration_indptr'][int(best_iteration) + 1]]
+
+        columns = {name: [] for name in cls.ARRAYS}
+        for tree in trees:
+            if any(tree.get('split_type', [])):
+                logging.error('TreeEnsemble: Categorical splits are not supported')
+                raise ValueError('TreeEnsemble: Categorical splits are not supported')
+            columns['tree_start'].append(len(columns['feature']))
+            columns['leaf_start'].append(len(columns['leaf_value']))
+            left, right = tree['left_children'], tree['right_children']
+            # Листья слева направо и диапазон номеров листьев каждого поддерева
+            leaves, spans, stack = [], {}, [(0, False)]
+            while stack:
+                node, visited = stack.pop()
+                if left[node] == -1:
+                    spans[node] = (len(leaves), len(leaves) + 1)
+                    leaves.append(node)
+                elif visited:
+                    spans[node] = (spans[left[node]][0], spans[right[node]][1])
+                else:
+                    stack.extend([(node, True), (right[node], False), (left[node], False)])
+            if len(leaves) > MAX_LEAVES:
+                logging.error('TreeEnsemble: Tree is too large')
+                raise ValueError(f'TreeEnsemble: Trees with more than {MAX_LEAVES} leaves are not supported')
+            # Значение листа хранится в split_conditions
+            columns['leaf_value'].extend(tree['split_conditions'][node] for node in leaves)
+            for node in range(len(left)):
+                if left[node] == -1:
+                    continue
+                first, last = spans[left[node]]
+                columns['feature'].append(tree['split_indices'][node])
+                columns['threshold'].append(tree['split_conditions'][node])
+                columns['default_left'].append(bool(tree['default_left'][node]))
+                columns['mask'].append(ALL_LEAVES & ~((1 << last) - (1 << first)))
+            if len(leaves) == 1:
+                # Дерево из одного листа: узел, который всегда идет вправо и не убирает листьев
+                columns['feature'].append(0)
+                columns['threshold'].append(np.nan)
+                columns['default_left'].append(False)
+                columns['mask'].append(ALL_LEAVES)
+
+        meta = {
+            'version': TREES_FORMAT_VERSION,
+            'base_score': float(parameters['base_score']),
+            'classes': estimator.classes_.tolist(),
+            'schema': [list(column) if column[0] == 'numeric' else
+                       [column[0], column[1], list(column[2].items()), column[3], column[4]] for column in schema],
+            'source_digest': source_digest
+        }
+        columns['mask'] = np.array(columns['mask'], dtype=np.uint64)
+        return cls(columns, meta)
+
+    def save(self, path: str) -> None:
+        """
+        Сохранение в несжатый .npz
+
+        Параметры:
+        - path (str): Путь к файлу
+        """
+        np.savez(path, **{name: getattr(self, name) for name in self.ARRAYS}, meta=np.array(json.dumps(self.meta)))
+        logging.info(f'TreeEnsemble: Saved {len(self.tree_start)} trees to {path}')
+
+    @classmethod
+    def load(cls, path: str) -> TreeEnsemble:
+        """
+        Загрузка из .npz
+
+        Параметры:
+        - path (str): Путь к файлу
+
+        Возвращает:
+        - ensemble (TreeEnsemble): Представление модели
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != TREES_FORMAT_VERSION:
+                logging.error('TreeEnsemble: Unsupported file version')
+                raise ValueError(f'TreeEnsemble: Unsupported file version in {path}')
+            return cls({name: data[name] for name in cls.ARRAYS}, meta)
+
+    def margins(self, matrix) -> np.ndarray:
+        """
+        Отступы (сумма листьев и начальный отступ) для строк матрицы
+
+        Параметры:
+        - matrix (np.ndarray): Матрица float32 размера (число строк, число входов)
+
+        Возвращает:
+        - margins (np.ndarray): Отступы float32
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        # Узлы по строкам массива: при матрице в порядке столбцов (order='F') выборка непрерывна
+        values = matrix.T[self.feature]
+        go_left = values < self._thresholds
+        if self._default_left is not None and np.isnan(matrix).any():
+            go_left |= np.isnan(values) & self._default_left
+        # Переход вправо убирает листья левого поддерева, переход влево не убирает ничего (все биты)
+        kept = self._masks | np.negative(go_left.astype(self._mask_type))
+        margins = np.full(matrix.shape[0], self.base_margin, dtype=np.float32)
+        # Листья прибавляются в порядке деревьев, как в xgboost, чтобы округление float32 совпадало
+        for start, end, leaf_values in self._trees:
+            # Выходной лист - самый левый из оставшихся
+            remaining = np.bitwise_and.reduce(kept[start:end], axis=0)
+            if self._lowest_bit is not None:
+                leaves = self._lowest_bit[remaining]
+            else:
+                leaves = np.log2((remaining & (~remaining + self._mask_type(1))).astype(np.float64)).astype(np.intp)
+            margins += leaf_values[leaves]
+        return margins
+
+    def predict_proba(self, matrix) -> np.ndarray:
+        """
+        Вероятности классов, как XGBClassifier.predict_proba
+
+        Параметры:
+        - matrix (np.ndarray): Матрица float32 размера (число строк, число входов)
+
+        Возвращает:
+        - probabilities (np.ndarray): Вероятности float32 размера (число строк, 2)
+        """
+        exponent = libm_float32('expf', np.minimum(-self.margins(matrix), np.float32(SIGMOID_LIMIT)))
+        positive = np.float32(1) / (exponent + np.float32(1) + np.float32(SIGMOID_EPSILON))
+        return np.column_stack((np.float32(1) - positive, positive))
+
+    def validation_matrix(self, rows=10000, seed=0) -> np.ndarray:
+        """
+        Проверочные строки: значения входов на порогах деревьев, на соседних с ними float32,
+        между порогами и пропущенные значения
+
+        Параметры:
+        - rows (int): Количество строк
+        - seed (int): Начальное значение генератора
+
+        Возвращает:
+        - matrix (np.ndarray): Матрица float32 размера (rows, число входов)
+        """
+        rng = np.random.default_rng(seed)
+        width = sum(1 if column[0] == 'numeric' else column[3] for column in self.schema)
+        matrix = rng.normal(0, 1, (rows, width)).astype(np.float32)
+        for feature in range(width):
+            thresholds = self.threshold[(self.feature == feature) & ~np.isnan(self.threshold)]
+            if thresholds.size == 0:
+                continue
+            candidates = np.concatenate([
+                thresholds,
+                np.nextafter(thresholds, np.float32(np.inf)),
+                np.nextafter(thresholds, np.float32(-np.inf)),
+                thresholds * np.float32(0.5),
+                thresholds * np.float32(2),
+                [np.nan]
+            ]).astype(np.float32)
+            matrix[:, feature] = rng.choice(candidates, rows)
+        return matrix
@@ -0,0 +1,404 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from feature_cache import content_digest
+from lazy_importing import lazy_import
+from tracing import METRIC_PREFIX
+
+np = lazy_import('numpy')
+sitk = lazy_import('SimpleITK')
+
+# Хранилище включается только переменной окружения с каталогом, например RADIOMICS_VOLUME_STORE=cache/volumes:
+# оно пишет распакованные тома на диск без срока хранения
+VOLUME_STORE_ENV = 'RADIOMICS_VOLUME_STORE'
+VOLUME_STORE_PATH = 'cache/volumes'
+VOLUME_STORE_MAX_SIZE = 4 * 2 ** 30
+INDEX_FILE_NAME = 'index.sqlite'
+
+
+class StoredVolume:
+    """
+    Класс StoredVolume - том из хранилища, отображенный в память без чтения.
+    Повторяет геометрию и срезы sitk.Image: при вырезании области или среза с диска читаются
+    только страницы, которые в них попадают
+
+    Атрибуты:
+    - array (np.memmap): Воксели в порядке (z, y, x), только для чтения
+
+    Методы:
+    - __init__(self, array, spacing, origin, direction): Инициализация класса StoredVolume
+    - GetSize, GetSpacing, GetOrigin, GetDirection, GetDimension, GetNumberOfPixels: Геометрия, как у sitk.Image
+    - __getitem__(self, key) -> sitk.Image: Область или срез по индексам (x, y, z), как у sitk.Image
+    - region(self, index, size) -> sitk.Image: Область по начальному индексу и размеру
+    - image(self) -> sitk.Image: Весь том в памяти
+    """
+
+    def __init__(self, array, spacing: tuple, origin: tuple, direction: tuple):
+        """
+        Инициализация класса StoredVolume
+
+        Параметры:
+        - array (np.ndarray): Воксели в порядке (z, y, x)
+        - spacing (tuple): Размер вокселя (x, y, z)
+        - origin (tuple): Начало координат
+        - direction (tuple): Матрица направлений по строкам
+        """
+        self.array = array
+        self._spacing = tuple(spacing)
+        self._origin = tuple(origin)
+        self._direction = tuple(direction)
+
+    def GetSize(self) -> tuple:
+        return self.array.shape[::-1]
+
+    def GetSpacing(self) -> tuple:
+        return self._spacing
+
+    def GetOrigin(self) -> tuple:
+        return self._origin
+
+    def GetDirection(self) -> tuple:
+        return self._direction
+
+    def GetDimension(self) -> int:
+        return self.array.ndim
+
+    def GetNumberOfPixels(self) -> int:
+        return int(self.array.size)
+
+    def __getitem__(self, key) -> sitk.Image:
+        # Индексы в порядке SimpleITK (x, y, z); целый индекс убирает ось, как при срезе sitk.Image
+        key = key if isinstance(key, tuple) else (key,)
+        start, kept = [], []
+        for axis, item in enumerate(key):
+            if isinstance(item, slice):
+                if item.step not in (None, 1):
+                    logging.error('VolumeStore: Only contiguous regions are supported')
+                    raise ValueError('VolumeStore: Only contiguous regions are supported')
+                start.append(item.indices(self.GetSize()[axis])[0])
+                kept.append(axis)
+            else:
+                start.append(int(item))
+        # GetImageFromArray копирует область один раз, читая только ее страницы
+        image = sitk.GetImageFromArray(self.array[key[::-1]])
+        dimension = self.GetDimension()
+        direction = np.array(self._direction).reshape(dimension, dimension)
+        origin = np.array(self._origin) + direction @ (np.array(start) * np.array(self._spacing))
+        image.SetSpacing([self._spacing[axis] for axis in kept])
+        if len(kept) == dimension:
+            image.SetOrigin(origin.tolist())
+            image.SetDirection(self._direction)
+        return image
+
+    def region(self, index, size) -> sitk.Image:
+        """
+        Область тома, аналог sitk.RegionOfInterest
+
+        Параметры:
+        - index (list): Начальный индекс (x, y, z)
+        - size (list): Размер (x, y, z)
+
+        Возвращает:
+        - image (sitk.Image): Область в памяти с геометрией исходного тома
+        """
+        return self[tuple(slice(int(i), int(i) + int(n)) for i, n in zip(index, size))]
+
+    def image(self) -> sitk.Image:
+        """
+        Весь том в памяти
+
+        Возвращает:
+        - image (sitk.Image): Копия тома с геометрией исходного изображения
+        """
+        return self[(slice(None),) * self.GetDimension()]
+
+
+class VolumeStore:
+    """
+    Класс VolumeStore предназначен для хранения распакованных томов: каждый прочитанный с диска NIfTI/NRRD
+    один раз сохраняется несжатым массивом .npy с ключом по хэшу содержимого, повторные чтения
+    отображают файл в память вместо распаковки gzip. Индекс - SQLite, безопасный для нескольких процессов,
+    с LRU-вытеснением при превышении заданного размера. Хэши файлов запоминаются по пути, размеру
+    и времени изменения, поэтому повторное чтение файла не хэширует его заново
+
+    Атрибуты:
+    - path (str | None): Каталог хранилища, None - хранилище отключено
+    - max_size (int): Максимальный суммарный размер томов в байтах
+    - hits (int): Количество попаданий в текущем процессе
+    - misses (int): Количество промахов в текущем процессе
+    - saved_seconds (float): Сэкономленное время чтения в текущем процессе в секундах
+
+    Методы:
+    - __init__(self, path=VOLUME_STORE_PATH, max_size=VOLUME_STORE_MAX_SIZE): Инициализация класса VolumeStore
+    - enabled (bool): Флаг, указывающий, что хранилище включено
+    - file_key(self, path) -> str: Ключ тома по содержимому файла
+    - open(self, key, decode) -> StoredVolume | sitk.Image: Том, отображенный в память
+    - read(self, key, decode, index=None, size=None) -> sitk.Image: Том или его область в памяти
+    - stats(self) -> dict: Счетчики и сэкономленное время
+    - prometheus_text(self) -> str: Общие счетчики в текстовом формате Prometheus
+    """
+
+    def __init__(self, path=VOLUME_STORE_PATH, max_size=VOLUME_STORE_MAX_SIZE):
+        """
+        Инициализация класса VolumeStore
+
+        Параметры:
+        - path (str | None): Каталог хранилища, None - хранилище отключено
+        - max_size (int): Максимальный суммарный размер томов в байтах
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._keys = {}
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _initialize(self) -> None:
+        # Индекс создается при первом обращении, чтобы импорт модуля не трогал диск
+        with self._lock:
+            if self._initialized:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.path, INDEX_FILE_NAME), timeout=60)
+            try:
+                with connection:
+                    connection.execute('PRAGMA journal_mode=WAL')
+                    connection.execute('CREATE TABLE IF NOT EXISTS volumes (key TEXT PRIMARY KEY, '
+                                       'geometry TEXT, size INTEGER, decode_seconds REAL, last_access REAL)')
+                    connection.execute('CREATE INDEX IF NOT EXISTS volumes_last_access ON volumes (last_access)')
+                    connection.execute('CREATE TABLE IF NOT EXISTS sources ('
+                                       'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, key TEXT)')
+                    connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL)')
+                    connection.execute("INSERT OR IGNORE INTO counters VALUES "
+                                       "('hits', 0), ('misses', 0), ('saved_seconds', 0)")
+            finally:
+                connection.close()
+            self._initialized = True
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            self._initialize()
+        # Отдельное соединение на каждую операцию: безопасно для потоков и процессов после fork
+        connection = sqlite3.connect(os.path.join(self.path, INDEX_FILE_NAME), timeout=60,
+                                     isolation_level='IMMEDIATE')
+        # В режиме WAL индекс не теряет согласованность без fsync на каждую фиксацию
+        connection.execute('PRAGMA synchronous=NORMAL')
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _volume_path(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.npy')
+
+    def file_key(self, path: str) -> str:
+        """
+        Ключ тома по содержимому файла; хэш пересчитывается только при изменении файла
+
+        Параметры:
+        - path (str): Путь к файлу изображения
+
+        Возвращает:
+        - key (str): Ключ тома
+        """
+        path = os.path.realpath(path)
+        status = os.stat(path)
+        source = (path, status.st_size, status.st_mtime_ns)
+        if source in self._keys:
+            return self._keys[source]
+        with self._connect() as connection:
+            row = connection.execute('SELECT key FROM sources WHERE path = ? AND size = ? AND mtime = ?',
+                                     (path, status.st_size, status.st_mtime_ns)).fetchone()
+        if row is not None:
+            key = row[0]
+        else:
+            key = content_digest(path)
+            with self._connect() as connection:
+                connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (*source, key))
+        self._keys[source] = key
+        return key
+
+    def _lookup(self, key: str):
+        # Том из хранилища или None; файл мог быть вытеснен другим процессом после чтения индекса
+        with self._connect() as connection:
+            row = connection.execute('SELECT geometry, decode_seconds FROM volumes WHERE key = ?',
+                                     (key,)).fetchone()
+        if row is None:
+            return None, 0.0
+        try:
+            array = np.load(self._volume_path(key), mmap_mode='r')
+        except OSError:
+            return None, 0.0
+        return StoredVolume(array, **json.loads(row[0])), row[1]
+
+    def _ingest(self, key: str, decode):
+        # Распаковка исходного файла и сохранение тома с вытеснением давно не использованных томов
+        start = time.perf_counter()
+        image = decode()
+        decode_seconds = time.perf_counter() - start
+        array = sitk.GetArrayViewFromImage(image)
+        if image.GetNumberOfComponentsPerPixel() != 1 or array.nbytes > self.max_size:
+            logging.info('VolumeStore: Volume not storable, using decoded image')
+            return image
+
+        # Запись во временный файл и атомарное переименование: читатели не видят недописанный том
+        fd, temporary_path = tempfile.mkstemp(suffix='.npy', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(temporary_path, self._volume_path(key))
+        except OSError as e:
+            logging.error(f'VolumeStore: Error writing volume: {e}')
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return image
+
+        geometry = json.dumps({'spacing': image.GetSpacing(), 'origin': image.GetOrigin(),
+                               'direction': image.GetDirection()})
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?)',
+                               (key, geometry, array.nbytes, decode_seconds, time.time()))
+            total = connection.execute('SELECT SUM(size) FROM volumes').fetchone()[0]
+            evicted = []
+            if total > self.max_size:
+                for old_key, old_size in connection.execute('SELECT key, size FROM volumes ORDER BY last_access'):
+                    if total <= self.max_size:
+                        break
+                    if old_key != key:
+                        evicted.append((old_key,))
+                        total -= old_size
+                connection.executemany('DELETE FROM volumes WHERE key = ?', evicted)
+        for old_key, in evicted:
+            # Отображенные в память тома остаются доступны процессам, которые их уже открыли
+            try:
+                os.remove(self._volume_path(old_key))
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logging.info(f'VolumeStore: Evicted {len(evicted)} volumes')
+        logging.info(f'VolumeStore: Stored volume in {decode_seconds:.2f} s')
+        return image
+
+    def _count(self, key: str, hit: bool, saved_seconds=0.0) -> None:
+        # Время доступа и общие счетчики обновляются одной транзакцией после чтения
+        if hit:
+            self.hits += 1
+            self.saved_seconds += saved_seconds
+        else:
+            self.misses += 1
+        with self._connect() as connection:
+            if hit:
+                connection.execute('UPDATE volumes SET last_access = ? WHERE key = ?', (time.time(), key))
+                connection.execute("UPDATE counters SET value = value + ? WHERE name = 'saved_seconds'",
+                                   (saved_seconds,))
+            connection.execute('UPDATE counters SET value = value + 1 WHERE name = ?', ('hits' if hit else 'misses',))
+
+    def open(self, key: str, decode):
+        """
+        Том, отображенный в память; при промахе исходный файл распаковывается и сохраняется
+
+        Параметры:
+        - key (str): Ключ тома
+        - decode (callable): Функция без аргументов, читающая исходное изображение (sitk.Image)
+
+        Возвращает:
+        - volume (StoredVolume | sitk.Image): Том из хранилища или прочитанное изображение,
+          если том нельзя сохранить
+        """
+        start = time.perf_counter()
+        volume, decode_seconds = self._lookup(key)
+        if volume is None:
+            self._count(key, False)
+            image = self._ingest(key, decode)
+            volume, _ = self._lookup(key)
+            return volume if volume is not None else image
+        # Для тома в памяти экономия - время распаковки за вычетом отображения; чтение страниц - по мере срезов
+        self._count(key, True, decode_seconds - (time.perf_counter() - start))
+        return volume
+
+    def read(self, key: str, decode, index=None, size=None) -> sitk.Image:
+        """
+        Том или его область в памяти; с диска читаются только страницы области
+
+        Параметры:
+        - key (str): Ключ тома
+        - decode (callable): Функция без аргументов, читающая исходное изображение (sitk.Image)
+        - index (list): Начальный индекс области (x, y, z), None - весь том
+        - size (list): Размер области (x, y, z)
+
+        Возвращает:
+        - image (sitk.Image): Изображение или его область
+        """
+        start = time.perf_counter()
+        volume, decode_seconds = self._lookup(key)
+        if volume is None:
+            self._count(key, False)
+            image = self._ingest(key, decode)
+            return image if index is None else sitk.RegionOfInterest(image, [int(n) for n in size],
+                                                                      [int(i) for i in index])
+        image = volume.image() if index is None else volume.region(index, size)
+        self._count(key, True, decode_seconds - (time.perf_counter() - start))
+        return image
+
+    def stats(self) -> dict:
+        """
+        Счетчики попаданий и промахов, сэкономленное время, количество и размер томов
+
+        Возвращает:
+        - stats (dict): Счетчики текущего процесса, общие счетчики всех процессов и размер хранилища
+        """
+        with self._connect() as connection:
+            counters = dict(connection.execute('SELECT name, value FROM counters'))
+            entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM volumes').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved_seconds': self.saved_seconds,
+            'total_hits': int(counters['hits']),
+            'total_misses': int(counters['misses']),
+            'total_saved_seconds': counters['saved_seconds'],
+            'entries': entries,
+            'size': size
+        }
+
+    def prometheus_text(self) -> str:
+        """
+        Общие счетчики хранилища всех процессов в текстовом формате Prometheus
+
+        Возвращает:
+        - text (str): Попадания, промахи, сэкономленное время и размер, пустая строка - хранилище отключено
+        """
+        if not self.enabled:
+            return ''
+        stats = self.stats()
+        family = f'{METRIC_PREFIX}_volume_store'
+        return '\n'.join([
+            f'# HELP {family}_hits_total Volume reads served from the decompressed store',
+            f'# TYPE {family}_hits_total counter',
+            f'{family}_hits_total {stats["total_hits"]}',
+            f'# TYPE {family}_misses_total counter',
+            f'{family}_misses_total {stats["total_misses"]}',
+            f'# HELP {family}_saved_seconds_total Decompression time saved minus time spent reading the store',
+            f'# TYPE {family}_saved_seconds_total counter',
+            f'{family}_saved_seconds_total {stats["total_saved_seconds"]}',
+            f'# TYPE {family}_bytes gauge',
+            f'{family}_bytes {stats["size"]}'
+        ]) + '\n'
+
+
+# Общее хранилище томов процесса, по умолчанию отключено
+volume_store = VolumeStore(os.environ.get(VOLUME_STORE_ENV) or None)